@@ -3,10 +3,13 @@ import sys
 import time
 import copy
 import json
+import argparse
 import warnings
+from itertools import izip
 from astropy.io import fits as pyfits
 import numpy as np
 from multiprocessing import Pool
+from . import json_index
 warnings.filterwarnings("ignore")
 
 __version__ = "2.4"
@@ -52,12 +55,23 @@ ProcessMinExptime = 10.
 stackfitsname = 'allmlns.fits'
 allpairname = 'allpairs.json'
 alltrackname = 'mjdalltracks.json'
+alltrackstream = 'mjdalltracks.jsonl'
 
 
 #####################################
 # Searching moving objects
 #####################################
 
+def usable(ft):
+    """
+    Select the ns catalog rows that are considered for linking.
+
+    :param ft: the ns catalog table
+    :return: boolean mask of the usable rows
+    """
+    return (ft['FLUX_RADIUS'] > 2) & (ft['MAG_ISO'] < 24.5) & (ft['X_IMAGE'] < 2085) & (ft['X_IMAGE'] > 42)
+
+
 # HPX_02937_RA_160.3_DEC_+31.4_cat.fits.ns
 
 class SearchMovingObjects:
@@ -67,18 +81,16 @@ class SearchMovingObjects:
         os.chdir(self.workdir)
         self.cra = float(self.healpix.split('_')[0])
         self.cdec = float(self.healpix.split('_')[1])
+        self.fr = fr
 
     def readns(self, nsfile):
-        ft = pyfits.open(nsfile)[1].data
-        mjdlist = list(set([int(i) for i in ft['mid_mjdate']]))
-        mjdlist.sort()
+        # memory map the catalog so only the usable rows are copied into memory.
+        ft = pyfits.open(nsfile, memmap=True)[1].data
+        mjdlist = list(np.unique(ft['mid_mjdate'].astype(int)))
         midmjd = mjdlist[int(len(mjdlist) / 2.)]
-        outarray = ft[(ft['FLUX_RADIUS'] > 2) & (ft['MAG_ISO'] < 24.5) & (ft['X_IMAGE'] < 2085) & (ft['X_IMAGE'] > 42)]
-        self.sns = outarray
-        global sns
-        sns = ft[(ft['FLUX_RADIUS'] > 2) & (ft['MAG_ISO'] < 24.5) & (ft['X_IMAGE'] < 2085) & (ft['X_IMAGE'] > 42)]
+        self.sns = ft[usable(ft)]
         time.sleep(1)
-        print 'self.sns, ft', len(self.sns), len(ft), len(outarray)
+        print 'self.sns, ft', len(self.sns), len(ft)
         return midmjd
 
     def searchline(self, inputra, inputdec, ang, sr):
@@ -92,14 +104,20 @@ class SearchMovingObjects:
         if sum(inline) == 0:
             return 0
         else:
-            match = sns[inline]
+            match = self.sns[inline]
             return match
 
+    def lines(self, ang):
+        """
+        The search lines of an angle: (number, declination at self.cra) of one line every step across the field.
+        """
+        return enumerate(np.arange(self.cdec - self.fr, self.cdec + self.fr, step / 3600))
+
     def oneangle(self, ang):
         t2 = time.time()
         result2 = []
         print '[%s] Processing angle: %s' % (time.strftime("%D %H:%M:%S"), ang)
-        for sl, ldec in enumerate(np.arange(self.cdec - fr, self.cdec + fr, step / 3600)):
+        for sl, ldec in self.lines(ang):
             inputra, inputdec = self.cra, ldec
             mat = self.searchline(inputra, inputdec, ang, sr)
             if mat != 0:
@@ -223,15 +241,31 @@ class SearchMovingObjects:
             pairs[m] = linking
         return pairs
 
-    def Searching(self, multi, nsfile):
+    def Searching(self, multi, nsfile, ratelist=None, stream=None):
+        """
+        Search every position angle around the mean angle listed in the ratelist, or expected for the field when
+        there is no ratelist, for tracks.
+
+        When a TrackStream is given the tracks of each angle are appended to it as soon as the angle is finished,
+        angles already in the stream are skipped and self.results reads the angles back from the stream.
+        """
         # self.midjd = self.CombineNS(True)
         # self.readalldet()
         self.midmjd = self.readns(nsfile)
+        self.link(multi, self.angles(nsfile, ratelist), stream=stream)
+
+    def angles(self, nsfile, ratelist=None):
+        """
+        The position angles to search, openangle either side of the mean angle listed in the ratelist or, without
+        a ratelist, the angles of the motion expected for bound orbits in this field on self.midmjd.
+        """
+        if ratelist is None:
+            return self.FindMovingAngle(self.midmjd, self.cra, self.cdec)
         # self.aveang = self.FindMovingAngle(self.midmjd, self.cra, self.cdec)
         #		self.aveang = 31
         # ratelist = open('/sciproc/disk2/cfis/mis/ratelist.txt').readlines()
         # ratelist = open('/sciproc/disk2/cfis/mis/ratelist.17BQ02.txt').readlines()
-        ratelist = open(sys.argv[3]).readlines()
+        ratelist = open(ratelist).readlines()
         d = {}
         for r in ratelist:
             rns = r.split()[0]
@@ -240,11 +274,39 @@ class SearchMovingObjects:
         self.aveang = d[nsfile.rstrip('ns').rstrip('.')]
         print '[%s] Getting the reasonable moving speed on (%s)... Done. Mean angle = %s' % (
         time.strftime("%D %H:%M:%S"), nsfile, self.aveang)
-        allanglist = np.arange(self.aveang - openangle, self.aveang + openangle, 1.0)
-        pool = Pool(processes=N_threading)
+        return np.arange(self.aveang - openangle, self.aveang + openangle, 1.0)
+
+    def FindMovingAngle(self, mjd, ra, dec):
+        """
+        The position angles holding the motion of most bound orbits between au_s and maxau, see daomop.motion
+        """
+        from .motion import search_angles
+        allanglist, (vmin, vmax) = search_angles(mjd, ra, dec)
+        self.aveang = (allanglist[0] + allanglist[-1]) / 2.
+        print '[%s] Expected motion on %s at (%s, %s): angle %s to %s, rate %.2f to %.2f arcsec/hr' % (
+            time.strftime("%D %H:%M:%S"), mjd, ra, dec, allanglist[0], allanglist[-1], vmin * 3600 / 24.,
+            vmax * 3600 / 24.)
+        return allanglist
+
+    def link(self, multi, allanglist, stream=None):
+        """
+        Search the detections in self.sns along each of the given angles, leaving the tracks in self.results.
+        """
+        pool = multi and Pool(processes=N_threading)
         # self.subresults = pool.map(oneangle, allanglist)
         print '[%s] Searching reasonable tracks ... ' % (time.strftime("%D %H:%M:%S"))
-        if multi:
+        if stream is not None:
+            todo = [ang for ang in allanglist if float(ang) not in stream.done]
+            print '[%s] %s angles already in %s' % (
+                time.strftime("%D %H:%M:%S"), len(allanglist) - len(todo), stream.filename)
+            if multi:
+                results = pool.imap(unwrap_self_f, zip([self] * len(todo), todo), chunksize=1)
+            else:
+                results = (self.oneangle(ang) for ang in todo)
+            for ang, r in izip(todo, results):
+                stream.write(ang, r)
+            self.results = stream
+        elif multi:
             self.results = pool.map(unwrap_self_f, zip([self] * len(allanglist), allanglist), chunksize=1)
         else:
             self.results = []
@@ -255,9 +317,8 @@ class SearchMovingObjects:
     def CleanTracks_array(self):
         mjdalltracks = {}
         tracksarray = np.array([], dtype=[('ra', 'f8'), ('dec', 'f8'), ('mjd', 'i4'), ('objid', 'S150')])
-        for n, allsearchang in enumerate(s.results):
+        for n, angtrackslist in enumerate(self.results):
             t2 = time.time()
-            angtrackslist = s.results[n]
             for i, alltrack in enumerate(angtrackslist):
                 angtracks = angtrackslist[i]
                 for mjd in angtracks.keys():
@@ -293,29 +354,183 @@ class SearchMovingObjects:
         self.mjdalltracks = mjdalltracks
 
 
+class TrackStream(object):
+    """
+    JSON lines file holding the tracks found on each search angle, with a checkpoint file of the finished angles.
+
+    Each line is one search line's pairs, {"angle": ang, "pairs": {mjd: {objid: track}}}.  The checkpoint lists every
+    finished angle with the size of the stream once that angle was written, so a restarted job truncates whatever a
+    killed job wrote after its last finished angle and carries on.  A checkpoint line torn by the kill, with no
+    newline or not parsing, is dropped with anything after it.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.checkpoint = '%s.checkpoint' % filename
+        self.done = {}
+        if os.path.exists(self.checkpoint):
+            size = 0
+            with open(self.checkpoint) as fobj:
+                for line in fobj:
+                    if not line.endswith('\n'):
+                        break
+                    try:
+                        ang, offset = line.split()
+                        ang, offset = float(ang), int(offset)
+                    except ValueError:
+                        break
+                    self.done[ang] = offset
+                    size += len(line)
+            with open(self.checkpoint, 'a') as fobj:
+                fobj.truncate(size)
+        with open(self.filename, 'a') as fobj:
+            fobj.truncate(max(self.done.values()) if self.done else 0)
+
+    def write(self, ang, result):
+        """
+        Append the tracks of one angle to the stream and mark the angle as done.
+
+        :param ang: the search angle
+        :param result: the tracks of the angle, as returned by SearchMovingObjects.oneangle
+        """
+        with open(self.filename, 'a') as fobj:
+            for pairs in result:
+                if any(len(tracks) > 0 for tracks in pairs.values()):
+                    fobj.write(json.dumps({'angle': float(ang), 'pairs': pairs}) + '\n')
+            fobj.flush()
+            os.fsync(fobj.fileno())
+            offset = fobj.tell()
+        with open(self.checkpoint, 'a') as fobj:
+            fobj.write('%r %d\n' % (float(ang), offset))
+            fobj.flush()
+            os.fsync(fobj.fileno())
+        self.done[float(ang)] = offset
+
+    def __iter__(self):
+        """
+        Read the stream back one angle at a time, in the layout returned by SearchMovingObjects.oneangle.
+        """
+        ang = None
+        result = []
+        for line in open(self.filename):
+            record = json.loads(line)
+            if ang is not None and record['angle'] != ang:
+                yield result
+                result = []
+            ang = record['angle']
+            result.append(record['pairs'])
+        if len(result) > 0:
+            yield result
+
+    def remove(self):
+        """
+        Remove the stream and its checkpoint, once they have been folded into the tracks file.
+        """
+        for filename in [self.filename, self.checkpoint]:
+            if os.path.exists(filename):
+                os.unlink(filename)
+
+
 def unwrap_self_f(arg, **kwarg):
     return SearchMovingObjects.oneangle(*arg, **kwarg)
 
 
+ENGINES = ['line', 'kdtree']
+
+
+def get_engine(engine):
+    """
+    Return the linking engine class selected by name.
+
+    :param engine: name of the linking engine, one of ENGINES.
+    :return: a class with the SearchMovingObjects interface (Searching, CleanTracks_array, mjdalltracks)
+    """
+    if engine == 'kdtree':
+        from .kdtree_link import KDTreeLinker
+        return KDTreeLinker
+    return SearchMovingObjects
+
+
 def main():
-    workdir = sys.argv[1]
-    nsfile = sys.argv[2]
+    parser = argparse.ArgumentParser(description="Link the sources in a stacked ns catalog into moving object tracks.")
+    parser.add_argument("workdir", help="directory containing the ns catalog, tracks are written here too.")
+    parser.add_argument("nsfile", help="stacked ns catalog to link, e.g. HPX_02937_RA_160.3_DEC_+31.4_cat.fits.ns")
+    parser.add_argument("ratelist", nargs='?', default=None,
+                        help="file listing the expected motion angle of each ns catalog, overrides the angles "
+                             "derived from the field geometry (line engine only).")
+    parser.add_argument("--engine", choices=ENGINES, default='line',
+                        help="linking engine: line search over position angles or velocity-space KD-tree.")
+    parser.add_argument("--tiles", action="store_true",
+                        help="link the catalog in overlapping spatial tiles, each within the --memory budget.")
+    parser.add_argument("--memory", type=float, default=512.,
+                        help="memory budget, in MB, of the detections in one tile (with --tiles).")
+    parser.add_argument("--processes", type=int, default=1, help="number of tiles linked at once (with --tiles).")
+    parser.add_argument("--max-residual", type=float, default=crit_residual,
+                        help="drop tracks whose rms residual from linear motion exceeds this, in arcsec.")
+    parser.add_argument("--rank-only", action="store_true",
+                        help="keep the tracks beyond --max-residual, ranked after the others, instead of dropping them.")
+    parser.add_argument("--max-dmag", type=float, default=None,
+                        help="also drop tracks whose magnitude scatter exceeds this, by default only the max_dm "
+                             "between detections applies.")
+    parser.add_argument("--no-prune", action="store_true",
+                        help="keep every linked track and do not fit them, no .fit.json is written.")
+    parser.add_argument("--qrunid", default=None,
+                        help="upload the tracks and their summary to this QRUNID directory of the VOSpace catalogs, "
+                             "where the viewer reads them.")
+    args = parser.parse_args()
+
+    workdir = args.workdir
+    nsfile = args.nsfile
     global alltrackname
     alltrackname = '%s%s' % (nsfile.rstrip('ns'), alltrackname)
     # nsfile = 'HPX_02937_RA_160.3_DEC_+31.4'
     healpix = '%s_%s_%s' % (nsfile.split('_')[3], nsfile.split('_')[5], nsfile.split('_')[1])
     os.chdir(workdir)
+    from . import track_fit
+
+    def prune(mjdalltracks):
+        if args.no_prune:
+            return mjdalltracks
+        tracks, fits = track_fit.prune(mjdalltracks, max_residual=args.max_residual, max_dmag=args.max_dmag,
+                                       drop=not args.rank_only)
+        track_fit.write_fits(fits, track_fit.fit_name(alltrackname))
+        return tracks
+
     global s
-    s = SearchMovingObjects(workdir, healpix)
+    if args.tiles:
+        from .tiled_link import TiledLinker
+        s = TiledLinker(workdir, healpix, engine=args.engine, memory=args.memory, processes=args.processes)
+    else:
+        s = get_engine(args.engine)(workdir, healpix)
     if os.path.exists(allpairname) and os.path.exists(alltrackname):
         print '[%s] %s has been done. Loading the file' % (time.strftime("%D %H:%M:%S"), alltrackname)
         # s.results = json.load(open(allpairname, 'r'))
         s.mjdalltracks = json.load(open(alltrackname, 'r'))
+    elif args.tiles:
+        s.Searching(multi, nsfile, args.ratelist)
+        s.CleanTracks_array()
+        s.mjdalltracks = prune(s.mjdalltracks)
+        json.dump(s.mjdalltracks, open(alltrackname, 'w'))
+    elif args.engine == 'line':
+        stream = TrackStream('%s%s' % (nsfile.rstrip('ns'), alltrackstream))
+        s.Searching(multi, nsfile, args.ratelist, stream=stream)
+        s.CleanTracks_array()
+        s.mjdalltracks = prune(s.mjdalltracks)
+        # write to a temporary file first so a job killed while writing keeps its stream.
+        json.dump(s.mjdalltracks, open(alltrackname + '.tmp', 'w'))
+        os.rename(alltrackname + '.tmp', alltrackname)
+        stream.remove()
     else:
-        s.Searching(multi, nsfile)
+        s.Searching(multi, nsfile, args.ratelist)
         # json.dump(s.results, open(allpairname, 'w'))
         s.CleanTracks_array()
+        s.mjdalltracks = prune(s.mjdalltracks)
         json.dump(s.mjdalltracks, open(alltrackname, 'w'))
+    # the candidate count and names, so the validator need not parse the tracks to know how many there are.
+    json_index.write_summary(s.mjdalltracks, json_index.summary_name(alltrackname))
+    if args.qrunid is not None:
+        from . import storage
+        storage.put_tracks(int(nsfile.split('_')[1]), args.qrunid, alltrackname)
 
 if __name__ == '__main__':
     main()
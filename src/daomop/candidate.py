@@ -1,5 +1,7 @@
 import sys
+from itertools import chain
 
+import numpy
 from mp_ephem import ObsRecord
 from astropy.time import Time
 import logging
@@ -7,14 +9,32 @@ from . import storage
 
 _LETTERS = 'abcdefghijklmnopqrstuvwxyz'
 _DIGITS = '0123456789'
+_discovery_dates = {}
+# tracks whose dates a Target converts together, so looking at one candidate does not read and convert them all.
+BATCH = 32
+DATE_PRECISION = 6
+
+
+def mpc_dates(mjds):
+    """
+    Convert mjd values to MPC date strings, the format ObsRecord reads its date from, with a single Time call,
+    much faster than one Time per value.
+
+    :param mjds: the mjd values.
+    :rtype: list(str)
+    """
+    if len(mjds) == 0:
+        return []
+    return [str(date) for date in Time(numpy.asarray(mjds, dtype='f8'), format='mjd', precision=DATE_PRECISION).mpc]
 
 
 def provisional(mjd, hpx, count):
     """Compute a provisional name from the date and HPX information.
     """
-    discovery_date = Time(int(mjd), format='mjd').yday.split(':')
-    discovery_day = int(discovery_date[1])
-    discovery_year = int(discovery_date[0])
+    if int(mjd) not in _discovery_dates:
+        discovery_date = Time(int(mjd), format='mjd').yday.split(':')
+        _discovery_dates[int(mjd)] = int(discovery_date[0]), int(discovery_date[1])
+    discovery_year, discovery_day = _discovery_dates[int(mjd)]
 
     yr = discovery_year - 2000
     p1 = discovery_day//36
@@ -32,14 +52,28 @@ def provisional(mjd, hpx, count):
 
 
 class ObservationSet(object):
-    def __init__(self, provisional_name, record):
+    def __init__(self, provisional_name, record, dates=None):
+        """
+        :param provisional_name: name given to the candidate.
+        :param record: the track, as written by the linker.
+        :param dates: the MPC date strings of the detections of the track, converted from record['mjd'] when first
+        needed if None.
+        :type dates: list(str)
+        """
         self.provisional_name = provisional_name
         self.record = record
         self.current_observation = -1
+        self._dates = dates
 
     def __iter__(self):
         return self
 
+    @property
+    def dates(self):
+        if self._dates is None:
+            self._dates = mpc_dates(self.record['mjd'])
+        return self._dates
+
     def next(self):
         """
 
@@ -53,7 +87,7 @@ class ObservationSet(object):
                          discovery=True,
                          note1=None,
                          note2='C',
-                         date=Time(self.record['mjd'][self.current_observation], format='mjd'),
+                         date=self.dates[self.current_observation],
                          ra=self.record['ra'][self.current_observation],
                          dec=self.record['dec'][self.current_observation],
                          mag=self.record['mag'][self.current_observation],
@@ -71,17 +105,55 @@ class ObservationSet(object):
 
 class Target(object):
     def __init__(self, hpx, mjdate, record):
+        """
+        :param record: the tracks found starting on mjdate, a dict or a json_index.Tracks that reads them on access.
+        """
         self.hpx = hpx
         self.mjdate = mjdate
         self.record = record
         self.current_observation = -1
+        self._observation_sets = None
+        self._batches = {}
 
     def __iter__(self):
         return self
 
+    def __len__(self):
+        return len(self.observation_sets)
+
+    def __getitem__(self, index):
+        """
+        Random access to one candidate: only the tracks of its batch are read and converted.
+
+        :rtype: ObservationSet
+        """
+        return self.observation_set(index)
+
     @property
     def observation_sets(self):
-        return self.record.keys()
+        if self._observation_sets is None:
+            self._observation_sets = list(self.record.keys())
+        return self._observation_sets
+
+    def _batch(self, index):
+        """
+        The tracks of the batch holding track index, and the MPC date strings of their detections, read and
+        converted with a single Time call when the batch is first needed.
+
+        :return: list of (track, dates)
+        """
+        batch = index // BATCH
+        if batch not in self._batches:
+            records = [self.record[name] for name in self.observation_sets[batch * BATCH:(batch + 1) * BATCH]]
+            dates = mpc_dates(list(chain.from_iterable(record['mjd'] for record in records)))
+            ends = numpy.cumsum([len(record['mjd']) for record in records])
+            self._batches[batch] = [(record, dates[end - len(record['mjd']):end])
+                                    for record, end in zip(records, ends)]
+        return self._batches[batch][index % BATCH]
+
+    def observation_set(self, index):
+        record, dates = self._batch(index)
+        return ObservationSet(provisional(self.mjdate, self.hpx, index), record, dates)
 
     @property
     def provisional_name(self):
@@ -95,15 +167,13 @@ class Target(object):
         self.current_observation += 1
         if not self.current_observation < len(self.observation_sets):
             raise StopIteration
-        return ObservationSet(self.provisional_name,
-                              self.record[self.observation_sets[self.current_observation]])
+        return self.observation_set(self.current_observation)
 
     def previous(self):
         if self.current_observation == 0:
             return None
         self.current_observation -= 1
-        return ObservationSet(self.provisional_name,
-                              self.record[self.observation_sets[self.current_observation]])
+        return self.observation_set(self.current_observation)
 
 
 class Catalog(object):
@@ -115,9 +185,19 @@ class Catalog(object):
     def __iter__(self):
         return self
 
+    def __len__(self):
+        return len(self.mjdates)
+
+    def __getitem__(self, index):
+        """
+        :rtype: Target
+        """
+        mjdate = self.mjdates[index]
+        return Target(self.catalog.pixel, mjdate, self.catalog.index[mjdate])
+
     @property
     def mjdates(self):
-        return self.catalog.json.keys()
+        return self.catalog.index.mjdates
 
     def next(self):
         """
@@ -127,15 +207,13 @@ class Catalog(object):
         self.current_date += 1
         if not self.current_date < len(self.mjdates):
             raise StopIteration
-        mjdate = self.mjdates[self.current_date]
-        return Target(self.catalog.pixel, mjdate, self.catalog.json[mjdate])
+        return self[self.current_date]
 
     def previous(self):
         if self.current_date == 0:
             return
         self.current_date -= 1
-        mjdate = self.mjdates[self.current_date]
-        return Target(self.catalog.pixel, mjdate, self.catalog.json[mjdate])
+        return self[self.current_date]
 
 
 class CandidateSet(object):
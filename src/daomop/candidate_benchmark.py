@@ -0,0 +1,80 @@
+"""Measure how fast the candidates of a linker _bk.json file are turned into ObsRecords.
+
+The per-detection path builds one Time for each detection, as candidate.ObservationSet used to, while the batched
+path walks the file with candidate.Target, which converts the mjd values of each batch of candidate.BATCH tracks
+to MPC date strings with a single Time call.
+"""
+import argparse
+import json
+import re
+import sys
+import time
+
+from astropy.time import Time
+from mp_ephem import ObsRecord
+
+from . import candidate
+
+
+def per_detection(hpx, mjdalltracks):
+    """
+    Build the ObsRecords of every candidate with one Time per detection.
+
+    :return: the number of records built.
+    """
+    count = 0
+    for mjdate in mjdalltracks:
+        for index, track in enumerate(mjdalltracks[mjdate]):
+            record = mjdalltracks[mjdate][track]
+            provisional_name = candidate.provisional(mjdate, hpx, index)
+            for i in range(len(record['mag'])):
+                ObsRecord(provisional_name=provisional_name, discovery=True, note1=None, note2='C',
+                          date=Time(record['mjd'][i], format='mjd'), ra=record['ra'][i], dec=record['dec'][i],
+                          mag=record['mag'][i], band=record['filterid'][i], observatory_code=568,
+                          mag_err=record['magerr'][i], comment='cand', xpos=None, ypos=None,
+                          frame=record['fitsname'][i], plate_uncertainty=None, astrometric_level=4)
+                count += 1
+    return count
+
+
+def batched(hpx, mjdalltracks):
+    """
+    Build the ObsRecords of every candidate through candidate.Target.
+
+    :return: the number of records built.
+    """
+    count = 0
+    for mjdate in mjdalltracks:
+        for observation_set in candidate.Target(hpx, mjdate, mjdalltracks[mjdate]):
+            for _ in observation_set:
+                count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("catalogs", nargs='+', help="linker _bk.json files, e.g. HPX_00887_RA_203.6_DEC_+58.9_bk.json")
+    parser.add_argument("--repeat", type=int, default=3, help="number of timed runs of each path, the best is kept.")
+    args = parser.parse_args()
+
+    sys.stdout.write("{:40s} {:>10s} {:>14s} {:>14s} {:>8s}\n".format(
+        "catalog", "records", "before(rec/s)", "after(rec/s)", "speedup"))
+    for filename in args.catalogs:
+        match = re.search(r'HPX_(\d+)', filename)
+        hpx = match and int(match.group(1)) or 0
+        with open(filename, 'r') as fobj:
+            mjdalltracks = json.load(fobj)
+        rates = []
+        for path in (per_detection, batched):
+            elapsed = []
+            for _ in range(args.repeat):
+                start = time.time()
+                count = path(hpx, mjdalltracks)
+                elapsed.append(time.time() - start)
+            rates.append(count / max(min(elapsed), 1e-9))
+        sys.stdout.write("{:40s} {:10d} {:14.1f} {:14.1f} {:8.2f}\n".format(
+            filename[-40:], count, rates[0], rates[1], rates[1] / rates[0]))
+
+
+if __name__ == '__main__':
+    main()
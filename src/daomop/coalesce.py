@@ -0,0 +1,167 @@
+"""Host-wide single-flight downloads through a shared local cache.
+
+Several daomop processes on one host often want the same file at the same time: validation sessions, stationary
+workers or build_cat runs on adjacent CCDs.  fetch lets the first of them download the file into a cache directory
+shared by all processes on the host, while the others wait on a lock file and then copy the cached file, so each
+file is transferred once.  A failed download is recorded next to the lock, and the processes that were waiting on it
+get the same error instead of trying again one after the other; processes asking later try again.
+
+Only files that never change, such as exposures and their cutouts, should be fetched through the cache: a cached copy
+is reused for up to max_age without looking at the source again.
+"""
+import errno
+import fcntl
+import hashlib
+import importlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+import uuid
+
+SHARED_CACHE = os.environ.get('DAOMOP_SHARED_CACHE', os.path.join(tempfile.gettempdir(), 'daomop_shared'))
+MAX_AGE = 3600
+MAX_BYTES = 10 * 1024 ** 3
+
+
+def _paths(source, cache_dir):
+    key = os.path.join(cache_dir, hashlib.sha1(source.encode('utf-8')).hexdigest())
+    return key + '.data', key + '.json', key + '.err', key + '.lock'
+
+
+def _record_error(filename, ex):
+    record = {'module': type(ex).__module__, 'name': type(ex).__name__, 'message': str(ex),
+              'errno': getattr(ex, 'errno', None), 'strerror': getattr(ex, 'strerror', None),
+              'attempt': uuid.uuid4().hex}
+    with open(filename + '.tmp', 'w') as fobj:
+        json.dump(record, fobj)
+    os.rename(filename + '.tmp', filename)
+
+
+def _read_error(filename):
+    """
+    The record of the last failed download, None if there is none.
+    """
+    try:
+        with open(filename) as fobj:
+            return json.load(fobj)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _raise_error(record):
+    """
+    Raise again, as well as can be rebuilt, the error another process recorded.
+    """
+    if record['errno'] is not None:
+        raise EnvironmentError(record['errno'], record['strerror'] or record['message'])
+    try:
+        cls = getattr(importlib.import_module(record['module']), record['name'])
+        ex = cls(record['message'])
+    except Exception:
+        ex = IOError(record['message'])
+    raise ex
+
+
+def _try_lock(lock_file):
+    """
+    Take the lock without waiting, False if another process holds it.
+    """
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except (IOError, OSError) as ex:
+        if ex.errno not in (errno.EAGAIN, errno.EACCES):
+            raise
+        return False
+
+
+def fetch(source, destination, backend, cache_dir=None, max_age=MAX_AGE):
+    """
+    Copy source to destination through the shared cache: backend(source, filename) is called by one process only
+    for any number of processes asking for source at the same time.
+
+    :param source: what to download, e.g. a VOSpace uri.
+    :param destination: local file to write, its content is replaced in place.
+    :param backend: function doing the download, called as backend(source, filename); what it returns is returned
+    to every process, so must be serialisable as JSON.
+    :param cache_dir: the shared cache, SHARED_CACHE if None.
+    :param max_age: a cached copy older than this, in seconds, is downloaded again.
+    :return: what backend returned.
+    """
+    cache_dir = cache_dir or SHARED_CACHE
+    try:
+        os.makedirs(cache_dir)
+    except OSError as ex:
+        if ex.errno != errno.EEXIST:
+            raise
+    data, meta, error, lock = _paths(source, cache_dir)
+
+    previous_error = _read_error(error)
+    with open(lock, 'a') as lock_file:
+        waited = not _try_lock(lock_file)
+        if waited:
+            # another process is downloading source, wait for it.
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            last_error = waited and _read_error(error)
+            if last_error and (previous_error is None or last_error.get('attempt') != previous_error.get('attempt')):
+                # the download we waited on failed.
+                _raise_error(last_error)
+            if os.path.exists(data) and os.path.exists(meta) and os.path.getmtime(data) > time.time() - max_age:
+                logging.debug("Shared cache hit for {}".format(source))
+            else:
+                partial = data + '.{}.tmp'.format(os.getpid())
+                try:
+                    result = backend(source, partial)
+                except Exception as ex:
+                    _record_error(error, ex)
+                    if os.path.exists(partial):
+                        os.remove(partial)
+                    raise
+                os.rename(partial, data)
+                with open(meta, 'w') as fobj:
+                    json.dump({'source': source, 'result': result}, fobj)
+                if os.path.exists(error):
+                    os.remove(error)
+                prune(cache_dir)
+            shutil.copyfile(data, destination)
+            with open(meta) as fobj:
+                return json.load(fobj)['result']
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def prune(cache_dir, max_bytes=MAX_BYTES):
+    """
+    Remove the least recently written files of the cache beyond max_bytes.  Files whose lock is held, being
+    downloaded or copied by some process, are kept.  A file being copied by another process stays readable until
+    that process closes it.
+    """
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith('.data'):
+            filename = os.path.join(cache_dir, name)
+            try:
+                entries.append((os.path.getmtime(filename), os.path.getsize(filename), filename))
+            except OSError:
+                continue
+    total = sum(entry[1] for entry in entries)
+    for _, size, filename in sorted(entries):
+        if total <= max_bytes:
+            break
+        key = filename[:-len('.data')]
+        with open(key + '.lock', 'a') as lock_file:
+            if not _try_lock(lock_file):
+                continue
+            try:
+                for name in [filename, key + '.json']:
+                    try:
+                        os.remove(name)
+                    except OSError:
+                        pass
+                total -= size
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
@@ -0,0 +1,178 @@
+"""Find comparison exposures for all the candidates of a HEALPix pixel with a single TAP query.
+
+The query returns every CFIS exposure whose footprint meets the circle enclosing all the candidates, together with
+its footprint and epoch.  Each candidate is then matched to the exposures that cover it, and were not taken within
+minimum_time of it, with a vectorised point-in-footprint test done in the tangent plane at the candidate, where the
+great-circle edges of the footprints are straight lines.
+"""
+import numpy
+
+MINIMUM_TIME = 20 / 60.0 / 24.0
+_CHUNK = 64
+
+
+def unit_vectors(ra, dec):
+    ra = numpy.radians(numpy.asarray(ra, dtype='f8'))
+    dec = numpy.radians(numpy.asarray(dec, dtype='f8'))
+    return numpy.column_stack((numpy.cos(dec) * numpy.cos(ra), numpy.cos(dec) * numpy.sin(ra), numpy.sin(dec)))
+
+
+def union_circle(ra, dec, radius=0.0):
+    """
+    A circle enclosing circles of the given radius around each position.
+
+    :param ra: right ascension of the positions, degrees.
+    :param dec: declination of the positions, degrees.
+    :param radius: radius around each position, degrees.
+    :return: ra, dec and radius of the circle, degrees.
+    """
+    vectors = unit_vectors(ra, dec)
+    centre = vectors.sum(axis=0)
+    centre /= numpy.sqrt((centre ** 2).sum())
+    separation = numpy.degrees(numpy.arccos(numpy.clip(vectors.dot(centre), -1, 1))).max()
+    return (numpy.degrees(numpy.arctan2(centre[1], centre[0])) % 360.0,
+            numpy.degrees(numpy.arcsin(centre[2])),
+            separation + radius)
+
+
+def query(ra, dec, radius=0.0):
+    """
+    The ADQL query for the CFIS exposures that may hold a comparison image for any of the positions.
+
+    :param ra: right ascension of the candidates, degrees.
+    :param dec: declination of the candidates, degrees.
+    :param radius: radius of the cutouts, degrees.
+    :rtype: str
+    """
+    circle = "CIRCLE('ICRS', {}, {}, {})".format(*union_circle(ra, dec, radius))
+    adql = """SELECT Observation.observationID AS "observationID", Plane.time_bounds_lower AS "mjdate", """
+    adql += """Plane.time_bounds_upper AS "mjdate_end", Plane.position_bounds AS "position_bounds" """
+    adql += """FROM caom2.Plane AS Plane JOIN caom2.Observation AS Observation ON Plane.obsID = Observation.obsID """
+    adql += """WHERE  Plane.calibrationLevel = '1' AND Plane.energy_bandpassName IN ( 'r.MP9602','r.MP9601' ) """
+    adql += """AND Observation.instrument_name = 'MegaPrime' """
+    adql += """AND Observation.collection = 'CFHT' """
+    adql += """AND lower(Observation.proposal_title) LIKE '%cfis%' """
+    adql += """AND  ( Plane.quality_flag IS NULL OR Plane.quality_flag != 'junk' ) """
+    adql += """AND INTERSECTS({}, Plane.position_bounds)=1 """.format(circle)
+    return adql
+
+
+def parse_bounds(value):
+    """
+    The polygons of a footprint, given in STC-S ('Polygon ICRS ra1 dec1 ...', or a 'Union ICRS (Polygon ...
+    Polygon ...)' of the CCDs of a mosaic) or as a DALI polygon ('ra1 dec1 ...').
+
+    :return: list of arrays of shape (n, 2), one per polygon, degrees.
+    """
+    polygons = []
+    values = None
+    for token in str(value).replace('(', ' ').replace(')', ' ').split():
+        if token.lower() == 'polygon':
+            values = []
+            polygons.append(values)
+            continue
+        try:
+            number = float(token)
+        except ValueError:
+            continue
+        if values is None:
+            values = []
+            polygons.append(values)
+        values.append(number)
+    return [numpy.array(values, dtype='f8').reshape(-1, 2) for values in polygons if len(values) >= 6]
+
+
+def padded(footprints):
+    """
+    Stack footprints of different lengths, each closed by repeating its first vertex, padding with NaN.
+
+    :return: ra and dec arrays of shape (number of footprints, most vertices + 1), degrees.
+    """
+    width = max(len(footprint) for footprint in footprints) + 1
+    ra = numpy.full((len(footprints), width), numpy.nan)
+    dec = numpy.full((len(footprints), width), numpy.nan)
+    for i, footprint in enumerate(footprints):
+        ra[i, :len(footprint) + 1] = numpy.append(footprint[:, 0], footprint[0, 0])
+        dec[i, :len(footprint) + 1] = numpy.append(footprint[:, 1], footprint[0, 1])
+    return ra, dec
+
+
+def contains(ra, dec, footprint_ra, footprint_dec, radius=0.0):
+    """
+    Which footprints cover a circle of radius around each position.
+
+    :param ra: right ascension of the positions, degrees, shape (m,)
+    :param dec: declination of the positions, degrees, shape (m,)
+    :param footprint_ra: closed footprints from padded, degrees, shape (n, v)
+    :param footprint_dec: closed footprints from padded, degrees, shape (n, v)
+    :param radius: radius of the circle, degrees.
+    :return: boolean array of shape (m, n)
+    """
+    ra0 = numpy.radians(numpy.asarray(ra, dtype='f8'))[:, None, None]
+    dec0 = numpy.radians(numpy.asarray(dec, dtype='f8'))[:, None, None]
+    ra1 = numpy.radians(footprint_ra)[None, :, :]
+    dec1 = numpy.radians(footprint_dec)[None, :, :]
+
+    # gnomonic projection of the vertices about each position
+    cos_c = numpy.sin(dec0) * numpy.sin(dec1) + numpy.cos(dec0) * numpy.cos(dec1) * numpy.cos(ra1 - ra0)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        x = numpy.cos(dec1) * numpy.sin(ra1 - ra0) / cos_c
+        y = (numpy.cos(dec0) * numpy.sin(dec1) - numpy.sin(dec0) * numpy.cos(dec1) * numpy.cos(ra1 - ra0)) / cos_c
+        x1, y1, x2, y2 = x[..., :-1], y[..., :-1], x[..., 1:], y[..., 1:]
+
+        # a ray from the position along +x crosses an odd number of edges when the position is inside
+        crosses = ((y1 > 0) != (y2 > 0)) & (x1 + (x2 - x1) * (0 - y1) / (y2 - y1) > 0)
+        inside = crosses.sum(axis=-1) % 2 == 1
+
+        # distance from the position to the nearest edge
+        dx, dy = x2 - x1, y2 - y1
+        t = numpy.clip(-(x1 * dx + y1 * dy) / (dx ** 2 + dy ** 2), 0, 1)
+        distance = numpy.sqrt((x1 + t * dx) ** 2 + (y1 + t * dy) ** 2)
+        distance = numpy.where(numpy.isnan(distance), numpy.inf, distance).min(axis=-1)
+
+    # a footprint vertex on or behind the horizon of the projection is far from the position.
+    visible = numpy.all((cos_c > 0) | numpy.isnan(cos_c), axis=-1)
+    return inside & visible & (distance >= numpy.tan(numpy.radians(radius)))
+
+
+def resolve(table, ra, dec, mjdates, minimum_time=MINIMUM_TIME, radius=0.0):
+    """
+    Match each candidate to its comparison exposure: the first row of the table whose footprint covers the cutout
+    and that was not taken within minimum_time of the candidate.
+
+    :param table: result of the query, with observationID, mjdate, mjdate_end and position_bounds columns.
+    :param ra: right ascension of the candidates, degrees.
+    :param dec: declination of the candidates, degrees.
+    :param mjdates: epoch of the candidates.
+    :param minimum_time: exposures within this many days of a candidate are not compared to it.
+    :param radius: radius of the cutouts, degrees.
+    :return: for each candidate the matching row of the table, or None.
+    """
+    ra = numpy.atleast_1d(numpy.asarray(ra, dtype='f8'))
+    dec = numpy.atleast_1d(numpy.asarray(dec, dtype='f8'))
+    mjdates = numpy.atleast_1d(numpy.asarray(mjdates, dtype='f8'))
+    if len(table) == 0:
+        return [None] * len(ra)
+    footprints = [parse_bounds(value) for value in table['position_bounds']]
+    polygons = [polygon for footprint in footprints for polygon in footprint]
+    if len(polygons) == 0:
+        return [None] * len(ra)
+    footprint_ra, footprint_dec = padded(polygons)
+    # which row each polygon belongs to: a row covers a cutout if any one of its polygons does.
+    owner = numpy.repeat(numpy.arange(len(table)), [len(footprint) for footprint in footprints])
+    membership = numpy.zeros((len(polygons), len(table)), dtype='i4')
+    membership[numpy.arange(len(polygons)), owner] = 1
+    start = numpy.asarray(table['mjdate'], dtype='f8')
+    end = numpy.asarray(table['mjdate_end'], dtype='f8')
+
+    matches = []
+    for first in range(0, len(ra), _CHUNK):
+        chunk = slice(first, first + _CHUNK)
+        covered = contains(ra[chunk], dec[chunk], footprint_ra, footprint_dec, radius)
+        covered = covered.astype('i4').dot(membership) > 0
+        apart = ((start[None, :] < mjdates[chunk, None] - minimum_time) |
+                 (end[None, :] > mjdates[chunk, None] + minimum_time))
+        for row in covered & apart:
+            index = numpy.flatnonzero(row)
+            matches.append(table[index[0]] if len(index) else None)
+    return matches
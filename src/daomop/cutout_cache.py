@@ -0,0 +1,281 @@
+"""A bounded two-tier cache of image cutouts, for the downloader of the validation viewer.
+
+Cutouts are kept in memory up to a budget in bytes of pixel data.  The least recently used ones are then spilled to
+FITS files in a local directory, itself bounded, and read back from there on the next request instead of going back
+to VOSpace.  Concurrent requests for the same cutout share a single fetch.  Evicted cutouts are written to disk after
+the cache is unlocked, so lookups never wait on the disk, and are found in memory until they have been written.
+"""
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+from astropy.io import fits
+
+MEMORY = 512 * 1024 ** 2
+DISK = 4 * 1024 ** 3
+
+
+def nbytes(hdulist):
+    """
+    The size of the pixel data of an HDUList, in bytes.
+    """
+    size = 0
+    for hdu in hdulist:
+        if hdu.data is not None:
+            size += hdu.data.nbytes
+    return size
+
+
+class _Flight(object):
+    """
+    A fetch in progress, waited on by the other threads asking for the same key.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class CutoutCache(object):
+
+    def __init__(self, memory=MEMORY, disk=DISK, directory=None, size=nbytes):
+        """
+        :param memory: budget of the in-memory tier, in bytes of pixel data.
+        :param disk: budget of the on-disk tier, in bytes of FITS file; 0 for no disk tier.
+        :param directory: where the on-disk tier is kept, a temporary directory if None.
+        :param size: function giving the size in bytes of a cached value, nbytes for HDULists. Values that are not
+        HDULists can only be cached with no disk tier.
+        """
+        self.memory = memory
+        self.size = size
+        self.disk = disk
+        self._directory = directory
+        self._temporary = False
+        self.lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._sizes = {}
+        self._disk = OrderedDict()
+        self._spilling = {}
+        self._flights = {}
+        self.memory_used = 0
+        self.disk_used = 0
+        self.stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0, 'spills': 0}
+
+    def __str__(self):
+        return ("{hits} hits, {disk_hits} disk hits, {misses} misses, {evictions} evicted, {spills} spilled; "
+                "{memory} in memory ({memory_mb:.1f} MB), {disk} on disk ({disk_mb:.1f} MB)").format(
+            memory=len(self._memory), memory_mb=self.memory_used / 1024. ** 2,
+            disk=len(self._disk), disk_mb=self.disk_used / 1024. ** 2, **self.stats)
+
+    def __contains__(self, key):
+        return key in self._memory or key in self._spilling or key in self._disk
+
+    def __len__(self):
+        return len(self._memory) + len(self._spilling) + len(self._disk)
+
+    @property
+    def directory(self):
+        if self._directory is None:
+            self._directory = tempfile.mkdtemp(prefix='daomop_cutouts_')
+            self._temporary = True
+        elif not os.path.isdir(self._directory):
+            os.makedirs(self._directory)
+        return self._directory
+
+    def filename(self, key):
+        return os.path.join(self.directory, "{}.fits".format(key))
+
+    def get(self, key, fetch):
+        """
+        The cutout stored under key, from memory, from disk, or else from fetch.
+
+        :param key: the key of the cutout, see Downloader.image_key
+        :param fetch: function returning the cutout as an HDUList, called at most once for concurrent requests.
+        :return: the HDUList, None if fetch returned None (which is not cached).
+        """
+        with self.lock:
+            if key in self._memory:
+                self.stats['hits'] += 1
+                self._memory[key] = self._memory.pop(key)
+                return self._memory[key]
+            if key in self._spilling:
+                # evicted but not yet on disk: take it back, its spill is then dropped.
+                self.stats['hits'] += 1
+                hdulist = self._spilling.pop(key)
+                evicted, stale = self._store(key, hdulist)
+            else:
+                hdulist = None
+                flight = self._flights.get(key)
+                leader = flight is None
+                if leader:
+                    flight = self._flights[key] = _Flight()
+                    on_disk = key in self._disk
+                    self.stats[on_disk and 'disk_hits' or 'misses'] += 1
+
+        if hdulist is not None:
+            self._spill(evicted, stale)
+            return hdulist
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        evicted, stale = [], []
+        try:
+            flight.result = on_disk and self._read(key) or fetch()
+        except Exception as ex:
+            flight.error = ex
+            raise
+        finally:
+            with self.lock:
+                if flight.result is not None:
+                    evicted, stale = self._store(key, flight.result)
+                del self._flights[key]
+            flight.done.set()
+            self._spill(evicted, stale)
+        return flight.result
+
+    def peek(self, key):
+        """
+        The value stored under key if it is in memory, else None, without counting a hit or a miss nor refreshing
+        its place in the LRU order.
+        """
+        with self.lock:
+            value = self._memory.get(key)
+            return value if value is not None else self._spilling.get(key)
+
+    def _read(self, key):
+        """
+        Read a spilled cutout back into memory, None if its file has gone.
+        """
+        try:
+            with fits.open(self.filename(key), memmap=False) as hdulist:
+                hdulist.readall()
+                return fits.HDUList([hdu.copy() for hdu in hdulist])
+        except (IOError, OSError) as ex:
+            logging.debug("Lost spilled cutout {}: {}".format(key, ex))
+            return None
+
+    def _store(self, key, hdulist):
+        """
+        Put a cutout in the memory tier and evict the least recently used ones beyond the budget, keeping at least
+        the one just stored.  Called with the lock held: the evicted cutouts are only marked as spilling, and are
+        written by _spill once the lock is released.
+
+        :return: the evicted (key, hdulist), and the keys whose files are to be removed.
+        """
+        stale = []
+        if key in self._disk:
+            self.disk_used -= self._disk.pop(key)
+            stale.append(key)
+        self._memory[key] = hdulist
+        self._sizes[key] = self.size(hdulist)
+        self.memory_used += self._sizes[key]
+        return self._evict(), stale
+
+    def _evict(self):
+        """
+        Evict the least recently used cutouts beyond the memory budget, keeping at least the most recent one.  Called
+        with the lock held.
+
+        :return: the evicted (key, hdulist), to be written by _spill.
+        """
+        evicted = []
+        while self.memory_used > self.memory and len(self._memory) > 1:
+            old_key, old_hdulist = self._memory.popitem(last=False)
+            self.memory_used -= self._sizes.pop(old_key)
+            self.stats['evictions'] += 1
+            if self.disk > 0:
+                self._spilling[old_key] = old_hdulist
+                evicted.append((old_key, old_hdulist))
+        return evicted
+
+    def resize(self, key):
+        """
+        Count again the size of a cached value that has grown, evicting others if it no longer fits the budget.
+        """
+        with self.lock:
+            if key not in self._memory:
+                return
+            size = self.size(self._memory[key])
+            self.memory_used += size - self._sizes[key]
+            self._sizes[key] = size
+            evicted = self._evict()
+        self._spill(evicted)
+
+    def _spill(self, evicted, stale=()):
+        """
+        Write evicted cutouts to the disk tier, dropping the least recently spilled ones beyond its budget.  Called
+        without the lock: each cutout is written to a temporary file, which only becomes its spill file if it has
+        not been taken back meanwhile.
+        """
+        for key in stale:
+            self._remove(key)
+        for key, hdulist in evicted:
+            partial = "{}.{}.tmp".format(self.filename(key), threading.current_thread().ident)
+            try:
+                self._write(hdulist, partial)
+                size = os.path.getsize(partial)
+            except Exception as ex:
+                logging.warning("Failed to spill cutout {}: {}".format(key, ex))
+                with self.lock:
+                    if self._spilling.get(key) is hdulist:
+                        del self._spilling[key]
+                self._unlink(partial)
+                continue
+            removed = []
+            with self.lock:
+                if self._spilling.get(key) is hdulist:
+                    del self._spilling[key]
+                    os.rename(partial, self.filename(key))
+                    self._disk[key] = size
+                    self.disk_used += size
+                    self.stats['spills'] += 1
+                    while self.disk_used > self.disk and self._disk:
+                        old_key, old_size = self._disk.popitem(last=False)
+                        self.disk_used -= old_size
+                        removed.append(old_key)
+                else:
+                    removed = None
+            if removed is None:
+                self._unlink(partial)
+            else:
+                for old_key in removed:
+                    self._remove(old_key)
+
+    @staticmethod
+    def _write(hdulist, filename):
+        hdulist.writeto(filename, overwrite=True)
+
+    def _remove(self, key):
+        self._unlink(self.filename(key))
+
+    @staticmethod
+    def _unlink(filename):
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+    def clear(self):
+        """
+        Empty both tiers, removing the temporary directory if the cache made one.
+        """
+        with self.lock:
+            for key in list(self._disk):
+                self._remove(key)
+            self._memory.clear()
+            self._sizes.clear()
+            self._spilling.clear()
+            self._disk.clear()
+            self.memory_used = self.disk_used = 0
+            if self._temporary:
+                shutil.rmtree(self._directory, ignore_errors=True)
+                self._directory = None
+                self._temporary = False
@@ -1,14 +1,17 @@
 import logging
 import storage
-from multiprocessing import Lock
 from astropy.io import fits
+from .cutout_cache import CutoutCache, MEMORY, DISK
 
 
 class Downloader(object):
-    def __init__(self):
-        self._downloaded_images = dict()
-        self.lock = Lock()
-        self.locks = {}
+    def __init__(self, memory=MEMORY, disk=DISK, directory=None):
+        """
+        :param memory: bytes of cutout pixel data kept in memory.
+        :param disk: bytes of cutouts kept in the local disk cache once evicted from memory.
+        :param directory: directory of the local disk cache, a temporary one if None.
+        """
+        self.cache = CutoutCache(memory=memory, disk=disk, directory=directory)
 
     @staticmethod
     def image_key(obs_record):
@@ -23,22 +26,14 @@ class Downloader(object):
 
     def get(self, obs_record):
         """
-        Returns the HDUList of a given observation record.
-        Uses locks on threads for multiprocessing to retrieve multiple HDU's in parallel.
+        Returns the HDUList of a given observation record, from the cutout cache when it has been retrieved before.
+        Threads asking for the same record at the same time share a single retrieval.
 
         :param obs_record: the ObsRecord for which the image is to be retrieved
         :type obs_record: mp_ephem.ObsRecord
         :return: astropy.io.fits.hdu.image.HDUList
         """
-        with self.lock:
-            if self.image_key(obs_record) not in self.locks:
-                self.locks[self.image_key(obs_record)] = Lock()
-
-        with self.locks[self.image_key(obs_record)]:
-            if self.image_key(obs_record) not in self._downloaded_images:
-                self._downloaded_images[self.image_key(obs_record)] = self.get_hdu(obs_record)
-
-        return self._downloaded_images[self.image_key(obs_record)]
+        return self.cache.get(self.image_key(obs_record), lambda: self.get_hdu(obs_record))
 
     @staticmethod
     def put(artifact):
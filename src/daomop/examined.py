@@ -0,0 +1,115 @@
+"""Record of which candidates of a QRUN have been examined in the validator, kept in one small JSON file.
+
+For each HEALPix pixel the index holds the number of candidates the linker found and the provisional names of those
+already accepted or rejected, so the validator can tell a pixel is finished, or find the next unfinished one, without
+parsing its candidate file or listing its VOSpace directory.  Several reviewers share the index of a QRUN: each
+merges the uploaded copy into its own before uploading, and a candidate the index does not know as examined is still
+looked up among the .ast files of its pixel.
+"""
+import json
+import os
+
+FILENAME = 'examined.json'
+
+
+class ExaminedIndex(object):
+
+    def __init__(self, filename):
+        """
+        :param filename: the local JSON file holding the index, read if it exists.
+        """
+        self.filename = filename
+        self.pixels = {}
+        if os.path.exists(filename):
+            with open(filename, 'r') as fobj:
+                self.pixels = dict((int(pixel), value) for pixel, value in json.load(fobj).items())
+
+    def __contains__(self, pixel):
+        return pixel in self.pixels
+
+    def _entry(self, pixel):
+        return self.pixels.setdefault(pixel, {'count': None, 'examined': []})
+
+    def count(self, pixel):
+        """
+        The number of candidates in the pixel, None if not known.
+        """
+        return self.pixels.get(pixel, {}).get('count')
+
+    def set_count(self, pixel, count):
+        self._entry(pixel)['count'] = count
+
+    def examined(self, pixel):
+        """
+        The provisional names of the candidates of the pixel that have been examined.
+        """
+        return self.pixels.get(pixel, {}).get('examined', [])
+
+    def set_examined(self, pixel, names):
+        """
+        Replace the examined names of a pixel, e.g. with the .ast files found in its VOSpace directory.
+        """
+        self._entry(pixel)['examined'] = sorted(set(names))
+
+    def update(self, pixel, names):
+        """
+        Add to the examined names of a pixel, e.g. the .ast files found in its VOSpace directory.
+        """
+        entry = self._entry(pixel)
+        entry['examined'] = sorted(set(entry['examined']) | set(names))
+
+    def merge(self, other):
+        """
+        Take in the examined names of another copy of the index, e.g. the one another reviewer has uploaded since
+        this one was read, so that neither loses the other's marks.  The counts of this index win when known.
+
+        :param other: the other copy.
+        :type other: ExaminedIndex
+        """
+        for pixel, value in other.pixels.items():
+            if self.count(pixel) is None and value.get('count') is not None:
+                self.set_count(pixel, value['count'])
+            self.update(pixel, value.get('examined', []))
+
+    def mark(self, pixel, name):
+        """
+        Record that a candidate has been examined.
+
+        :param pixel: the HEALPix pixel of the candidate.
+        :param name: the provisional name of the candidate.
+        """
+        entry = self._entry(pixel)
+        if name not in entry['examined']:
+            entry['examined'].append(name)
+
+    def is_examined(self, pixel, name=None):
+        """
+        Has a candidate, or if name is None every candidate of the pixel, been examined.
+        """
+        if name is not None:
+            return name in self.examined(pixel)
+        count = self.count(pixel)
+        return count is not None and len(self.examined(pixel)) >= count
+
+    def next_unexamined(self, pixels, start=None):
+        """
+        The first pixel, in order, from start on that is not known to be fully examined.
+
+        :param pixels: the pixels to consider.
+        :param start: skip the pixels below this one.
+        :return: the pixel, or None if all are fully examined.
+        """
+        for pixel in sorted(pixels):
+            if start is not None and pixel < start:
+                continue
+            if not self.is_examined(pixel):
+                return pixel
+        return None
+
+    def save(self):
+        """
+        Write the index, through a temporary file so a reader never sees a partial index.
+        """
+        with open(self.filename + '.tmp', 'w') as fobj:
+            json.dump(dict((str(pixel), value) for pixel, value in self.pixels.items()), fobj, sort_keys=True)
+        os.rename(self.filename + '.tmp', self.filename)
@@ -0,0 +1,295 @@
+"""Link detections across nights by clustering under heliocentric distance hypotheses, in the style of HelioLinC.
+
+Pairs of detections taken on the same night (tracklets) are found with the KD-tree linker's rate bounded annulus.
+For each hypothesis of heliocentric distance r and radial velocity rdot, every tracklet is turned into a heliocentric
+state vector, propagated on a two-body orbit to a common reference epoch and the propagated positions are clustered.
+Tracklets of the same object collapse onto one point when the hypothesis is close to the truth, so clusters spanning
+several nights become tracks, even though their sky motion is curved by parallax.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from multiprocessing import Pool
+
+import numpy as np
+from astropy import units
+from astropy.coordinates import get_body_barycentric
+from astropy.io import fits
+from astropy.table import Table, vstack
+from astropy.time import Time
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+
+from . import CFIS_Link_stacked as link
+from .kdtree_link import KDTreeLinker, deduplicate
+
+GM = 2.959122082855911e-4  # heliocentric gravitational constant, au^3 / day^2
+CLUSTER_RADIUS = 1.0e-4  # clustering radius at the reference epoch, in au per au of hypothesised distance
+MIN_NIGHTS = 3  # only keep clusters holding tracklets from at least this many nights
+alltrackname = 'helio_{}'.format(link.alltrackname)
+
+
+def stumpff(z):
+    """
+    The Stumpff functions C(z) and S(z), vectorised.
+    """
+    c = np.ones_like(z) / 2.
+    s = np.ones_like(z) / 6.
+    pos = z > 1e-8
+    neg = z < -1e-8
+    sz = np.sqrt(z[pos])
+    c[pos] = (1 - np.cos(sz)) / z[pos]
+    s[pos] = (sz - np.sin(sz)) / sz ** 3
+    sz = np.sqrt(-z[neg])
+    c[neg] = (np.cosh(sz) - 1) / -z[neg]
+    s[neg] = (np.sinh(sz) - sz) / sz ** 3
+    return c, s
+
+
+def propagate(r0, v0, dt, iterations=50):
+    """
+    Propagate heliocentric state vectors on two-body orbits using universal variables.
+
+    :param r0: positions, shape (n, 3), au
+    :param v0: velocities, shape (n, 3), au / day
+    :param dt: time to propagate each state by, shape (n,), days
+    :param iterations: maximum number of Newton iterations on the universal anomaly.
+    :return: positions and velocities after dt.
+    """
+    sqrt_mu = np.sqrt(GM)
+    r0n = np.sqrt((r0 ** 2).sum(axis=1))
+    vr0 = (r0 * v0).sum(axis=1) / r0n
+    alpha = 2. / r0n - (v0 ** 2).sum(axis=1) / GM
+    chi = sqrt_mu * np.abs(alpha) * dt
+    for _ in range(iterations):
+        z = alpha * chi ** 2
+        c, s = stumpff(z)
+        f = (r0n * vr0 / sqrt_mu * chi ** 2 * c + (1 - alpha * r0n) * chi ** 3 * s + r0n * chi - sqrt_mu * dt)
+        df = (r0n * vr0 / sqrt_mu * chi * (1 - z * s) + (1 - alpha * r0n) * chi ** 2 * c + r0n)
+        step = f / df
+        chi -= step
+        if np.all(np.abs(step) < 1e-12):
+            break
+    z = alpha * chi ** 2
+    c, s = stumpff(z)
+    f = 1 - chi ** 2 / r0n * c
+    g = dt - chi ** 3 * s / sqrt_mu
+    r = f[:, np.newaxis] * r0 + g[:, np.newaxis] * v0
+    rn = np.sqrt((r ** 2).sum(axis=1))
+    fdot = sqrt_mu / (rn * r0n) * (z * chi * s - chi)
+    gdot = 1 - chi ** 2 / rn * c
+    v = fdot[:, np.newaxis] * r0 + gdot[:, np.newaxis] * v0
+    return r, v
+
+
+def observer_positions(mjd):
+    """
+    Heliocentric, equatorial, position of the (geocentric) observer.
+
+    :param mjd: UTC times of the observations.
+    :return: positions, shape (n, 3), au
+    """
+    t = Time(mjd, format='mjd', scale='utc')
+    return (get_body_barycentric('earth', t) - get_body_barycentric('sun', t)).xyz.to(units.au).value.T
+
+
+def line_of_sight(ra, dec):
+    """
+    Equatorial unit vectors towards ra/dec, in degrees.
+    """
+    ra = np.radians(ra)
+    dec = np.radians(dec)
+    return np.column_stack((np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)))
+
+
+def heliocentric(observer, direction, r):
+    """
+    Place each detection on the sphere of heliocentric radius r along its line of sight.
+
+    :return: heliocentric positions, shape (n, 3), and a flag for lines of sight that do reach distance r.
+    """
+    b = (observer * direction).sum(axis=1)
+    disc = b ** 2 - (observer ** 2).sum(axis=1) + r ** 2
+    ok = disc > 0
+    rho = -b + np.sqrt(np.where(ok, disc, 0))
+    return observer + rho[:, np.newaxis] * direction, ok & (rho > 0)
+
+
+def link_hypothesis(hypothesis):
+    """
+    Cluster the tracklets under one (r, rdot) hypothesis.
+
+    Runs inside a worker; the tracklets are the module level _tracklets set by init_worker.
+
+    :param hypothesis: heliocentric distance (au) and radial velocity (au / day) at the epoch of each tracklet.
+    :return: list of tracks, each a tuple of detection indices ordered in time.
+    """
+    r, rdot = hypothesis
+    a, b, t, observer, direction, night, t_ref, cluster_radius, min_nights = _tracklets
+    tmid = (t[a] + t[b]) / 2.
+    pa, oka = heliocentric(observer[a], direction[a], r + rdot * (t[a] - tmid))
+    pb, okb = heliocentric(observer[b], direction[b], r + rdot * (t[b] - tmid))
+    ok = np.flatnonzero(oka & okb)
+    if len(ok) < min_nights:
+        return []
+    velocity = (pb[ok] - pa[ok]) / (t[b[ok]] - t[a[ok]])[:, np.newaxis]
+    position, _ = propagate((pa[ok] + pb[ok]) / 2., velocity, t_ref - tmid[ok])
+
+    pairs = cKDTree(position).query_pairs(cluster_radius * r, output_type='ndarray')
+    if len(pairs) == 0:
+        return []
+    graph = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])), shape=(len(ok), len(ok)))
+    n_clusters, label = connected_components(graph, directed=False)
+    tracks = []
+    for cluster in np.flatnonzero(np.bincount(label) >= min_nights):
+        members = ok[label == cluster]
+        if len(set(night[a[members]])) < min_nights:
+            continue
+        detections = np.unique(np.concatenate((a[members], b[members])))
+        # one detection per exposure, otherwise the cluster mixes objects.
+        if len(set(t[detections])) != len(detections):
+            continue
+        tracks.append(tuple(detections[np.argsort(t[detections])]))
+    return tracks
+
+
+def init_worker(tracklets):
+    global _tracklets
+    _tracklets = tracklets
+
+
+class HelioLinker(KDTreeLinker):
+    """
+    Link the detections of several ns catalogs (nights or QRUNs) under a grid of heliocentric hypotheses.
+
+    The interface matches SearchMovingObjects, but Searching takes a list of ns catalogs and the tracks left in
+    mjdalltracks use the same layout as the other engines.
+    """
+
+    def __init__(self, workdir, healpix, hypotheses, cluster_radius=CLUSTER_RADIUS, min_nights=MIN_NIGHTS):
+        """
+        :param hypotheses: list of (r, rdot) pairs, au and au / day.
+        :param cluster_radius: clustering radius, in au per au of hypothesised distance.
+        :param min_nights: minimum number of nights a track must span.
+        """
+        KDTreeLinker.__init__(self, workdir, healpix)
+        self.hypotheses = hypotheses
+        self.cluster_radius = cluster_radius
+        self.min_nights = min_nights
+
+    def readns(self, nsfiles):
+        """
+        Read the usable rows of each ns catalog into a single table.
+
+        :return: the middle night of the observations.
+        """
+        tables = []
+        for nsfile in nsfiles:
+            ft = fits.open(nsfile)[1].data
+            tables.append(Table(ft[link.usable(ft)]))
+        self.sns = vstack(tables, metadata_conflicts='silent')
+        mjdlist = sorted(set([int(i) for i in self.sns['mid_mjdate']]))
+        print '[%s] Read %s detections on %s nights' % (time.strftime("%D %H:%M:%S"), len(self.sns), len(mjdlist))
+        return mjdlist[int(len(mjdlist) / 2.)]
+
+    def tracklets(self, times, epochs):
+        """
+        Pair the detections taken on the same night inside the rate bounded annulus.
+
+        :return: index of the first and second detection of each tracklet.
+        """
+        trees = [cKDTree(self.xy[idx]) for idx in epochs]
+        first = []
+        second = []
+        for i in range(len(times)):
+            for j in range(i + 1, len(times)):
+                dt = times[j] - times[i]
+                if int(times[j]) != int(times[i]):
+                    break
+                if dt < link.min_dt or len(epochs[i]) == 0 or len(epochs[j]) == 0:
+                    continue
+                a, b = self.seeds(epochs[i], epochs[j], dt, trees[j])
+                first.append(a)
+                second.append(b)
+        if len(first) == 0:
+            return np.array([], dtype=int), np.array([], dtype=int)
+        return np.concatenate(first), np.concatenate(second)
+
+    def Searching(self, multi, nsfiles, ratelist=None):
+        """
+        Link the detections of the ns catalogs under every hypothesis, in a pool of N_threading workers if multi.
+        """
+        t1 = time.time()
+        self.midmjd = self.readns(nsfiles)
+        times, epochs = self.epochs()
+        a, b = self.tracklets(times, epochs)
+        print '[%s] Found %s tracklets in %s epochs' % (time.strftime("%D %H:%M:%S"), len(a), len(times))
+
+        ra = np.array(self.sns['X_WORLD'], dtype='f8')
+        dec = np.array(self.sns['Y_WORLD'], dtype='f8')
+        epoch = np.searchsorted(times, np.round(self.mjd, 6))
+        observer = observer_positions(times)[epoch]
+        tracklets = (a, b, self.mjd, observer, line_of_sight(ra, dec), self.mjd.astype(int),
+                     (times[0] + times[-1]) / 2., self.cluster_radius, self.min_nights)
+
+        if multi:
+            pool = Pool(processes=link.N_threading, initializer=init_worker, initargs=(tracklets,))
+            results = pool.map(link_hypothesis, self.hypotheses, chunksize=1)
+            pool.close()
+        else:
+            init_worker(tracklets)
+            results = map(link_hypothesis, self.hypotheses)
+
+        tracks = set()
+        for hypothesis, result in zip(self.hypotheses, results):
+            tracks.update(result)
+            print '[%s] Hypothesis r=%s rdot=%s: %s tracks' % (
+                time.strftime("%D %H:%M:%S"), hypothesis[0], hypothesis[1], len(result))
+        self.tracks = deduplicate(tracks)
+        print '[%s] Total tracks: %s. Total time: %s' % (
+            time.strftime("%D %H:%M:%S"), len(self.tracks), time.time() - t1)
+
+
+def hypothesis_grid(distance, rdot):
+    """
+    Build the grid of hypotheses.
+
+    :param distance: (minimum, maximum, count) of the heliocentric distances, geometrically spaced, au.
+    :param rdot: (minimum, maximum, count) of the radial velocities, au / day.
+    :return: list of (r, rdot) pairs
+    """
+    return [(r, v) for r in np.geomspace(distance[0], distance[1], int(distance[2]))
+            for v in np.linspace(rdot[0], rdot[1], int(rdot[2]))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Link ns catalogs from several nights under heliocentric "
+                                                 "distance hypotheses.")
+    parser.add_argument("workdir", help="directory containing the ns catalogs, tracks are written here too.")
+    parser.add_argument("nsfiles", nargs='+', help="ns catalogs of the same HEALPix, e.g. from several QRUNs.")
+    parser.add_argument("--distance", nargs=3, type=float, default=[link.au_s, link.maxau, 12],
+                        metavar=('MIN', 'MAX', 'N'), help="heliocentric distances to hypothesise, au.")
+    parser.add_argument("--rdot", nargs=3, type=float, default=[-0.005, 0.005, 3],
+                        metavar=('MIN', 'MAX', 'N'), help="radial velocities to hypothesise, au/day.")
+    parser.add_argument("--cluster-radius", type=float, default=CLUSTER_RADIUS,
+                        help="clustering radius, in au per au of hypothesised distance.")
+    parser.add_argument("--min-nights", type=int, default=MIN_NIGHTS)
+    parser.add_argument("--processes", type=int, default=link.N_threading,
+                        help="number of hypotheses to link in parallel.")
+    args = parser.parse_args()
+
+    nsfile = os.path.basename(args.nsfiles[0])
+    healpix = '%s_%s_%s' % (nsfile.split('_')[3], nsfile.split('_')[5], nsfile.split('_')[1])
+    link.N_threading = args.processes
+    s = HelioLinker(args.workdir, healpix, hypothesis_grid(args.distance, args.rdot),
+                    cluster_radius=args.cluster_radius, min_nights=args.min_nights)
+    s.Searching(args.processes > 1, args.nsfiles)
+    s.CleanTracks_array()
+    json.dump(s.mjdalltracks, open('%s%s' % (nsfile.rstrip('ns'), alltrackname), 'w'))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,184 @@
+"""Byte-offset index of a candidate JSON file, so single tracks can be read without loading the whole file.
+
+The candidate files written by the linker hold {mjd: {track: record}}.  The index lists every (mjd, track) in a
+stable order, mjd numerically then track name, with the offset and length of its record in the file, and is kept in
+a sidecar file next to the JSON.
+"""
+import json
+import os
+
+SUFFIX = '.idx'
+SUMMARY = '.summary.json'
+_WHITESPACE = ' \t\n\r'
+_decoder = json.JSONDecoder()
+
+
+def _skip(text, pos, expected=None):
+    while text[pos] in _WHITESPACE:
+        pos += 1
+    if expected is not None:
+        if text[pos] not in expected:
+            raise ValueError("expected {!r} at byte {}".format(expected, pos))
+        pos += 1
+    return pos
+
+
+def _key(text, pos):
+    """Read the object key starting at pos, returning it and the position after its ':'."""
+    pos = _skip(text, pos, '"')
+    key, pos = json.decoder.scanstring(text, pos)
+    return key, _skip(text, pos, ':')
+
+
+def _sort_key(value):
+    try:
+        return 0, float(value), value
+    except ValueError:
+        return 1, 0., value
+
+
+def build(filename):
+    """
+    Scan a candidate JSON file for the position of each track record.
+
+    :param filename: the JSON file.
+    :return: list of [mjd, track, offset, length], in mjd then track order.
+    """
+    entries = []
+    with open(filename, 'rb') as fobj:
+        text = fobj.read()
+    if not text.strip():
+        return entries
+    pos = _skip(text, 0, '{')
+    if text[_skip(text, pos)] == '}':
+        return entries
+    while True:
+        mjd, pos = _key(text, pos)
+        pos = _skip(text, pos, '{')
+        if text[_skip(text, pos)] == '}':
+            pos = _skip(text, pos, '}')
+        else:
+            while True:
+                track, pos = _key(text, pos)
+                start = _skip(text, pos)
+                _, end = _decoder.raw_decode(text, start)
+                entries.append([mjd, track, start, end - start])
+                pos = _skip(text, end, ',}')
+                if text[pos - 1] == '}':
+                    break
+        pos = _skip(text, pos, ',}')
+        if text[pos - 1] == '}':
+            break
+    entries.sort(key=lambda entry: (_sort_key(entry[0]), _sort_key(entry[1])))
+    return entries
+
+
+def load(filename):
+    """
+    The index of a candidate JSON file, read from its sidecar if that is up to date, otherwise built and saved.
+
+    :param filename: the JSON file.
+    :return: list of [mjd, track, offset, length], see build
+    """
+    index_filename = filename + SUFFIX
+    if os.path.exists(index_filename) and os.path.getmtime(index_filename) >= os.path.getmtime(filename):
+        with open(index_filename, 'r') as fobj:
+            return json.load(fobj)
+    entries = build(filename)
+    try:
+        with open(index_filename + '.tmp', 'w') as fobj:
+            json.dump(entries, fobj)
+        os.rename(index_filename + '.tmp', index_filename)
+    except (IOError, OSError):
+        pass
+    return entries
+
+
+def summarise(mjdalltracks):
+    """
+    The summary of a set of tracks: how many there are and their (mjd, track) names, in index order.
+
+    :param mjdalltracks: the tracks, in the mjdalltracks layout.
+    :return: {'count': number of tracks, 'tracks': [[mjd, track], ...]}
+    """
+    tracks = sorted(([str(mjd), str(track)] for mjd in mjdalltracks for track in mjdalltracks[mjd]),
+                    key=lambda entry: (_sort_key(entry[0]), _sort_key(entry[1])))
+    return {'count': len(tracks), 'tracks': tracks}
+
+
+def summary_name(filename):
+    """
+    The name of the summary of a candidate JSON file, next to it: HPX_..._bk.json has HPX_..._bk.summary.json, for
+    the linker output and its copy in VOSpace alike.
+    """
+    if filename.endswith('.json'):
+        filename = filename[:-len('.json')]
+    return filename + SUMMARY
+
+
+def write_summary(mjdalltracks, filename):
+    """
+    Write the summary of a set of tracks, see summarise.
+    """
+    with open(filename + '.tmp', 'w') as fobj:
+        json.dump(summarise(mjdalltracks), fobj)
+    os.rename(filename + '.tmp', filename)
+
+
+class Tracks(object):
+    """
+    The tracks of one mjd in a candidate JSON file, as a read-only mapping whose records are read on access.
+    """
+
+    def __init__(self, filename, entries):
+        """
+        :param filename: the JSON file.
+        :param entries: the (track, offset, length) of each track, in order.
+        """
+        self.filename = filename
+        self._keys = [entry[0] for entry in entries]
+        self._position = dict((entry[0], (entry[1], entry[2])) for entry in entries)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __contains__(self, key):
+        return key in self._position
+
+    def keys(self):
+        return list(self._keys)
+
+    def __getitem__(self, key):
+        offset, length = self._position[key]
+        with open(self.filename, 'rb') as fobj:
+            fobj.seek(offset)
+            return json.loads(fobj.read(length))
+
+
+class IndexedCatalog(object):
+    """
+    Random access to the tracks of a candidate JSON file through its index.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.mjdates = []
+        entries = {}
+        for mjd, track, offset, length in load(filename):
+            if mjd not in entries:
+                self.mjdates.append(mjd)
+                entries[mjd] = []
+            entries[mjd].append((track, offset, length))
+        self._tracks = dict((mjd, Tracks(filename, entries[mjd])) for mjd in self.mjdates)
+
+    def __len__(self):
+        return len(self.mjdates)
+
+    def __getitem__(self, mjd):
+        """
+        :rtype: Tracks
+        """
+        return self._tracks[mjd]
@@ -0,0 +1,177 @@
+"""Velocity-space KD-tree linker, an alternative engine to the line search in CFIS_Link_stacked.
+
+Detections are split by exposure epoch and one KD-tree is built per epoch.  Every detection of an early epoch is
+paired with the detections of later epochs that lie inside the annulus allowed by min_v..max_v (and min_motion),
+the pair is then extended by predicting its linear motion into each following epoch and querying that epoch's tree.
+"""
+import time
+import numpy as np
+from scipy.spatial import cKDTree
+
+from . import CFIS_Link_stacked as link
+
+
+class KDTreeLinker(link.SearchMovingObjects):
+    """
+    Link the detections of a stacked ns catalog using per-epoch KD-trees.
+
+    The interface matches SearchMovingObjects: call Searching, then CleanTracks_array, and the tracks are left in
+    mjdalltracks using the same layout as the line search, so candidate.Catalog can read either.
+    """
+
+    def __init__(self, workdir, healpix):
+        link.SearchMovingObjects.__init__(self, workdir, healpix)
+        self.tracks = []
+
+    def epochs(self):
+        """
+        Project the detections onto the plane tangent to the field centre and group them by exposure epoch.
+
+        :return: times of the epochs and, for each epoch, the indices (into self.sns) of its detections.
+        :rtype: (numpy.ndarray, list)
+        """
+        cosdec = np.cos(np.radians(self.cdec))
+        self.xy = np.column_stack(((self.sns['X_WORLD'] - self.cra) * cosdec,
+                                   self.sns['Y_WORLD'] - self.cdec))
+        self.mjd = np.array(self.sns['mid_mjdate'], dtype='f8')
+        self.mag = np.array(self.sns[link.Processmag], dtype='f8')
+        # exposures of the same epoch share mid_mjdate, to within the precision it was written with.
+        times, epoch = np.unique(np.round(self.mjd, 6), return_inverse=True)
+        return times, [np.flatnonzero(epoch == i) for i in range(len(times))]
+
+    def seeds(self, first, second, dt, tree):
+        """
+        Find the pairs between two epochs whose motion is inside the rate bounded annulus.
+
+        :param first: indices of the detections in the earlier epoch.
+        :param second: indices of the detections in the later epoch.
+        :param dt: time between the two epochs, in days.
+        :param tree: KD-tree of the later epoch.
+        :return: arrays of the first and second index of each pair.
+        """
+        r_out = link.max_v * dt
+        r_in = max(link.min_v * dt, link.min_motion / 3600.)
+        neighbours = tree.query_ball_point(self.xy[first], r_out)
+        counts = np.array([len(n) for n in neighbours], dtype=int)
+        if counts.sum() == 0:
+            return np.array([], dtype=int), np.array([], dtype=int)
+        a = np.repeat(first, counts)
+        b = second[np.concatenate([n for n in neighbours if len(n) > 0]).astype(int)]
+        d = np.hypot(*(self.xy[b] - self.xy[a]).T)
+        keep = (d > r_in) & (abs(self.mag[b] - self.mag[a]) < link.max_dm)
+        return a[keep], b[keep]
+
+    def grow(self, a, b, first, start, times, epochs, trees):
+        """
+        Extend a batch of seed pairs into the later epochs by predicting their linear motion.
+
+        :param a: index of the first detection of each seed.
+        :param b: index of the second detection of each seed.
+        :param first: epoch number of the first detection.
+        :param start: epoch number of the second detection.
+        :param times: the epoch times.
+        :param epochs: detections indices of each epoch.
+        :param trees: KD-tree of each epoch.
+        :return: array of shape (len(a), len(times)) holding the detection index in each epoch, or -1.
+        """
+        members = -np.ones((len(a), len(times)), dtype=int)
+        members[:, first] = a
+        members[:, start] = b
+        rate = (self.xy[b] - self.xy[a]) / (self.mjd[b] - self.mjd[a])[:, np.newaxis]
+        last = b.copy()
+        for k in range(start + 1, len(times)):
+            if len(epochs[k]) == 0:
+                continue
+            predicted = self.xy[a] + rate * (times[k] - self.mjd[a])[:, np.newaxis]
+            distance, nearest = trees[k].query(predicted, distance_upper_bound=link.sr / 3600.)
+            hit = np.isfinite(distance)
+            found = epochs[k][np.where(hit, nearest, 0)]
+            motion = np.hypot(*(self.xy[found] - self.xy[last]).T)
+            hit &= (times[k] - self.mjd[last] > link.min_dt) & (motion > link.min_motion / 3600.)
+            hit &= abs(self.mag[found] - self.mag[a]) < link.max_dm
+            members[hit, k] = found[hit]
+            last[hit] = found[hit]
+            # refine the rate with the longest available arc.
+            rate[hit] = (self.xy[found[hit]] - self.xy[a[hit]]) / (times[k] - self.mjd[a[hit]])[:, np.newaxis]
+        return members
+
+    def Searching(self, multi, nsfile, ratelist=None):
+        """
+        Link the detections of the ns catalog.  multi and ratelist are accepted for compatibility with the
+        line search but are not used, every start epoch is processed in this process.
+        """
+        self.midmjd = self.readns(nsfile)
+        self.link(multi)
+
+    def link(self, multi=False, allanglist=None, stream=None):
+        """
+        Link the detections in self.sns, leaving the tracks in self.tracks.  The arguments match
+        SearchMovingObjects.link and are not used.
+        """
+        t1 = time.time()
+        times, epochs = self.epochs()
+        trees = [cKDTree(self.xy[idx]) for idx in epochs]
+        print '[%s] Built KD-trees for %s epochs ... ' % (time.strftime("%D %H:%M:%S"), len(times))
+        tracks = set()
+        for i in range(len(times)):
+            for j in range(i + 1, len(times)):
+                dt = times[j] - times[i]
+                if dt < link.min_dt or len(epochs[i]) == 0 or len(epochs[j]) == 0:
+                    continue
+                a, b = self.seeds(epochs[i], epochs[j], dt, trees[j])
+                if len(a) == 0:
+                    continue
+                members = self.grow(a, b, i, j, times, epochs, trees)
+                for row in members[(members >= 0).sum(axis=1) >= link.N_dets]:
+                    track = tuple(row[row >= 0])
+                    if np.ptp(self.mag[list(track)]) <= link.max_dm:
+                        tracks.add(track)
+            print '[%s] Processing epoch: %s. Total tracks: %s. Total time: %s' % (
+                time.strftime("%D %H:%M:%S"), i, len(tracks), time.time() - t1)
+        self.tracks = deduplicate(tracks)
+
+    def record(self, track):
+        """
+        Build the mjdalltracks entry of a track, in the layout written by SearchMovingObjects.findpair.
+        """
+        rows = self.sns[list(track)]
+        return {'ra': [float(x) for x in rows['X_WORLD']],
+                'dec': [float(x) for x in rows['Y_WORLD']],
+                'mjd': [float(x) for x in rows['mid_mjdate']],
+                'mag': [float(x) for x in rows[link.Processmag]],
+                'magerr': [float(x) for x in rows[link.Processmagerr]],
+                'A': [float(x) for x in rows['A_IMAGE']],
+                'B': [float(x) for x in rows['B_IMAGE']],
+                'theta': [float(x) for x in rows['THETA_IMAGE']],
+                'fitsname': [str(x) for x in rows['dataset_name']],
+                'filterid': ['r'] * len(rows),
+                'exptime': [30.0] * len(rows)}
+
+    def CleanTracks_array(self):
+        mjdalltracks = {}
+        for n, track in enumerate(self.tracks):
+            record = self.record(track)
+            mjd = int(record['mjd'][0])
+            objid = '%13.9f_%13.11f_kd_%06i' % (record['ra'][0], record['dec'][0], n)
+            mjdalltracks.setdefault(mjd, {})[objid] = record
+        self.mjdalltracks = mjdalltracks
+
+
+def deduplicate(tracks):
+    """
+    Remove the tracks that are a subset of a longer track.
+
+    :param tracks: collection of tracks, each a tuple of detection indices.
+    :return: list of the tracks that are not contained in any other track, longest first.
+    """
+    kept = []
+    members = []
+    containing = {}
+    for track in sorted(tracks, key=len, reverse=True):
+        if any(set(track) <= members[k] for k in containing.get(track[0], [])):
+            continue
+        for detection in track:
+            containing.setdefault(detection, []).append(len(kept))
+        kept.append(track)
+        members.append(set(track))
+    return kept
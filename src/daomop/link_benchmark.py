@@ -0,0 +1,253 @@
+"""Compare the recall, runtime and memory of the linking engines on synthetic stacked ns catalogs.
+
+The moving objects are drawn with plant.KBOGenerator, the same rate, angle and magnitude distributions used to plant
+artificial objects, and hidden among uniformly distributed stationary-residual noise so the catalogs can be scaled
+from 10^3 to 10^6 detections.  Every engine runs in a new python process that reads the catalog itself, so the peak
+RSS it reports is its own and holds nothing of the benchmark process.
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy
+from astropy.table import Table
+
+from . import CFIS_Link_stacked as link
+
+# centre of the synthetic field and the first exposure epoch.
+RA = 160.0
+DEC = 10.0
+MJD = 57800.3
+
+
+def population(n_objects, rate=(1.0, 15.0), angle=(10.0, 30.0), mag=(21.0, 24.5), radius=0.2, seed=None):
+    """
+    Draw moving objects from the plant.KBOGenerator distributions.
+
+    :param n_objects: number of objects.
+    :param rate: range of the sky rates, arcsec per hour.
+    :param angle: range of the position angles of the motion, degrees from the RA axis.
+    :param mag: range of the magnitudes.
+    :param radius: half width of the field the objects start in, in degrees.
+    :param seed: random seed.
+    :return: table of the objects, with the KBOGenerator columns x, y (offsets from the field centre, in degrees),
+    mag, sky_rate, angle and id.
+    """
+    from .plant import KBOGenerator, Range
+    # each Range seeds the global generator, so seeding them all leaves one reproducible stream of draws.
+    generator = KBOGenerator(n_objects,
+                             rate=Range(rate, func=lambda value: value ** 0.25, seed=seed),
+                             angle=Range(angle, seed=seed),
+                             mag=Range(mag, func=KBOGenerator._step, seed=seed),
+                             x=Range((-radius, radius), seed=seed),
+                             y=Range((-radius, radius), seed=seed))
+    objects = Table(rows=[(kbo['x'], kbo['y'], kbo['mag'], kbo['sky_rate'], kbo['angle'], kbo['id'])
+                          for kbo in generator] or None,
+                    names=('x', 'y', 'mag', 'sky_rate', 'angle', 'id'))
+    return objects
+
+
+def synthetic_catalog(n_noise, n_objects, epochs=(0.0, 0.04, 0.08), radius=0.2, angle=20.0, seed=None,
+                      objects=None):
+    """
+    Build a stacked ns catalog holding stationary residual noise and linearly moving objects.
+
+    :param n_noise: number of noise detections in each epoch.
+    :param n_objects: number of moving objects, each detected once per epoch, ignored if objects is given.
+    :param epochs: time offsets, in days, of the exposures from MJD.
+    :param radius: half width of the field, in degrees.
+    :param angle: mean position angle of the motion of the objects, in degrees from the RA axis.
+    :param seed: random seed.
+    :param objects: moving objects to inject, as returned by population, instead of drawing them uniformly.
+    :return: catalog with the ns columns used by the linker plus OBJECT_ID (-1 for noise).
+    :rtype: Table
+    """
+    rand = numpy.random.RandomState(seed)
+    cosdec = numpy.cos(numpy.radians(DEC))
+    if objects is None:
+        ra0 = RA + rand.uniform(-radius, radius, n_objects) / cosdec
+        dec0 = DEC + rand.uniform(-radius, radius, n_objects)
+        rate = rand.uniform(1.5, 10.0, n_objects) * 24 / 3600.  # degree per day
+        theta = numpy.radians(rand.uniform(angle - 10, angle + 10, n_objects))
+        mag = rand.uniform(21.0, 24.0, n_objects)
+    else:
+        n_objects = len(objects)
+        ra0 = RA + numpy.array(objects['x'], dtype='f8') / cosdec
+        dec0 = DEC + numpy.array(objects['y'], dtype='f8')
+        rate = numpy.array(objects['sky_rate'], dtype='f8') * 24 / 3600.
+        theta = numpy.radians(numpy.array(objects['angle'], dtype='f8'))
+        mag = numpy.array(objects['mag'], dtype='f8')
+
+    columns = dict((name, []) for name in ['X_WORLD', 'Y_WORLD', 'mid_mjdate', 'MAG_PSF', 'OBJECT_ID'])
+    for n, dt in enumerate(epochs):
+        columns['X_WORLD'].append(ra0 + rate * dt * numpy.cos(theta) / cosdec)
+        columns['Y_WORLD'].append(dec0 + rate * dt * numpy.sin(theta))
+        columns['MAG_PSF'].append(mag + rand.normal(0, 0.05, n_objects))
+        columns['OBJECT_ID'].append(numpy.arange(n_objects))
+        columns['X_WORLD'].append(RA + rand.uniform(-radius, radius, n_noise) / cosdec)
+        columns['Y_WORLD'].append(DEC + rand.uniform(-radius, radius, n_noise))
+        columns['MAG_PSF'].append(rand.uniform(21.0, 24.0, n_noise))
+        columns['OBJECT_ID'].append(-numpy.ones(n_noise, dtype=int))
+        columns['mid_mjdate'].append(numpy.ones(n_objects + n_noise) * (MJD + dt))
+
+    catalog = Table(dict((name, numpy.concatenate(value)) for name, value in columns.items()))
+    size = len(catalog)
+    catalog['MAGERR_PSF'] = 0.1 * numpy.ones(size)
+    catalog['MAG_ISO'] = catalog['MAG_PSF']
+    catalog['FLUX_RADIUS'] = 3.0 * numpy.ones(size)
+    catalog['X_IMAGE'] = rand.uniform(50, 2080, size)
+    catalog['A_IMAGE'] = 2.0 * numpy.ones(size)
+    catalog['B_IMAGE'] = 2.0 * numpy.ones(size)
+    catalog['THETA_IMAGE'] = numpy.zeros(size)
+    catalog['dataset_name'] = ['{}p{:02d}'.format(2000000 + int(round((m - MJD) * 1000)), 0)
+                               for m in catalog['mid_mjdate']]
+    return catalog
+
+
+def score(mjdalltracks, catalog):
+    """
+    Compare the tracks found by a linker with the objects injected into the catalog.
+
+    :param mjdalltracks: the tracks, in the mjdalltracks layout.
+    :param catalog: the synthetic catalog the tracks were found in.
+    :return: number of tracks, recall of the injected objects and the fraction of tracks that are false links.
+    """
+    truth = dict(((round(ra, 7), round(dec, 7)), object_id)
+                 for ra, dec, object_id in zip(catalog['X_WORLD'], catalog['Y_WORLD'], catalog['OBJECT_ID']))
+    found = set()
+    n_tracks = n_false = 0
+    for tracks in mjdalltracks.values():
+        for track in tracks.values():
+            n_tracks += 1
+            ids = set(truth.get((round(ra, 7), round(dec, 7)), -1) for ra, dec in zip(track['ra'], track['dec']))
+            if len(ids) == 1 and -1 not in ids:
+                found |= ids
+            else:
+                n_false += 1
+    n_objects = len(set(catalog['OBJECT_ID'][catalog['OBJECT_ID'] >= 0]))
+    return n_tracks, len(found) / float(max(n_objects, 1)), n_false / float(max(n_tracks, 1))
+
+
+def write(catalog, workdir, angle):
+    """
+    Write a catalog, and a ratelist listing its mean motion angle, for the linkers to read.
+
+    :return: the name of the ns catalog and the path of the ratelist.
+    """
+    nsfile = 'HPX_00000_RA_{:05.1f}_DEC_{:+04.1f}_cat.fits.ns'.format(RA, DEC)
+    catalog.write(os.path.join(workdir, nsfile), format='fits', overwrite=True)
+    ratelist = os.path.join(workdir, 'ratelist.txt')
+    with open(ratelist, 'w') as fobj:
+        fobj.write('{} 0 {}\n'.format(nsfile.rstrip('ns').rstrip('.'), angle))
+    return nsfile, ratelist
+
+
+def run(engine, catalog, workdir, angle):
+    """
+    Link a catalog with the given engine.
+
+    :param engine: the engine class, see CFIS_Link_stacked.get_engine
+    :param catalog: the catalog to link.
+    :param workdir: scratch directory the catalog and ratelist are written to.
+    :param angle: mean motion angle listed in the ratelist given to the line search.
+    :return: the tracks found and the time taken.
+    """
+    nsfile, ratelist = write(catalog, workdir, angle)
+    return link_file(engine, workdir, nsfile, ratelist)
+
+
+def link_file(engine, workdir, nsfile, ratelist):
+    linker = engine(workdir, '{}_{}_{}'.format(RA, DEC, 0))
+    start = time.time()
+    linker.Searching(False, nsfile, ratelist)
+    linker.CleanTracks_array()
+    return linker.mjdalltracks, time.time() - start
+
+
+def measure(name, workdir, nsfile, ratelist, fr, openangle):
+    """
+    Link a catalog already written by write, in a new python process.
+
+    A forked worker would start with the pages of this process, catalog included, and count them in its peak RSS, so
+    the linking runs in a fresh interpreter that reads the catalog from workdir itself, see _measure.
+
+    :param name: the engine, one of CFIS_Link_stacked.ENGINES
+    :param fr: half width of the field, link.fr
+    :param openangle: half width of the searched angles, link.openangle
+    :return: the tracks found, the time taken and the peak RSS of the process, in MB.
+    """
+    output = os.path.join(workdir, '{}.measure.json'.format(name))
+    package = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([package] + filter(None, [os.environ.get('PYTHONPATH')])))
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call([sys.executable, '-m', 'daomop.link_benchmark', '--measure', name, workdir, nsfile,
+                               ratelist, str(fr), str(openangle), output], env=env, stdout=devnull)
+    with open(output) as fobj:
+        result = json.load(fobj)
+    os.remove(output)
+    return result['tracks'], result['elapsed'], result['rss']
+
+
+def _measure(name, workdir, nsfile, ratelist, fr, openangle, output):
+    """
+    The linking of measure, in the new process: write the tracks, time taken and peak RSS to output.
+    """
+    link.fr = float(fr)
+    link.openangle = float(openangle)
+    mjdalltracks, elapsed = link_file(link.get_engine(name), workdir, nsfile, ratelist)
+    with open(output, 'w') as fobj:
+        json.dump({'tracks': mjdalltracks, 'elapsed': elapsed,
+                   'rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.}, fobj)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--detections", type=int, nargs='+', default=[1000, 10000, 100000, 1000000],
+                        help="total number of detections in each catalog, one benchmark per value.")
+    parser.add_argument("--objects", type=int, default=100, help="number of moving objects to inject.")
+    parser.add_argument("--epochs", type=float, nargs='+', default=[0.0, 0.04, 0.08],
+                        help="time of each exposure, in days from the first.")
+    parser.add_argument("--radius", type=float, default=0.5, help="half width of the synthetic field, in degrees.")
+    parser.add_argument("--engines", nargs='+', choices=link.ENGINES, default=link.ENGINES)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--measure", nargs=7, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure is not None:
+        _measure(*args.measure)
+        return
+
+    # only search the synthetic field, and only the angles the objects were injected over.
+    angle = 20.0
+    workdir = tempfile.mkdtemp()
+    results = []
+    try:
+        objects = population(args.objects, angle=(angle - 10, angle + 10), radius=args.radius, seed=args.seed)
+        for detections in args.detections:
+            n_noise = max(detections // len(args.epochs) - len(objects), 0)
+            catalog = synthetic_catalog(n_noise, 0, epochs=args.epochs, radius=args.radius, seed=args.seed,
+                                        objects=objects)
+            nsfile, ratelist = write(catalog, workdir, angle)
+            for name in args.engines:
+                # a fresh process for each run, so ru_maxrss is the peak of this engine on this catalog.
+                mjdalltracks, elapsed, rss = measure(name, workdir, nsfile, ratelist, args.radius, 15.)
+                n_tracks, recall, false_links = score(mjdalltracks, catalog)
+                results.append((name, len(catalog), n_tracks, recall, false_links, elapsed, rss,
+                                n_tracks / max(elapsed, 1e-9)))
+    finally:
+        shutil.rmtree(workdir)
+
+    sys.stdout.write("{:8s} {:>10s} {:>8s} {:>8s} {:>8s} {:>10s} {:>10s} {:>10s}\n".format(
+        "engine", "detections", "tracks", "recall", "false", "time(s)", "rss(MB)", "tracks/s"))
+    for result in results:
+        sys.stdout.write("{:8s} {:10d} {:8d} {:8.3f} {:8.3f} {:10.2f} {:10.1f} {:10.1f}\n".format(*result))
+
+
+if __name__ == '__main__':
+    main()
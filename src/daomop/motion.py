@@ -0,0 +1,123 @@
+"""Expected sky motion of bound solar system objects, used to choose the position angles the line search sweeps.
+
+A population of heliocentric orbits is sampled along the line of sight of a field: distances between au_s and maxau,
+eccentricities up to e_s and inclinations up to I_MAX above the smallest inclination that reaches the field's
+ecliptic latitude.  The apparent rate and position angle of each sample, as seen from the geocentre on the night of
+the observations, give the window of angles that holds most of the population.
+"""
+import numpy as np
+
+from . import CFIS_Link_stacked as link
+from .helio_link import GM, line_of_sight, observer_positions
+
+OBLIQUITY = np.radians(23.439291)  # obliquity of the ecliptic, J2000
+I_MAX = 30.0  # range of inclinations sampled, in degrees
+N_SAMPLES = 20000
+COVERAGE = 0.99  # fraction of the sampled motions the angle window must hold
+
+
+def to_ecliptic(xyz):
+    """
+    Rotate equatorial vectors, shape (n, 3), to the ecliptic frame.
+    """
+    c, s = np.cos(OBLIQUITY), np.sin(OBLIQUITY)
+    return np.column_stack((xyz[:, 0], c * xyz[:, 1] + s * xyz[:, 2], -s * xyz[:, 1] + c * xyz[:, 2]))
+
+
+def sample_motion(mjd, ra, dec, n=N_SAMPLES, seed=None):
+    """
+    Sample the apparent motion of bound orbits seen towards ra/dec at mjd.
+
+    :param mjd: time of the observations.
+    :param ra: right ascension of the field, degrees.
+    :param dec: declination of the field, degrees.
+    :param n: number of orbits to sample.
+    :param seed: random seed.
+    :return: rate (degree per day) and position angle (degrees, in the linker's RA/Dec convention, 0 to 180) of
+    each sample whose line of sight reaches its distance.
+    """
+    rand = np.random.RandomState(seed)
+    observer = observer_positions(np.array([mjd - 0.5, mjd, mjd + 0.5]))
+    observer_velocity = to_ecliptic((observer[2] - observer[0])[np.newaxis, :])[0]
+    observer = to_ecliptic(observer[1][np.newaxis, :])[0]
+    direction = to_ecliptic(line_of_sight(np.array([ra]), np.array([dec])))[0]
+
+    r = np.exp(rand.uniform(np.log(link.au_s), np.log(link.maxau), n))
+    b = observer.dot(direction)
+    disc = b ** 2 - observer.dot(observer) + r ** 2
+    rho = -b + np.sqrt(np.clip(disc, 0, None))
+    keep = (disc > 0) & (rho > 0)
+    r, rho = r[keep], rho[keep]
+    n = len(r)
+    position = observer + rho[:, np.newaxis] * direction
+    rhat = position / r[:, np.newaxis]
+
+    # speed and flight path from the vis-viva relation at a random true anomaly.
+    e = rand.uniform(0, link.e_s, n)
+    f = rand.uniform(0, 2 * np.pi, n)
+    p = r * (1 + e * np.cos(f))
+    vr = np.sqrt(GM / p) * e * np.sin(f)
+    vt = np.sqrt(GM / p) * (1 + e * np.cos(f))
+
+    # prograde orbit normals inclined by i to the ecliptic pole that are perpendicular to the position.
+    beta = np.arcsin(np.clip(rhat[:, 2], -1, 1))
+    inc = np.minimum(np.abs(beta) + np.radians(rand.uniform(0, I_MAX, n)), np.radians(89.9))
+    pole = np.array([0., 0., 1.])
+    e1 = pole - rhat[:, 2][:, np.newaxis] * rhat
+    e1 /= np.sqrt((e1 ** 2).sum(axis=1))[:, np.newaxis]
+    e2 = np.cross(rhat, e1)
+    alpha = np.clip(np.cos(inc) / np.cos(beta), -1, 1)
+    normal = alpha[:, np.newaxis] * e1 + (rand.choice([-1, 1], n) * np.sqrt(1 - alpha ** 2))[:, np.newaxis] * e2
+    tangent = np.cross(normal, rhat)
+    velocity = vt[:, np.newaxis] * tangent + vr[:, np.newaxis] * rhat
+
+    # apparent angular velocity, then back to the equatorial frame to measure RA/Dec rates.
+    relative = velocity - observer_velocity
+    angular = (relative - (relative.dot(direction))[:, np.newaxis] * direction) / rho[:, np.newaxis]
+    c, s = np.cos(OBLIQUITY), np.sin(OBLIQUITY)
+    angular = np.column_stack((angular[:, 0], c * angular[:, 1] - s * angular[:, 2],
+                               s * angular[:, 1] + c * angular[:, 2]))
+    ra, dec = np.radians(ra), np.radians(dec)
+    east = angular.dot([-np.sin(ra), np.cos(ra), 0.])
+    north = angular.dot([-np.sin(dec) * np.cos(ra), -np.sin(dec) * np.sin(ra), np.cos(dec)])
+    rate = np.degrees(np.hypot(east, north))
+    angle = np.degrees(np.arctan2(north, east / np.cos(dec))) % 180.
+    return rate, angle
+
+
+def angle_window(angle, coverage=COVERAGE):
+    """
+    The shortest range of position angles, modulo 180 degrees, holding the given fraction of the angles.
+
+    :param angle: position angles, degrees.
+    :param coverage: fraction of the angles the range must hold.
+    :return: the start and end of the range, in degrees, end may exceed 180.
+    """
+    angle = np.sort(np.asarray(angle) % 180.)
+    k = max(int(np.ceil(coverage * len(angle))), 1)
+    wrapped = np.concatenate((angle, angle + 180.))
+    width = wrapped[k - 1:k - 1 + len(angle)] - angle
+    start = np.argmin(width)
+    return angle[start], angle[start] + width[start]
+
+
+def search_angles(mjd, ra, dec, coverage=COVERAGE, seed=0):
+    """
+    Position angles, in 1 degree steps, the line search should sweep to find the objects the linker can link.
+
+    :param mjd: time of the observations.
+    :param ra: right ascension of the field, degrees.
+    :param dec: declination of the field, degrees.
+    :param coverage: fraction of the sampled motions, within min_v and max_v, the angles must hold.
+    :param seed: random seed, fixed so a field always gets the same angles.
+    :return: the angles to search and the (minimum, maximum) rate of the sampled motions that are linked.
+    """
+    rate, angle = sample_motion(mjd, ra, dec, seed=seed)
+    linked = (rate >= link.min_v) & (rate <= link.max_v)
+    if linked.any():
+        rate, angle = rate[linked], angle[linked]
+    start, end = angle_window(angle, coverage)
+    if np.ceil(end) - np.floor(start) >= 179:
+        # near the stationary points the motion can point anywhere.
+        return np.arange(0., 180., 1.0), (rate.min(), rate.max())
+    return np.arange(np.floor(start), np.ceil(end) + 1, 1.0), (rate.min(), rate.max())
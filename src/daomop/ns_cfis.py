@@ -9,21 +9,81 @@ from scipy.spatial import cKDTree as KDTree
 import pandas as pd
 import seaborn as sns
 import os, sys
+import time
+import argparse
+from multiprocessing import Pool
+from .reference_index import get_index
+
+# the columns, in order, of the real/bogus feature matrix.
+FEATURES = ['MAG_ISO', 'MAGERR_ISO', 'MAG_ISOCOR', 'MAGERR_ISOCOR',
+            'MAG_APER', 'MAGERR_APER', 'MAG_AUTO', 'MAGERR_AUTO',
+            'MAG_PETRO', 'MAGERR_PETRO', 'MAG_WIN', 'MAGERR_WIN',
+            'SNR_WIN', 'MAG_SOMFIT', 'MAGERR_SOMFIT', 'KRON_RADIUS',
+            'PETRO_RADIUS', 'BACKGROUND', 'ISOAREA_IMAGE', 'ISOAREAF_IMAGE',
+            'A_IMAGE', 'B_IMAGE', 'THETA_IMAGE', 'ERRX2_IMAGE',
+            'ERRY2_IMAGE', 'ERRXY_IMAGE', 'ERRCXX_IMAGE', 'ERRCYY_IMAGE',
+            'ERRCXY_IMAGE', 'CXXWIN_IMAGE', 'CYYWIN_IMAGE', 'CXYWIN_IMAGE',
+            'AWIN_IMAGE', 'BWIN_IMAGE', 'ERRX2WIN_IMAGE', 'ERRY2WIN_IMAGE',
+            'ERRXYWIN_IMAGE', 'ERRCXXWIN_IMAGE', 'ERRCYYWIN_IMAGE', 'ERRCXYWIN_IMAGE',
+            'MU_THRESHOLD', 'MU_MAX', 'ISO0', 'ISO1', 'ISO2', 'ISO3',
+            'ISO4', 'ISO5', 'ISO6', 'ISO7', 'FWHM_IMAGE', 'ELONGATION',
+            'ELLIPTICITY', 'POLAR_IMAGE', 'POLARWIN_IMAGE', 'FLUX_RADIUS',
+            'FWHMPSF_IMAGE', 'MAG_PSF', 'MAGERR_PSF', 'CHI2_PSF',
+            'ERRCXXPSF_IMAGE', 'ERRCYYPSF_IMAGE', 'ERRCXYPSF_IMAGE',
+            'ERRAPSF_IMAGE', 'ERRBPSF_IMAGE', 'ERRAPSF_WORLD', 'ERRBPSF_WORLD',
+            'ERRTHETAPSF_SKY']
+
+def feature_matrix(catalog, mask=None, features=FEATURES, dtype=float32):
+    """
+    Copy the feature columns of the selected rows into a C-contiguous matrix, one row per source.
+
+    Only the listed columns of the selected rows are read, so a memory mapped catalog is never copied whole.
+
+    :param catalog: FITS_rec (or other table) holding the features.
+    :param mask: boolean mask, or indices, of the rows to use; all rows if None.
+    :param features: names of the feature columns.
+    :param dtype: dtype of the matrix.
+    :return: matrix of shape (number of rows, len(features))
+    """
+    rows = slice(None) if mask is None else (flatnonzero(mask) if asarray(mask).dtype == bool else mask)
+    n = len(catalog) if mask is None else len(rows)
+    matrix = empty((n, len(features)), dtype=dtype, order='C')
+    for i, name in enumerate(features):
+        matrix[:, i] = catalog.field(name)[rows]
+    return matrix
 
 class fits_cat:
     def __init__(self, fitsfile):
         self.fits_name = fitsfile
-        self.fits_file = fits.open(self.fits_name)
+        self.fits_file = fits.open(self.fits_name, memmap=True)
         self.header = self.fits_file[1].header
         self.catalog = self.fits_file[1].data
-        self.stationary0 = self.catalog[self.catalog['MATCHES'] > 0]
-        self.stationary1 = self.catalog[self.catalog['MATCHES'] > 1]
-        self.stationary2 = self.catalog[self.catalog['MATCHES'] > 2]
-        self.ns0 = self.catalog[logical_and(logical_and(self.catalog['MATCHES'] == 0, self.catalog['OVERLAPS'] >0), self.catalog['MAG_PSF']<27)]
-        self.ns1 = self.catalog[logical_and(self.catalog['MATCHES'] == 0, self.catalog['OVERLAPS'] >1)]
-        self.ns2 = self.catalog[logical_and(self.catalog['MATCHES'] == 0, self.catalog['OVERLAPS'] >2)]
-	self.real_feature = self.feature(self.stationary2)
-        self.ns_feature = self.feature(self.ns0)
+        matches = self.catalog.field('MATCHES')
+        overlaps = self.catalog.field('OVERLAPS')
+        self.ns0_mask = (matches == 0) & (overlaps > 0) & (self.catalog.field('MAG_PSF') < 27)
+        self.ns_feature = feature_matrix(self.catalog, self.ns0_mask)
+    # the row subsets, and the training features, are only copied out of the catalog when they are used.
+    @property
+    def real_feature(self):
+        return feature_matrix(self.catalog, self.catalog.field('MATCHES') > 2)
+    @property
+    def stationary0(self):
+        return self.catalog[self.catalog['MATCHES'] > 0]
+    @property
+    def stationary1(self):
+        return self.catalog[self.catalog['MATCHES'] > 1]
+    @property
+    def stationary2(self):
+        return self.catalog[self.catalog['MATCHES'] > 2]
+    @property
+    def ns0(self):
+        return self.catalog[self.ns0_mask]
+    @property
+    def ns1(self):
+        return self.catalog[logical_and(self.catalog['MATCHES'] == 0, self.catalog['OVERLAPS'] >1)]
+    @property
+    def ns2(self):
+        return self.catalog[logical_and(self.catalog['MATCHES'] == 0, self.catalog['OVERLAPS'] >2)]
     def plot(self):
         #plt.xlim(165.5, 168.0)
         #plt.ylim(31.5, 32.0)
@@ -35,23 +95,7 @@ class fits_cat:
         plt.plot(self.catalog['X_WORLD'], self.catalog['Y_WORLD'], marker = '.', label='ALL')
         plt.legend(loc=2)
     def feature(self, cat):
-        return array([cat['MAG_ISO'], cat['MAGERR_ISO'], cat['MAG_ISOCOR'], cat['MAGERR_ISOCOR'], 
-                       cat['MAG_APER'], cat['MAGERR_APER'], cat['MAG_AUTO'], cat['MAGERR_AUTO'],
-                       cat['MAG_PETRO'], cat['MAGERR_PETRO'], cat['MAG_WIN'], cat['MAGERR_WIN'],
-                       cat['SNR_WIN'], cat['MAG_SOMFIT'], cat['MAGERR_SOMFIT'], cat['KRON_RADIUS'],
-                       cat['PETRO_RADIUS'], cat['BACKGROUND'], cat['ISOAREA_IMAGE'], cat['ISOAREAF_IMAGE'],
-                       cat['A_IMAGE'], cat['B_IMAGE'], cat['THETA_IMAGE'], cat['ERRX2_IMAGE'],
-                       cat['ERRY2_IMAGE'], cat['ERRXY_IMAGE'], cat['ERRCXX_IMAGE'], cat['ERRCYY_IMAGE'],
-                       cat['ERRCXY_IMAGE'], cat['CXXWIN_IMAGE'], cat['CYYWIN_IMAGE'], cat['CXYWIN_IMAGE'],
-                       cat['AWIN_IMAGE'], cat['BWIN_IMAGE'], cat['ERRX2WIN_IMAGE'], cat['ERRY2WIN_IMAGE'],
-                       cat['ERRXYWIN_IMAGE'], cat['ERRCXXWIN_IMAGE'], cat['ERRCYYWIN_IMAGE'], cat['ERRCXYWIN_IMAGE'],
-                       cat['MU_THRESHOLD'], cat['MU_MAX'], cat['ISO0'], cat['ISO1'], cat['ISO2'], cat['ISO3'],
-                       cat['ISO4'], cat['ISO5'], cat['ISO6'], cat['ISO7'], cat['FWHM_IMAGE'], cat['ELONGATION'],
-                       cat['ELLIPTICITY'], cat['POLAR_IMAGE'], cat['POLARWIN_IMAGE'], cat['FLUX_RADIUS'], 
-                       cat['FWHMPSF_IMAGE'], cat['MAG_PSF'], cat['MAGERR_PSF'], cat['CHI2_PSF'],
-                       cat['ERRCXXPSF_IMAGE'], cat['ERRCYYPSF_IMAGE'], cat['ERRCXYPSF_IMAGE'],
-                       cat['ERRAPSF_IMAGE'], cat['ERRBPSF_IMAGE'], cat['ERRAPSF_WORLD'], cat['ERRBPSF_WORLD'],
-                       cat['ERRTHETAPSF_SKY']]).T
+        return feature_matrix(cat)
         
 class IF_real_bogus:
     def __init__(self, feature):
@@ -82,62 +126,119 @@ def build_model(fits_tab):
 	return real_bogus.IFmod
 
 def remove_ps1_source(ps1_cat, ns_cat):
-	ps1 = fits.open(ps1_cat)[1].data
-	ps1_ra = ps1['f0']
-	ps1_dec = ps1['f1']
-	ra = ns_cat['X_WORLD']
-	dec = ns_cat['Y_WORLD']
-	ns_tree = KDTree(zip(ra, dec))
-	ps1_tree = KDTree(zip(ps1_ra, ps1_dec))
-	match = ns_tree.query_ball_tree(ps1_tree, r=.5/3600.)
-	#print len(match), len(ra), len(ps1)
-	ps1_match = []
-	for i in match:
-		if i != []:
-			ps1_match.append(True)
-		else:
-			ps1_match.append(False)
-	return array(ps1_match)
+	"""True for the ns_cat sources within 0.5 arcsec of a PS1 source, using the reference index of ps1_cat."""
+	ps1 = get_index(ps1_cat, ra_column='f0', dec_column='f1')
+	return ps1.within(ns_cat['X_WORLD'], ns_cat['Y_WORLD'], 0.5)
 	
 
+def write_ns(fits_tab, sources, normal):
+	"""Write the .ns catalog of fits_tab: its ns0 sources scored normal, less those matching a PS1 source."""
+	healpix = fits_tab.split('/')[-1].rstrip('_cat.fits') #HPX_03205_RA_194.1_DEC_+28.6_cat.fits
+	print fits_tab
+	print "total:{0}, normal:{1}, abnormal:{2}".format(len(normal), normal.sum(), (~normal).sum())
+	ns_cat = sources.catalog[flatnonzero(sources.ns0_mask)[normal]]
+	ps1_cat = '{0}{1}_STK.fits'.format(ps1_dir, healpix) #HPX_02298_RA_164.5_DEC_+38.7_STK.fits
+	ps1_match = remove_ps1_source(ps1_cat, ns_cat)
+	ns_cat = ns_cat[~ps1_match]
+	print "PS1 remove {0} stationary sources".format(ps1_match.sum())
+	print "{0} non-stationary sources remain".format((~ps1_match).sum())
+	fits.writeto('{}.ns'.format(fits_tab), ns_cat, header=sources.header, overwrite=True)
+
+def ns_cats(batch):
+	"""
+	Build the .ns catalogs of a batch of catalogs, scoring the ns0 sources of all of them with a single predict call.
+
+	:param batch: list of HPX catalogs.
+	:return: list of (catalog, seconds spent on it), the inference time shared out by source count.
+	"""
+	elapsed = dict((fits_tab, 0.0) for fits_tab in batch)
+	loaded = []
+	for fits_tab in batch:
+		start = time.time()
+		try:
+			loaded.append((fits_tab, fits_cat(fits_tab)))
+		except ValueError:
+			print 'ValueError: {0}'.format(fits_tab)
+		except IOError:
+			print 'IOError: {0}'.format(fits_tab)
+		elapsed[fits_tab] += time.time() - start
+
+	sizes = [len(sources.ns_feature) for fits_tab, sources in loaded]
+	start = time.time()
+	if sum(sizes) > 0:
+		normal = RB_model.predict(concatenate([sources.ns_feature for fits_tab, sources in loaded])) == 1
+	else:
+		normal = zeros(0, dtype=bool)
+	inference = time.time() - start
+
+	for (fits_tab, sources), catalog_normal in zip(loaded, split(normal, cumsum(sizes)[:-1])):
+		start = time.time()
+		try:
+			write_ns(fits_tab, sources, catalog_normal)
+		except ValueError:
+			print 'ValueError: {0}'.format(fits_tab)
+		except IOError:
+			print 'IOError: {0}'.format(fits_tab)
+		elapsed[fits_tab] += time.time() - start + inference * len(catalog_normal) / float(max(sum(sizes), 1))
+	return [(fits_tab, elapsed[fits_tab]) for fits_tab in batch]
+
 def ns_cat(fits_tab):
-	try:
-		sources = fits_cat(fits_tab)
-		healpix = fits_tab.split('/')[-1].rstrip('_cat.fits') #HPX_03205_RA_194.1_DEC_+28.6_cat.fits
-		print fits_tab
-		real_bogus = IF_real_bogus(sources.ns_feature)
-		real_bogus.IFmod = RB_model
-		real_bogus.validation()
-		ns_cat = sources.ns0[real_bogus.normal]
-		ps1_cat = '{0}{1}_STK.fits'.format(ps1_dir, healpix) #HPX_02298_RA_164.5_DEC_+38.7_STK.fits
-		ps1_match = remove_ps1_source(ps1_cat, ns_cat)
-		ns_cat = ns_cat[~ps1_match]
-		#print len(ps1_match), ps1_match.sum()
-		print "PS1 remove {0} stationary sources".format(ps1_match.sum())
-		print "{0} non-stationary sources remain".format((~ps1_match).sum())
-		fits.writeto('{}.ns'.format(fits_tab), ns_cat, header=sources.header)
-	except ValueError:
-		print 'ValueError: {0}'.format(fits_tab)
-	except IOError:
-		print 'IOError: {0}'.format(fits_tab)
+	"""Build the .ns catalog of a single catalog."""
+	ns_cats([fits_tab])
 	
-def main():
+def up_to_date(fits_tab):
+	"""True if the .ns catalog of fits_tab exists and is newer than fits_tab."""
+	ns_tab = '{}.ns'.format(fits_tab)
+	return os.path.exists(ns_tab) and os.path.getmtime(ns_tab) >= os.path.getmtime(fits_tab)
+
+def init_worker(model, ps1):
+	"""Set the model and the PS1 directory once for each worker of the pool."""
 	global RB_model
 	global ps1_dir
-	ps1_dir = '/mnt/jkavelaars/YTC_TEST/PS/'
-	workdir = '/mnt/jkavelaars/YTC_TEST/'
+	RB_model = model
+	ps1_dir = ps1
+
+def main():
+	parser = argparse.ArgumentParser(description="Build the non-stationary (.ns) catalog of every HPX catalog in a directory.")
+	parser.add_argument('workdir', nargs='?', default='/mnt/jkavelaars/YTC_TEST/', help="directory of the HPX *_cat.fits catalogs")
+	parser.add_argument('--ps1-dir', default='/mnt/jkavelaars/YTC_TEST/PS/', help="directory of the PS1 HPX *_STK.fits catalogs")
+	parser.add_argument('--registry', default=None, help="directory of the real/bogus models, see daomop_rb")
+	parser.add_argument('--model-version', type=int, default=None, help="version of the real/bogus model to score with, the latest by default")
+	parser.add_argument('--batch', type=int, default=8, help="number of catalogs scored together by each process")
+	parser.add_argument('--processes', type=int, default=1, help="number of catalogs processed at once")
+	parser.add_argument('--force', action='store_true', help="rebuild .ns catalogs that are newer than their input")
+	args = parser.parse_args()
+
+	workdir = os.path.join(args.workdir, '')
+	ps1 = os.path.join(args.ps1_dir, '')
 	fits_list = filter(lambda x: x.endswith('fits'), os.listdir(workdir))
-	fits_list = [workdir + i for i in fits_list]
+	fits_list = [workdir + i for i in sorted(fits_list)]
 	#fits_list = ['/sciproc/disk2/cfis/catalog_20170501/HPX_02559_RA_178.6_DEC_+35.7_cat.fits']
-	training_fits = 'HPX_03011_RA_09.8_DEC_+30.0_cat.fits'
-	RB_model = build_model(workdir + training_fits)
-	map(ns_cat, fits_list)
+	todo = [i for i in fits_list if args.force or not up_to_date(i)]
+	print "{0} of {1} catalogs are up to date".format(len(fits_list) - len(todo), len(fits_list))
+	if len(todo) == 0:
+		return
+
+	from . import rb_model
+	model = rb_model.load(args.registry or rb_model.REGISTRY, args.model_version)
+	print "Scoring with real/bogus model {0}".format(model)
+
+	start = time.time()
+	batches = [todo[i:i + args.batch] for i in range(0, len(todo), args.batch)]
+	if args.processes > 1:
+		# the model is sent to each worker once, when the worker starts.
+		pool = Pool(processes=args.processes, initializer=init_worker, initargs=(model, ps1))
+		results = pool.imap_unordered(ns_cats, batches)
+	else:
+		init_worker(model, ps1)
+		results = (ns_cats(i) for i in batches)
+	for batch in results:
+		for fits_tab, elapsed in batch:
+			print "{0}: {1:.1f}s".format(fits_tab, elapsed)
+	if args.processes > 1:
+		pool.close()
+		pool.join()
+	print "Processed {0} catalogs in {1:.1f}s".format(len(todo), time.time() - start)
 	
 if __name__ == '__main__':
 	main()
-	
-	
-	
-	
-	
-	    
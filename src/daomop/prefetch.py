@@ -0,0 +1,180 @@
+"""Priority scheduler for the cutout downloads of the validation viewer.
+
+Every download is a request with a key and one of three priorities: the candidate on screen, the next few candidates,
+and the rest of the pixel.  A fixed set of worker threads always runs the most urgent pending request, so what the
+reviewer is looking at is never queued behind the background prefetch of the pixel.  Pending requests can be raised
+or lowered as the reviewer moves, and cancelled once they are stale.
+"""
+import heapq
+import itertools
+import logging
+import threading
+
+CURRENT = 0
+LOOKAHEAD = 1
+BACKGROUND = 2
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+CANCELLED = 'cancelled'
+
+
+class Cancelled(Exception):
+    pass
+
+
+class Request(object):
+    """
+    A download submitted to the Scheduler, with the interface of a multiprocessing ApplyResult.
+    """
+
+    def __init__(self, key, function, args, priority):
+        self.key = key
+        self.function = function
+        self.args = args
+        self.priority = priority
+        self.state = PENDING
+        self.result = None
+        self.error = None
+        self._done = threading.Event()
+
+    def ready(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        self._done.wait(timeout)
+
+    def get(self, timeout=None):
+        """
+        The result of the request, waiting for it to run if needed.
+
+        :raise: the exception raised by the request, Cancelled if it was cancelled before running, or RuntimeError
+        if it has not finished within timeout.
+        """
+        self._done.wait(timeout)
+        if not self._done.is_set():
+            raise RuntimeError("request {} not done after {}s".format(self.key, timeout))
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class Scheduler(object):
+
+    def __init__(self, processes=5):
+        """
+        :param processes: number of worker threads.
+        """
+        self.condition = threading.Condition()
+        self._queue = []
+        self._requests = {}
+        self._count = itertools.count()
+        self._closed = False
+        self.workers = [threading.Thread(target=self._work, name="prefetch-{}".format(i)) for i in range(processes)]
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+    def __len__(self):
+        """
+        The number of requests pending or running.
+        """
+        return len(self._requests)
+
+    def _push(self, request):
+        heapq.heappush(self._queue, (request.priority, next(self._count), request))
+        self.condition.notify()
+
+    def submit(self, key, function, args=(), priority=BACKGROUND):
+        """
+        Queue function(*args) under key, unless a request for key is already pending or running, in which case that
+        request is returned, raised to priority if that is more urgent.
+
+        :rtype: Request
+        """
+        with self.condition:
+            request = self._requests.get(key)
+            if request is None:
+                request = self._requests[key] = Request(key, function, args, priority)
+                self._push(request)
+            elif request.state == PENDING and priority < request.priority:
+                request.priority = priority
+                self._push(request)
+            return request
+
+    def prioritise(self, key, priority):
+        """
+        Move a pending request to priority, more or less urgent.
+
+        :return: True if the request is pending.
+        """
+        with self.condition:
+            request = self._requests.get(key)
+            if request is None or request.state != PENDING:
+                return False
+            if request.priority != priority:
+                request.priority = priority
+                self._push(request)
+            return True
+
+    def cancel(self, key):
+        """
+        Drop a pending request.  Anyone waiting on it gets Cancelled; submitting the key again queues a new request.
+
+        :return: True if the request was pending.
+        """
+        with self.condition:
+            request = self._requests.get(key)
+            if request is None or request.state != PENDING:
+                return False
+            request.state = CANCELLED
+            request.error = Cancelled(key)
+            del self._requests[key]
+        request._done.set()
+        return True
+
+    def cancel_all(self):
+        with self.condition:
+            for key in list(self._requests):
+                self.cancel(key)
+
+    def close(self):
+        """
+        Cancel everything pending and stop the workers once they finish what they are running.
+        """
+        with self.condition:
+            self.cancel_all()
+            self._closed = True
+            self.condition.notify_all()
+
+    def _next(self):
+        """
+        The most urgent pending request, waiting for one if there is none.  Queue entries for requests that have
+        since been cancelled, run or moved to another priority are skipped.
+        """
+        with self.condition:
+            while not self._closed:
+                while self._queue:
+                    priority, _, request = heapq.heappop(self._queue)
+                    if request.state == PENDING and request.priority == priority:
+                        request.state = RUNNING
+                        return request
+                self.condition.wait()
+            return None
+
+    def _work(self):
+        while True:
+            request = self._next()
+            if request is None:
+                return
+            try:
+                request.result = request.function(*request.args)
+            except Exception as ex:
+                logging.debug("Request {} failed: {}".format(request.key, ex))
+                request.error = ex
+            with self.condition:
+                request.state = DONE
+                if self._requests.get(request.key) is request:
+                    del self._requests[request.key]
+            request._done.set()
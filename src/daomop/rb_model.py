@@ -0,0 +1,137 @@
+"""Registry of versioned real/bogus models used by ns_cfis to select the non-stationary sources worth linking.
+
+Each model is trained once, with `daomop_rb train`, and written to the registry as rb_vNNN.pkl together with the
+feature schema it was trained on and where it came from.  ns_cfis then loads a version by number (the latest by
+default) instead of training a new IsolationForest on every run, so every worker scores with the same model.
+"""
+import argparse
+import cPickle as pickle
+import datetime
+import logging
+import os
+import re
+
+import numpy
+import sklearn
+from sklearn.ensemble import IsolationForest
+
+from . import ns_cfis
+
+REGISTRY = os.path.join(os.path.expanduser('~'), '.daomop', 'rb_models')
+N_ESTIMATORS = 160
+_FILENAME = 'rb_v{:03d}.pkl'
+_PATTERN = re.compile(r'^rb_v(\d+)\.pkl$')
+
+
+class RBModel(object):
+    """
+    A trained real/bogus model with the feature schema and provenance it was trained with.
+    """
+
+    def __init__(self, model, features, version, training, random_state):
+        """
+        :param model: the fitted IsolationForest.
+        :param features: names of the feature columns, in the order the model expects them.
+        :param version: version number of the model in its registry.
+        :param training: names of the catalogs the model was trained on.
+        :param random_state: random seed used when training.
+        """
+        self.model = model
+        self.features = list(features)
+        self.version = version
+        self.training = list(training)
+        self.random_state = random_state
+        self.created = datetime.datetime.utcnow().isoformat()
+        self.sklearn_version = sklearn.__version__
+
+    def __str__(self):
+        return "v{:03d} trained {} on {} ({} features, sklearn {})".format(
+            self.version, self.created, ", ".join(self.training), len(self.features), self.sklearn_version)
+
+    def predict(self, feature):
+        """
+        Score a feature matrix, built with the ns_cfis.FEATURES schema.
+
+        :return: 1 for the sources that look real, -1 for the others, as IsolationForest.predict
+        """
+        if self.features != list(ns_cfis.FEATURES):
+            raise ValueError("model v{:03d} was trained on a different feature schema".format(self.version))
+        if feature.shape[1] != len(self.features):
+            raise ValueError("expected {} features, got {}".format(len(self.features), feature.shape[1]))
+        return self.model.predict(feature)
+
+
+def versions(registry=REGISTRY):
+    """
+    The version numbers of the models in a registry, in increasing order.
+    """
+    if not os.path.isdir(registry):
+        return []
+    return sorted(int(match.group(1)) for match in map(_PATTERN.match, os.listdir(registry)) if match)
+
+
+def train(catalogs, registry=REGISTRY, n_estimators=N_ESTIMATORS, random_state=0):
+    """
+    Train a model on the stationary sources of the catalogs and add it to the registry as the next version.
+
+    :param catalogs: HPX catalogs to train on.
+    :param registry: directory of the registry.
+    :param n_estimators: number of trees in the IsolationForest.
+    :param random_state: random seed, so the same catalogs always give the same model.
+    :rtype: RBModel
+    """
+    feature = numpy.concatenate([ns_cfis.fits_cat(catalog).real_feature for catalog in catalogs])
+    model = IsolationForest(n_estimators=n_estimators, random_state=random_state)
+    model.fit(feature)
+    existing = versions(registry)
+    rb_model = RBModel(model, ns_cfis.FEATURES, existing[-1] + 1 if existing else 1,
+                       [os.path.basename(catalog) for catalog in catalogs], random_state)
+    if not os.path.isdir(registry):
+        os.makedirs(registry)
+    filename = os.path.join(registry, _FILENAME.format(rb_model.version))
+    with open(filename + '.tmp', 'wb') as fobj:
+        pickle.dump(rb_model, fobj, pickle.HIGHEST_PROTOCOL)
+    os.rename(filename + '.tmp', filename)
+    logging.info("Trained {} on {} sources".format(rb_model, len(feature)))
+    return rb_model
+
+
+def load(registry=REGISTRY, version=None):
+    """
+    Load a model from the registry.
+
+    :param registry: directory of the registry.
+    :param version: version number, the latest if None.
+    :rtype: RBModel
+    """
+    if version is None:
+        existing = versions(registry)
+        if not existing:
+            raise IOError("no real/bogus model in {}, train one with daomop_rb train".format(registry))
+        version = existing[-1]
+    with open(os.path.join(registry, _FILENAME.format(version)), 'rb') as fobj:
+        return pickle.load(fobj)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train and list the versioned real/bogus models used by daomop_ns.")
+    parser.add_argument('--registry', default=REGISTRY, help="directory holding the models")
+    parser.add_argument('--verbose', '-v', action='store_true')
+    commands = parser.add_subparsers(dest='command')
+    train_parser = commands.add_parser('train', help="train a new version of the model")
+    train_parser.add_argument('catalogs', nargs='+', help="HPX catalogs whose stationary sources are the training set")
+    train_parser.add_argument('--n-estimators', type=int, default=N_ESTIMATORS)
+    train_parser.add_argument('--seed', type=int, default=0)
+    commands.add_parser('list', help="list the models in the registry")
+    args = parser.parse_args()
+    logging.basicConfig(level=args.verbose and logging.INFO or logging.WARNING)
+
+    if args.command == 'train':
+        print train(args.catalogs, registry=args.registry, n_estimators=args.n_estimators, random_state=args.seed)
+    else:
+        for version in versions(args.registry):
+            print load(args.registry, version)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+"""Persistent positional index of a reference catalog, for masking detections of known stationary sources.
+
+The index holds the reference sources as unit vectors in a KD-tree that is pickled next to
+the catalog it was built from, so later runs load it instead of rebuilding it.  Any catalog with RA/DEC columns can be
+indexed: the PS1 stacks used by ns_cfis are only the first user.
+"""
+import argparse
+import cPickle as pickle
+import logging
+import os
+
+import numpy
+from astropy.io import fits
+from scipy.spatial import cKDTree
+
+VERSION = 1
+SUFFIX = '.idx'
+
+
+def unit_vectors(ra, dec):
+    """
+    Unit vectors towards ra/dec, given in degrees.
+
+    :return: array of shape (n, 3)
+    """
+    ra = numpy.radians(numpy.asarray(ra, dtype='f8'))
+    dec = numpy.radians(numpy.asarray(dec, dtype='f8'))
+    return numpy.column_stack((numpy.cos(dec) * numpy.cos(ra), numpy.cos(dec) * numpy.sin(ra), numpy.sin(dec)))
+
+
+class ReferenceIndex(object):
+    """
+    A KD-tree over the unit vectors of a set of reference sources.
+    """
+
+    def __init__(self, ra, dec, source=None):
+        """
+        :param ra: right ascension of the reference sources, degrees.
+        :param dec: declination of the reference sources, degrees.
+        :param source: name of the catalog the sources came from, kept for provenance.
+        """
+        self.tree = cKDTree(unit_vectors(ra, dec))
+        self.source = source
+        self.version = VERSION
+
+    def __len__(self):
+        return self.tree.n
+
+    def within(self, ra, dec, radius):
+        """
+        Which positions have a reference source within radius.
+
+        :param ra: right ascension, degrees.
+        :param dec: declination, degrees.
+        :param radius: match radius, arcsec.
+        :return: boolean array, True where a reference source is within radius.
+        """
+        if len(self) == 0 or len(numpy.atleast_1d(ra)) == 0:
+            return numpy.zeros(len(numpy.atleast_1d(ra)), dtype=bool)
+        chord = 2 * numpy.sin(numpy.radians(radius / 3600.) / 2)
+        distance, _ = self.tree.query(unit_vectors(numpy.atleast_1d(ra), numpy.atleast_1d(dec)),
+                                      distance_upper_bound=chord)
+        return numpy.isfinite(distance)
+
+    def save(self, filename):
+        """
+        Write the index, first to a temporary file that is then renamed so readers never see a partial index.
+        """
+        with open(filename + '.tmp', 'wb') as fobj:
+            pickle.dump(self, fobj, pickle.HIGHEST_PROTOCOL)
+        os.rename(filename + '.tmp', filename)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'rb') as fobj:
+            index = pickle.load(fobj)
+        if getattr(index, 'version', None) != VERSION:
+            raise ValueError("{} is not a version {} reference index".format(filename, VERSION))
+        return index
+
+    @classmethod
+    def from_fits(cls, filename, ra_column='RA', dec_column='DEC'):
+        """
+        Index the sources of a FITS table.
+
+        :param filename: the FITS catalog, the table is in the first extension.
+        :param ra_column: name of the RA column, degrees.
+        :param dec_column: name of the DEC column, degrees.
+        """
+        with fits.open(filename, memmap=True) as hdulist:
+            data = hdulist[1].data
+            return cls(data.field(ra_column), data.field(dec_column), source=os.path.basename(filename))
+
+
+def get_index(filename, ra_column='RA', dec_column='DEC'):
+    """
+    The reference index of a FITS catalog, loaded from filename.idx if that is newer than the catalog, otherwise
+    built and saved there (when the directory is writable).
+
+    :param filename: the FITS catalog.
+    :param ra_column: name of the RA column.
+    :param dec_column: name of the DEC column.
+    :rtype: ReferenceIndex
+    """
+    index_filename = filename + SUFFIX
+    if os.path.exists(index_filename) and os.path.getmtime(index_filename) >= os.path.getmtime(filename):
+        try:
+            return ReferenceIndex.load(index_filename)
+        except (ValueError, EOFError, pickle.UnpicklingError) as ex:
+            logging.warning("Rebuilding {}: {}".format(index_filename, ex))
+    index = ReferenceIndex.from_fits(filename, ra_column=ra_column, dec_column=dec_column)
+    try:
+        index.save(index_filename)
+    except (IOError, OSError) as ex:
+        logging.warning("Could not save {}: {}".format(index_filename, ex))
+    return index
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the reference index of each catalog, saved as <catalog>.idx")
+    parser.add_argument('catalogs', nargs='+', help="FITS catalogs to index, e.g. the PS1 HPX *_STK.fits files.")
+    parser.add_argument('--ra-column', default='f0', help="name of the RA column (f0 in the PS1 stacks).")
+    parser.add_argument('--dec-column', default='f1', help="name of the DEC column (f1 in the PS1 stacks).")
+    parser.add_argument('--verbose', '-v', action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(level=args.verbose and logging.INFO or logging.WARNING)
+
+    for catalog in args.catalogs:
+        index = get_index(catalog, ra_column=args.ra_column, dec_column=args.dec_column)
+        logging.info("{}: {} sources".format(catalog, len(index)))
+
+
+if __name__ == '__main__':
+    main()
@@ -19,6 +19,9 @@ from cadcutils.exceptions import BadRequestException, AlreadyExistsException, No
 from numpy.linalg import LinAlgError
 from sip_tpv import pv_to_sip
 from . import util
+from . import coalesce
+from . import comparison
+from . import json_index
 import vospace
 from wcs import WCS
 
@@ -32,6 +35,8 @@ except:
     pass
 
 VOS_PROTOCOL = 'vos:'
+# the target of the lock nodes of create_lock, naming their holder.
+LOCK_TARGET = 'ivo://cadc.nrc.ca/user/{}'
 MAX_RETRY = 10
 MAXCOUNT = 30000
 _TARGET = "TARGET"
@@ -211,6 +216,29 @@ def get_comparison_image(coordinate, mjdate, minimum_time=None, radius=None):
     return tap_query(query)
 
 
+def get_comparison_images(coordinates, mjdates, minimum_time=None, radius=None):
+    """
+    The comparison exposure of each of a set of positions, found with one TAP query, see get_comparison_image.
+
+    :param coordinates: positions of the candidates.
+    :type coordinates: list(SkyCoord)
+    :param mjdates: epoch of each candidate.
+    :param minimum_time: exposures taken within this many days of a candidate are not used.
+    :param radius: radius of the cutout that must lie inside the exposure, degrees.
+    :return: for each candidate the row of its comparison exposure, with observationID and mjdate, or None.
+    """
+    if minimum_time is None:
+        minimum_time = comparison.MINIMUM_TIME
+    if radius is None:
+        radius = 0.0
+    if len(coordinates) == 0:
+        return []
+    ra = [coordinate.ra.degree for coordinate in coordinates]
+    dec = [coordinate.dec.degree for coordinate in coordinates]
+    table = tap_query(comparison.query(ra, dec, radius))
+    return comparison.resolve(table, ra, dec, mjdates, minimum_time=minimum_time, radius=radius)
+
+
 class MyPolygon(Polygon.Polygon):
 
     def __init__(self, *args, **kwargs):
@@ -415,7 +443,8 @@ class Artifact(object):
         """Get the artifact from VOSpace."""
         if not os.access(self.filename, os.F_OK):
             logging.info("Retrieving {} from VOSpace".format(self.uri))
-            return copy(self.uri, self.filename)
+            # exposures never change once written, so processes may share their download.
+            return copy(self.uri, self.filename, shared=self.ext == IMAGE_EXT)
         return 0
 
     @property
@@ -714,7 +743,7 @@ class FitsImage(FitsArtifact):
         fpt = tempfile.NamedTemporaryFile(suffix='.fits')
         cutout_list = []
         try:
-            content_disposition = copy(self.uri + cutout, fpt.name)
+            content_disposition = copy(self.uri + cutout, fpt.name, shared=True)
             cutout_list = decompose_content_decomposition(content_disposition)
         except BadRequestException as bre:
             if "No matching data" in str(bre):
@@ -724,7 +753,7 @@ class FitsImage(FitsArtifact):
             raise bre
         except NotFoundException:
             self._ext = ".fits"
-            copy(self.uri + cutout, fpt.name)
+            copy(self.uri + cutout, fpt.name, shared=True)
 
         fpt.seek(0)
         hdu_list = fits.open(fpt, scale_back=False)
@@ -910,6 +939,19 @@ class JSONCatalog(HPXCatalog):
         directory = os.path.join(CATALOG, catalog_dir)
         super(JSONCatalog, self).__init__(pixel, version=MOVING_TARGET_VERSION, ext=".json", catalog_dir=directory)
         self._json = None
+        self._index = None
+
+    @property
+    def index(self):
+        """
+        Random access to the candidates through the byte-offset index kept next to the Catalog file.
+
+        :rtype: json_index.IndexedCatalog
+        """
+        if self._index is None:
+            self.get()
+            self._index = json_index.IndexedCatalog(self.filename)
+        return self._index
 
     @property
     def json(self):
@@ -923,6 +965,46 @@ class JSONCatalog(HPXCatalog):
         return self._json
 
 
+class JSONSummary(JSONCatalog):
+    """
+    The summary written by the linker next to a JSONCatalog: the number of candidates and their (mjd, track) names.
+    """
+    def __init__(self, pixel, catalog_dir=None):
+        super(JSONSummary, self).__init__(pixel, catalog_dir=catalog_dir)
+        self._summary = None
+
+    @property
+    def uri(self):
+        return json_index.summary_name(super(JSONSummary, self).uri)
+
+    @property
+    def summary(self):
+        """
+        Return the summary, see json_index.summarise.  It is always downloaded again, as the linker replaces it
+        with the catalog when it is run again.
+        """
+        if self._summary is None:
+            copy(self.uri, self.filename)
+            with open(self.filename, 'r') as jobj:
+                self._summary = json.load(jobj)
+        return self._summary
+
+
+def put_tracks(pixel, catalog_dir, filename):
+    """
+    Upload the tracks written by the linker as the JSONCatalog of pixel, and their summary next to it, with the names
+    the viewer reads them under.
+
+    :param pixel: the healpix of the tracks.
+    :param catalog_dir: the QRUNID directory of the catalogs.
+    :param filename: the tracks, their summary is json_index.summary_name(filename).
+    """
+    uri = JSONCatalog(pixel, catalog_dir=catalog_dir).uri
+    make_path(uri)
+    copy(filename, uri)
+    copy(json_index.summary_name(filename), JSONSummary(pixel, catalog_dir=catalog_dir).uri)
+
+
 def set_tags_on_uri(uri, keys, values=None):
     node = vospace.client.get_node(uri)
     if values is None:
@@ -1237,10 +1319,77 @@ def make_link(source, destination):
         return True
 
 
+def create_lock(uri, holder):
+    """
+    Take a lock by creating a link node at uri whose target names the holder.  VOSpace refuses to create a node
+    that already exists, so of several processes trying at once only one takes the lock.
+
+    :param uri: the lock node, its container is made if needed.
+    :param holder: who takes the lock, e.g. a CADC user name.
+    :return: who holds the lock: holder if it was taken or already held, else whoever took it first.
+    """
+    for attempt in range(2):
+        try:
+            vospace.client.link(LOCK_TARGET.format(holder), uri)
+            return holder
+        except AlreadyExistsException:
+            break
+        except NotFoundException:
+            if attempt > 0:
+                raise
+            mkdir(os.path.dirname(uri))
+        except EnvironmentError as ex:
+            if ex.errno != errno.EEXIST:
+                raise
+            break
+    return lock_holder(uri)
+
+
+def lock_holder(uri):
+    """
+    Who holds the lock node at uri, see create_lock.
+
+    :return: the holder, None if nobody holds the lock.
+    """
+    try:
+        node = vospace.client.get_node(uri, force=True)
+    except NotFoundException:
+        return None
+    except EnvironmentError as ex:
+        if ex.errno in [404, errno.ENOENT]:
+            return None
+        raise
+    return node.target.rsplit('/', 1)[-1]
+
+
+def release_lock(uri):
+    """
+    Release the lock node at uri, see create_lock.
+    """
+    try:
+        vospace.client.delete(uri)
+    except NotFoundException:
+        pass
+
+
 def listdir(directory, force=False):
     return vospace.client.listdir(directory, force=force)
 
 
+def list_sizes(directory):
+    """
+    The size of each file of a directory, from a single request.
+
+    :return: dict of size by file name, None for a file whose size is not known.
+    """
+    node = vospace.client.get_node(directory, limit=None, force=True)
+    sizes = {}
+    for child in node.node_list:
+        length = child.props.get('length', None)
+        sizes[child.name] = length is not None and int(length) or None
+    return sizes
+
+
 def list_dbimages(dbimages=None):
     if dbimages is None:
         dbimages = DBIMAGES
@@ -1390,12 +1539,24 @@ def isfile(uri):
         return False
 
 
-def copy(source, destination):
+def copy(source, destination, shared=False):
     """Copy a file to/from VOSpace. With up to 10 retries on errors,
 
+    Shared downloads go through the host-wide cache, see coalesce, so that processes asking for the same file at the
+    same time transfer it once.
+
+    :param shared: download through the shared cache, which may serve a copy up to coalesce.MAX_AGE old; only for
+    files that never change, like exposures and their cutouts.
     :return: content disposition value from data service
     :rtype: basestring
     """
+    if shared and coalesce.SHARED_CACHE and source.startswith(VOS_PROTOCOL) and \
+            not destination.startswith(VOS_PROTOCOL):
+        return coalesce.fetch(source, destination, _copy)
+    return _copy(source, destination)
+
+
+def _copy(source, destination):
     count = 1
     while True:
         try:
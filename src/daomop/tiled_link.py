@@ -0,0 +1,208 @@
+"""Link a large stacked ns catalog in overlapping spatial tiles so each linker only holds a bounded number of rows.
+
+The field is split into core tiles, each tile is linked together with a margin of max_v times the time baseline of
+the catalog, so any track that starts in a core lies entirely inside the tile that owns that core.  Only the tracks
+whose first detection falls inside the core are kept, which merges the overlap zones without linking a track twice.
+"""
+import time
+import numpy as np
+from astropy.io import fits as pyfits
+from multiprocessing import Pool
+
+from . import CFIS_Link_stacked as link
+from .kdtree_link import deduplicate
+
+# memory, in MB, that the rows of one tile may use.
+MEMORY = 512.
+
+
+def row_limit(memory, dtype):
+    """
+    Number of catalog rows a tile may hold.  The linkers copy the rows they are given about once more while
+    searching, so the budget is shared between two copies.
+
+    :param memory: memory budget of one tile, in MB.
+    :param dtype: dtype of the ns catalog rows.
+    :return: maximum number of rows in a tile.
+    """
+    return max(int(memory * 1024 ** 2 / (2 * dtype.itemsize)), 1)
+
+
+def split(x, y, box, margin, limit, min_size):
+    """
+    Recursively halve a box until the detections inside each box, plus its margin, fit into the row limit.
+
+    :param x: tangent plane x of the detections, in degrees.
+    :param y: tangent plane y of the detections, in degrees.
+    :param box: the box to split, (x0, x1, y0, y1).
+    :param margin: width of the overlap added around each box, in degrees.
+    :param limit: maximum number of detections in a box plus margin.
+    :param min_size: boxes are not split below this size, in degrees, even when they hold more than limit rows.
+    :return: list of the core boxes.
+    """
+    x0, x1, y0, y1 = box
+    inside = (x >= x0 - margin) & (x < x1 + margin) & (y >= y0 - margin) & (y < y1 + margin)
+    if inside.sum() <= limit or max(x1 - x0, y1 - y0) / 2. < min_size:
+        return [box]
+    x, y = x[inside], y[inside]
+    if x1 - x0 >= y1 - y0:
+        xm = (x0 + x1) / 2.
+        halves = [(x0, xm, y0, y1), (xm, x1, y0, y1)]
+    else:
+        ym = (y0 + y1) / 2.
+        halves = [(x0, x1, y0, ym), (x0, x1, ym, y1)]
+    return [core for half in halves for core in split(x, y, half, margin, limit, min_size)]
+
+
+class TileLineSearch(link.SearchMovingObjects):
+    """
+    The line search of one tile: only the lines of the whole field that can reach a detection of the tile are swept,
+    so each tile costs its share of the lines at every angle, steep ones included, and finds what the whole field
+    search finds along them.
+    """
+
+    def lines(self, ang):
+        slope = np.tan(np.radians(ang))
+        # declination at self.cra of the line through each detection, widened by the search radius of searchline.
+        offsets = np.array(self.sns['Y_WORLD'], dtype='f8') - slope * (np.array(self.sns['X_WORLD'], dtype='f8') -
+                                                                       self.cra)
+        tolerance = link.sr / 3600. * (slope ** 2 + 1) ** 0.5
+        return [(sl, ldec) for sl, ldec in link.SearchMovingObjects.lines(self, ang)
+                if offsets.min() - tolerance <= ldec <= offsets.max() + tolerance]
+
+
+def link_tile(args):
+    """
+    Link the detections of one tile.
+
+    :param args: (engine, workdir, healpix, nsfile, rows, core, margin, allanglist), rows are the indices of the
+    tile's detections in the ns catalog and core is the tile's core box in tangent plane degrees.
+    :return: the tracks that start in the core of the tile, in the mjdalltracks layout.
+    """
+    engine, workdir, healpix, nsfile, rows, core, margin, allanglist = args
+    if engine == 'line':
+        linker = TileLineSearch(workdir, healpix)
+    else:
+        linker = link.get_engine(engine)(workdir, healpix)
+    linker.sns = pyfits.open(nsfile, memmap=True)[1].data[rows]
+    x0, x1, y0, y1 = core
+    cosdec = np.cos(np.radians(linker.cdec))
+    linker.link(False, allanglist)
+    linker.CleanTracks_array()
+    ra0, dec0 = float(healpix.split('_')[0]), float(healpix.split('_')[1])
+    mjdalltracks = {}
+    for mjd, tracks in linker.mjdalltracks.items():
+        for objid, track in tracks.items():
+            x = (track['ra'][0] - ra0) * cosdec
+            y = track['dec'][0] - dec0
+            if x0 <= x < x1 and y0 <= y < y1:
+                mjdalltracks.setdefault(mjd, {})[objid] = track
+    return mjdalltracks
+
+
+def merge(tiles):
+    """
+    Combine the tracks of the tiles, dropping any track that is a subset of a longer one.
+
+    :param tiles: list of the mjdalltracks of each tile.
+    :return: the combined mjdalltracks.
+    """
+    tracks = {}
+    for mjdalltracks in tiles:
+        for mjd, objects in mjdalltracks.items():
+            for objid, track in objects.items():
+                key = tuple(sorted(zip(track['mjd'], [(round(ra, 7), round(dec, 7))
+                                                      for ra, dec in zip(track['ra'], track['dec'])])))
+                tracks[key] = (mjd, objid, track)
+    mjdalltracks = {}
+    for key in deduplicate(tracks.keys()):
+        mjd, objid, track = tracks[key]
+        mjdalltracks.setdefault(mjd, {})[objid] = track
+    return mjdalltracks
+
+
+class TiledLinker(object):
+    """
+    Link a stacked ns catalog tile by tile with one of the CFIS_Link_stacked engines.
+
+    The interface matches SearchMovingObjects: call Searching, then CleanTracks_array, and the tracks are left in
+    mjdalltracks.
+    """
+
+    def __init__(self, workdir, healpix, engine='line', memory=MEMORY, processes=1):
+        """
+        :param workdir: directory holding the ns catalog.
+        :param healpix: 'ra_dec_pixel' of the field centre.
+        :param engine: the linking engine used on each tile, one of CFIS_Link_stacked.ENGINES
+        :param memory: memory budget of each tile, in MB.
+        :param processes: number of tiles linked at once.
+        """
+        self.workdir = workdir
+        self.healpix = healpix
+        self.engine = engine
+        self.memory = memory
+        self.processes = processes
+        self.tiles = []
+        self.mjdalltracks = {}
+
+    def layout(self, nsfile):
+        """
+        Plan the tiles of a catalog.
+
+        :param nsfile: the stacked ns catalog.
+        :return: list of (rows, core) of each tile, rows index the catalog and core is the box in tangent plane degrees.
+        """
+        ft = pyfits.open(nsfile, memmap=True)[1].data
+        rows = np.flatnonzero(link.usable(ft))
+        cra, cdec = float(self.healpix.split('_')[0]), float(self.healpix.split('_')[1])
+        cosdec = np.cos(np.radians(cdec))
+        x = (np.array(ft['X_WORLD'][rows], dtype='f8') - cra) * cosdec
+        y = np.array(ft['Y_WORLD'][rows], dtype='f8') - cdec
+        mjd = np.array(ft['mid_mjdate'][rows], dtype='f8')
+        mjdlist = np.unique(mjd.astype(int))
+        self.midmjd = mjdlist[int(len(mjdlist) / 2.)] if len(mjdlist) else None
+        margin = link.max_v * (mjd.max() - mjd.min()) if len(rows) else 0.
+        limit = row_limit(self.memory, ft.dtype)
+        box = (x.min(), np.nextafter(x.max(), np.inf), y.min(), np.nextafter(y.max(), np.inf)) if len(rows) else \
+            (0., 0., 0., 0.)
+        cores = split(x, y, box, margin, limit, max(margin, link.sr / 3600.))
+        self.margin = margin
+        tiles = []
+        for x0, x1, y0, y1 in cores:
+            inside = (x >= x0 - margin) & (x < x1 + margin) & (y >= y0 - margin) & (y < y1 + margin)
+            if inside.any():
+                tiles.append((rows[inside], (x0, x1, y0, y1)))
+        print '[%s] Split %s detections into %s tiles of at most %s rows, margin %.4f degree' % (
+            time.strftime("%D %H:%M:%S"), len(rows), len(tiles), limit, margin)
+        return tiles
+
+    def Searching(self, multi, nsfile, ratelist=None):
+        """
+        Link every tile of the ns catalog, processes tiles at a time.  multi is accepted for compatibility with
+        SearchMovingObjects, the tiles themselves are linked in a single process each.
+        """
+        t1 = time.time()
+        self.tiles = self.layout(nsfile)
+        allanglist = None
+        if self.engine == 'line':
+            finder = link.SearchMovingObjects(self.workdir, self.healpix)
+            finder.midmjd = self.midmjd
+            allanglist = finder.angles(nsfile, ratelist)
+        jobs = [(self.engine, self.workdir, self.healpix, nsfile, rows, core, self.margin, allanglist)
+                for rows, core in self.tiles]
+        results = []
+        if self.processes > 1:
+            pool = Pool(processes=self.processes)
+            # one batch at a time, so no more than processes tiles are held in memory.
+            for i in range(0, len(jobs), self.processes):
+                results.extend(pool.map(link_tile, jobs[i:i + self.processes], chunksize=1))
+            pool.close()
+            pool.join()
+        else:
+            results = [link_tile(job) for job in jobs]
+        self.results = results
+        print '[%s] Linked %s tiles. Total time: %s' % (time.strftime("%D %H:%M:%S"), len(jobs), time.time() - t1)
+
+    def CleanTracks_array(self):
+        self.mjdalltracks = merge(self.results)
+
@@ -0,0 +1,178 @@
+"""Rendered display tiles of the cutouts, shared by all the validation sessions of a web_validate server.
+
+A tile is a cutout scaled once to 8 bits with the display stretch, together with its header for the WCS and the
+keywords shown to the reviewer, and rendered to PNG through a colour map when served over HTTP.  Tiles are kept in a
+single byte-bounded cache per server, keyed by (cutout, stretch, colour map), and served at /tiles/ as the thumbnails
+of the candidate's observations, so a cutout already seen by any reviewer is shown there without downloading,
+decoding or scaling its FITS data again.  The viewer itself displays the FITS data, for its pixel values and cuts.
+"""
+import hashlib
+import struct
+import zlib
+
+import numpy
+from astropy.io import fits
+from astropy.visualization import ZScaleInterval, MinMaxInterval
+
+from .cutout_cache import CutoutCache
+
+TILE_BYTES = 256 * 1024 ** 2
+MAX_AGE = 24 * 3600
+STRETCHES = {'zscale': ZScaleInterval, 'minmax': MinMaxInterval}
+
+
+class Tile(object):
+    """
+    A cutout scaled to uint8 for display.
+    """
+
+    def __init__(self, data, header, cmap='gray'):
+        """
+        :param data: the scaled pixels, uint8.
+        :param header: the header of the cutout.
+        :param cmap: name of the colour map used for the PNG.
+        """
+        self.data = data
+        self.header = header
+        self.cmap = cmap
+        self._png = None
+        self._etag = None
+        self.on_encoded = None
+
+    @property
+    def nbytes(self):
+        """
+        The size of the tile, counting its PNG only once it has been encoded.
+        """
+        return self.data.nbytes + len(self.header.tostring()) + (self._png is not None and len(self._png) or 0)
+
+    @property
+    def hdu(self):
+        """
+        The tile as an ImageHDU, to load into a viewer with its cut levels set to 0, 255.
+        """
+        return fits.ImageHDU(data=self.data, header=self.header)
+
+    @property
+    def png(self):
+        if self._png is None:
+            self._png = png(colormap(self.cmap)[self.data])
+            if self.on_encoded is not None:
+                self.on_encoded()
+        return self._png
+
+    @property
+    def etag(self):
+        if self._etag is None:
+            self._etag = '"{}"'.format(hashlib.sha1(self.png).hexdigest())
+        return self._etag
+
+
+def scale(data, stretch='zscale'):
+    """
+    Scale an image to uint8 between the limits of the stretch, NaN to 0.
+    """
+    data = numpy.asarray(data, dtype='f4')
+    finite = numpy.isfinite(data)
+    if not finite.any():
+        return numpy.zeros(data.shape, dtype='u1')
+    vmin, vmax = STRETCHES[stretch]().get_limits(data[finite])
+    scaled = (numpy.where(finite, data, vmin) - vmin) * (255. / max(vmax - vmin, 1e-12))
+    return numpy.clip(scaled, 0, 255).astype('u1')
+
+
+def render(hdu, stretch='zscale', cmap='gray'):
+    """
+    :param hdu: the image HDU of the cutout.
+    :rtype: Tile
+    """
+    return Tile(scale(hdu.data, stretch), hdu.header.copy(), cmap)
+
+
+def colormap(name):
+    """
+    The colour map as a (256, 3) uint8 look-up table, from ginga for any name but gray.
+    """
+    if name == 'gray':
+        return numpy.repeat(numpy.arange(256, dtype='u1')[:, None], 3, axis=1)
+    from ginga import cmap
+    return numpy.round(numpy.array(cmap.get_cmap(name).clst) * 255).astype('u1')
+
+
+def png(rgb):
+    """
+    Encode an RGB image, a (ny, nx, 3) uint8 array with row 0 at the bottom as in FITS, as PNG.
+    """
+    ny, nx = rgb.shape[:2]
+    rows = numpy.zeros((ny, 1 + 3 * nx), dtype='u1')
+    rows[:, 1:] = rgb[::-1].reshape(ny, 3 * nx)
+
+    def chunk(kind, content):
+        return (struct.pack('>I', len(content)) + kind + content +
+                struct.pack('>I', zlib.crc32(kind + content) & 0xffffffff))
+
+    return ('\x89PNG\r\n\x1a\n' +
+            chunk('IHDR', struct.pack('>IIBBBBB', nx, ny, 8, 2, 0, 0, 0)) +
+            chunk('IDAT', zlib.compress(rows.tostring(), 6)) +
+            chunk('IEND', ''))
+
+
+def response(tile, if_none_match=None, max_age=MAX_AGE):
+    """
+    The HTTP response serving a tile as PNG: tiles never change, so clients and proxies may keep them for max_age
+    and revalidate them by ETag.
+
+    :return: status, headers, body
+    """
+    headers = {'Content-Type': 'image/png',
+               'Cache-Control': 'public, max-age={:d}'.format(max_age),
+               'ETag': tile.etag}
+    if if_none_match is not None and tile.etag in [tag.strip() for tag in if_none_match.split(',')]:
+        return 304, headers, ''
+    return 200, headers, tile.png
+
+
+class TileCache(object):
+    """
+    The tiles of a server, shared by its sessions.
+    """
+
+    def __init__(self, max_bytes=TILE_BYTES):
+        self.cache = CutoutCache(memory=max_bytes, disk=0, size=lambda tile: tile.nbytes)
+
+    def __str__(self):
+        return str(self.cache)
+
+    def has(self, key, stretch='zscale', cmap='gray'):
+        return (key, stretch, cmap) in self.cache
+
+    def get(self, key, hdu, stretch='zscale', cmap='gray'):
+        """
+        The tile of a cutout, rendered from hdu() only if no session has rendered it before.
+
+        :param key: key of the cutout, see Downloader.image_key
+        :param hdu: function returning the image HDU of the cutout.
+        :param stretch: one of STRETCHES.
+        :param cmap: colour map name.
+        :rtype: Tile
+        """
+        cache_key = (key, stretch, cmap)
+
+        def fetch():
+            tile = render(hdu(), stretch, cmap)
+            # the PNG is encoded when first served: count it in the cache from then on.
+            tile.on_encoded = lambda: self.cache.resize(cache_key)
+            return tile
+
+        return self.cache.get(cache_key, fetch)
+
+    def find(self, key, stretch='zscale', cmap='gray'):
+        """
+        The tile of a cutout if a session has rendered it, else None.  Not counted in the stats of the cache.
+
+        :rtype: Tile
+        """
+        return self.cache.peek((key, stretch, cmap))
+
+
+TILES = TileCache()
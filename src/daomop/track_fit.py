@@ -0,0 +1,145 @@
+"""Fit great-circle motion to every linked track at once and prune the tracks that do not move like an object.
+
+Each track is projected onto the plane tangent to the sky at its mean position, where great circles are straight
+lines, and x, y are fitted as linear functions of time.  All tracks are fitted together as padded arrays, so a
+catalog with many thousands of tracks costs a handful of numpy operations.
+
+The fits are written next to the tracks, HPX_..._bk.json has HPX_..._bk.fit.json, so the tracks file keeps the
+layout the viewer reads.  The sidecar holds {mjd: {track: {'rms', 'chi2', 'rate', 'angle', 'dmag', 'rank'}}}, with
+rms in arcsec, rate in arcsec per hour, angle in degrees and rank 0 for the best fitting track.
+"""
+import json
+import os
+import time
+
+import numpy as np
+
+from . import CFIS_Link_stacked as link
+
+# fit results kept for each track.
+FIELDS = ['rms', 'chi2', 'rate', 'angle', 'dmag', 'rank']
+FIT = '.fit.json'
+
+
+def padded(records):
+    """
+    Copy the detections of the tracks into padded arrays.
+
+    :param records: list of tracks, in the mjdalltracks layout.
+    :return: ra, dec, mjd and mag arrays of shape (len(records), longest track) and the mask of the filled cells.
+    """
+    n = max([len(record['mjd']) for record in records] + [1])
+    ra, dec, mjd, mag = [np.zeros((len(records), n)) for _ in range(4)]
+    mask = np.zeros((len(records), n), dtype=bool)
+    for i, record in enumerate(records):
+        k = len(record['mjd'])
+        ra[i, :k] = record['ra']
+        dec[i, :k] = record['dec']
+        mjd[i, :k] = record['mjd']
+        mag[i, :k] = record['mag']
+        mask[i, :k] = True
+    return ra, dec, mjd, mag, mask
+
+
+def fit(ra, dec, mjd, mag, mask):
+    """
+    Least squares fit of linear motion in the gnomonic projection about each track's mean position.
+
+    :param ra: right ascension, degrees, shape (n_tracks, n_detections)
+    :param dec: declination, degrees, same shape.
+    :param mjd: time of each detection, same shape.
+    :param mag: magnitude of each detection, same shape.
+    :param mask: True for the cells that hold a detection.
+    :return: dict of arrays, one value per track: rms (arcsec), chi2 (per degree of freedom, using
+    astrometryerror), rate (arcsec per hour), angle (degrees, in the linker's RA/Dec convention) and dmag
+    (standard deviation of the magnitudes).
+    """
+    w = mask.astype('f8')
+    n = w.sum(axis=1)
+    a = np.radians(ra)
+    d = np.radians(dec)
+    # tangent point at the mean position of each track, measuring RA from the first detection to handle 0/360.
+    da = np.angle(np.exp(1j * (a - a[:, :1])))
+    a0 = a[:, :1] + ((da * w).sum(axis=1) / n)[:, np.newaxis]
+    d0 = ((d * w).sum(axis=1) / n)[:, np.newaxis]
+    cosc = np.sin(d0) * np.sin(d) + np.cos(d0) * np.cos(d) * np.cos(a - a0)
+    x = np.degrees(np.cos(d) * np.sin(a - a0) / cosc) * w
+    y = np.degrees((np.cos(d0) * np.sin(d) - np.sin(d0) * np.cos(d) * np.cos(a - a0)) / cosc) * w
+    t = (mjd - ((mjd * w).sum(axis=1) / n)[:, np.newaxis]) * w
+
+    st = t.sum(axis=1)
+    stt = (t * t).sum(axis=1)
+    det = n * stt - st ** 2
+    det = np.where(det > 0, det, 1.)
+    vx = (n * (t * x).sum(axis=1) - st * x.sum(axis=1)) / det
+    vy = (n * (t * y).sum(axis=1) - st * y.sum(axis=1)) / det
+    x0 = (x.sum(axis=1) - vx * st) / n
+    y0 = (y.sum(axis=1) - vy * st) / n
+    rx = (x - x0[:, np.newaxis] - vx[:, np.newaxis] * t) * w
+    ry = (y - y0[:, np.newaxis] - vy[:, np.newaxis] * t) * w
+    squares = (rx ** 2 + ry ** 2).sum(axis=1)
+    dof = np.maximum(2 * n - 4, 1)
+
+    mmean = (mag * w).sum(axis=1) / n
+    return {'rms': np.sqrt(squares / n) * 3600.,
+            'chi2': squares / link.astrometryerror ** 2 / dof,
+            'rate': np.hypot(vx, vy) * 3600. / 24.,
+            'angle': np.degrees(np.arctan2(vy, vx / np.cos(d0[:, 0]))),
+            'dmag': np.sqrt((((mag - mmean[:, np.newaxis]) * w) ** 2).sum(axis=1) / n)}
+
+
+def prune(mjdalltracks, max_residual=None, max_dmag=None, drop=True):
+    """
+    Fit every track and drop those beyond the thresholds.
+
+    Tracks are ranked by chi2, rank 0 is the best fitting track.
+
+    :param mjdalltracks: the tracks, in the mjdalltracks layout.
+    :param max_residual: largest rms residual kept, arcsec, defaults to crit_residual.
+    :param max_dmag: largest magnitude scatter kept, by default the magnitudes are not checked beyond the max_dm the
+    linker already applies between detections.
+    :param drop: if False the tracks beyond the thresholds are kept, ranked after all the others.
+    :return: the tracks that are kept, in the mjdalltracks layout, and the fit of each, as {mjd: {track: fit}}.
+    """
+    max_residual = link.crit_residual if max_residual is None else max_residual
+    keys = [(mjd, objid) for mjd in mjdalltracks for objid in mjdalltracks[mjd]]
+    if len(keys) == 0:
+        return {}, {}
+    records = [mjdalltracks[mjd][objid] for mjd, objid in keys]
+    result = fit(*padded(records))
+    good = result['rms'] <= max_residual
+    if max_dmag is not None:
+        good &= result['dmag'] <= max_dmag
+    # the tracks that pass come first, then by goodness of fit.
+    result['rank'] = np.empty(len(keys), dtype=int)
+    result['rank'][np.lexsort((result['chi2'], ~good))] = np.arange(len(keys))
+
+    pruned = {}
+    fits = {}
+    for i, (mjd, objid) in enumerate(keys):
+        if drop and not good[i]:
+            continue
+        pruned.setdefault(mjd, {})[objid] = mjdalltracks[mjd][objid]
+        fits.setdefault(mjd, {})[objid] = dict((field, result[field][i].item()) for field in FIELDS)
+    print '[%s] %s of %s tracks have rms <= %s arcsec%s' % (
+        time.strftime("%D %H:%M:%S"), good.sum(), len(keys), max_residual,
+        '' if max_dmag is None else ' and magnitude scatter <= %s' % max_dmag)
+    return pruned, fits
+
+
+def fit_name(filename):
+    """
+    The name of the fits of a candidate JSON file, next to it: HPX_..._bk.json has HPX_..._bk.fit.json.
+    """
+    if filename.endswith('.json'):
+        filename = filename[:-len('.json')]
+    return filename + FIT
+
+
+def write_fits(fits, filename):
+    """
+    Write the fits returned by prune.
+    """
+    with open(filename + '.tmp', 'w') as fobj:
+        json.dump(fits, fobj)
+    os.rename(filename + '.tmp', filename)
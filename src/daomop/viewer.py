@@ -11,7 +11,13 @@ from mp_ephem import ObsRecord
 import tempfile
 from . import candidate
 from . import downloader
+from . import examined
+from . import prefetch
 from . import storage
+from . import tiles
+import tornado.escape
+import tornado.ioloop
+import tornado.web
 from ginga import AstroImage
 from ginga.web.pgw import ipg, Widgets, Viewers
 from ginga.misc import log
@@ -26,6 +32,13 @@ LEGEND = 'Keyboard Shortcuts: \n' \
          'esc: reset keyboard mode\n'
 ACCEPTED_DIRECTORY = 'accepted'
 PROCESSES = 5
+LOOKAHEAD = 3
+STRETCH = 'zscale'
+CMAP = 'gray'
+THUMBNAILS = 3
+# the cutouts, and their rendered tiles, are shared by all the sessions of the server.
+DOWNLOADER = downloader.Downloader()
+COMPARISON_RADIUS = 120 / 3600.0
 
 
 class ConsoleBoxStream(object):
@@ -61,7 +74,8 @@ class ValidateGui(ipg.EnhancedCanvasView):
 
         self.console_box = Widgets.TextArea(editable=False)
 
-        self.downloader = downloader.Downloader()
+        self.downloader = DOWNLOADER
+        self.prefetcher = prefetch.Scheduler(processes=PROCESSES)
         self.pool = Pool(processes=PROCESSES)
         self.lock = Lock()
         self.image_list = {}
@@ -97,10 +111,13 @@ class ValidateGui(ipg.EnhancedCanvasView):
         self.override = None
         self.qrun_id = None
         self.length_check = False
+        self.examined = None
 
         # GUI elements
         self.pixel_base = 1.0
         self.readout = Widgets.Label("")
+        # the observations of the candidate, as tiles shared by all the sessions of the server
+        self.thumbnails = [Widgets.Image() for _ in range(THUMBNAILS)]
         self.header_box = Widgets.TextArea(editable=False)
         self.accept = Widgets.Button("Accept")
         self.reject = Widgets.Button("Reject")
@@ -117,8 +134,11 @@ class ValidateGui(ipg.EnhancedCanvasView):
         self.legend.set_text(LEGEND)
         self.build_gui(self.top)
         self.comparison_images = {}
+        self.comparison_exposures = {}
         self.null_observation = {}
         self.next_image = None
+        self.candidate_list = []
+        self.candidate_index = {}
 
     def build_gui(self, container):
         """
@@ -139,6 +159,10 @@ class ValidateGui(ipg.EnhancedCanvasView):
         viewer_widget = Viewers.GingaViewerWidget(viewer=self)
         viewer_vbox.add_widget(viewer_widget, stretch=1)
         viewer_vbox.add_widget(self.readout, stretch=0)  # text directly below the viewer for coordinate display
+        thumbnails_hbox = Widgets.HBox()
+        for thumbnail in self.thumbnails:
+            thumbnails_hbox.add_widget(thumbnail)
+        viewer_vbox.add_widget(thumbnails_hbox, stretch=0)
 
         self.set_callback('cursor-changed', self.motion_cb)
 
@@ -251,8 +275,10 @@ class ValidateGui(ipg.EnhancedCanvasView):
                 while self.ast_exists():
                     self.candidate = self.candidates.next()
 
+                self.prioritise()
                 self.logger.info("Loading {}...".format(self.candidate[0].provisional_name))
                 self.load()
+                self.logger.info("Cutout cache: {}".format(self.downloader.cache))
                 self.buttons_on()
 
             except Exception as ex:
@@ -273,9 +299,10 @@ class ValidateGui(ipg.EnhancedCanvasView):
 
         :return True is the .ast files exists and there is no viewing override, False otherwise
         """
-        if self.length_check and self.candidate[0].provisional_name + '.ast' in storage.listdir(
-                os.path.join(os.path.dirname(storage.DBIMAGES), storage.CATALOG, self.qrun_id,
-                             self.candidates.catalog.catalog.dataset_name), force=True):
+        if self.length_check and not self.examined.is_examined(self.healpix, self.candidate[0].provisional_name):
+            # another reviewer may have examined it since the index was read.
+            self.update_examined()
+        if self.length_check and self.examined.is_examined(self.healpix, self.candidate[0].provisional_name):
 
             if self.override == self.candidate[0].provisional_name:
                 self.logger.info("Candidate {} being overridden for viewing."
@@ -296,6 +323,7 @@ class ValidateGui(ipg.EnhancedCanvasView):
             self.obs_number = 0
             self.candidate = self.candidates.previous()
             if self.candidate is not None:
+                self.prioritise()
                 self.load()
             self.buttons_on()
 
@@ -323,9 +351,60 @@ class ValidateGui(ipg.EnhancedCanvasView):
             self.storage_list = storage.listdir(os.path.join(os.path.dirname(storage.DBIMAGES),
                                                              storage.CATALOG,
                                                              self.qrun_id), force=True)
+            self.examined = self.load_examined()
             self.load_json.set_enabled(True)
             self.logger.info("QRUNID set to {}.".format(self.qrun_id))
 
+    @property
+    def examined_uri(self):
+        return os.path.join(os.path.dirname(storage.DBIMAGES), storage.CATALOG, self.qrun_id, examined.FILENAME)
+
+    def load_examined(self):
+        """
+        Get the examined-state index of the QRUNID from VOSpace, or start an empty one if there is none yet.
+
+        :rtype: examined.ExaminedIndex
+        """
+        filename = os.path.join(tempfile.gettempdir(), "{}_{}".format(self.qrun_id, examined.FILENAME))
+        if os.path.exists(filename):
+            os.remove(filename)
+        if examined.FILENAME in self.storage_list:
+            try:
+                storage.copy(self.examined_uri, filename)
+            except Exception as ex:
+                self.logger.warning("Failed to get {}, rebuilding it: {}".format(self.examined_uri, str(ex)))
+        return examined.ExaminedIndex(filename)
+
+    def save_examined(self):
+        """
+        Write the examined-state index and upload it to VOSpace, merged with the copy there so the marks other
+        reviewers uploaded since it was read are kept.
+        """
+        remote = self.examined.filename + '.remote'
+        try:
+            storage.copy(self.examined_uri, remote)
+        except NotFoundException:
+            pass
+        with self.lock:
+            if os.path.exists(remote):
+                self.examined.merge(examined.ExaminedIndex(remote))
+                os.remove(remote)
+            self.examined.save()
+        storage.copy(self.examined.filename, self.examined_uri)
+
+    def update_examined(self):
+        """
+        Add the .ast files in the VOSpace directory of the current candidate set to the examined index.
+        """
+        sub_directory = storage.listdir(os.path.join(os.path.dirname(storage.DBIMAGES),
+                                                     storage.CATALOG,
+                                                     self.qrun_id,
+                                                     self.candidates.catalog.catalog.dataset_name),
+                                        force=True)
+        with self.lock:
+            self.examined.update(self.healpix, [filename[:-len('.ast')] for filename in sub_directory
+                                                if filename.endswith('.ast')])
+
     def lookup(self):
         """
         Determines which healpix values is to be examined next. The healpix value is eventually used when creating the
@@ -343,13 +422,17 @@ class ValidateGui(ipg.EnhancedCanvasView):
             sub_directory = filename[:-len(storage.MOVING_TARGET_VERSION + '.json')]
             count += 1
 
-            # if the file extension is in the filename, then it is a file containing candidate information
-            if storage.MOVING_TARGET_VERSION in filename:
+            # if the file extension ends the filename, then it is a file containing candidate information
+            if filename.endswith(storage.MOVING_TARGET_VERSION + '.json'):
                 x = re.match('(?P<hpx>HPX_)(?P<healpix>\d{5})(?P<leftover>_.*)', filename)
 
                 if self.healpix is not None and int(x.group('healpix')) < self.healpix:
                     continue  # skipping over json files until the specified catalog has been reached
 
+                # the examined index knows this set is done, no need to open it
+                elif self.override is None and self.examined.is_examined(int(x.group('healpix'))):
+                    continue
+
                 # if the sub directory exists, we will have to check that all the candidates have been investigated
                 elif sub_directory in self.storage_list:
                     self.length_check = True
@@ -387,7 +470,7 @@ class ValidateGui(ipg.EnhancedCanvasView):
         self.candidates = [self.candidate]
         self.next_set.set_enabled(False)
         self.previous_set.set_enabled(False)
-        self._download_obs_records(self.candidate)
+        self._download_obs_records(self.candidate, priority=prefetch.CURRENT)
         self.load(0)
 
     def override_set(self, event):
@@ -419,122 +502,189 @@ class ValidateGui(ipg.EnhancedCanvasView):
         self.logger.warning("Launching image prefetching. Please be patient.")
 
         with self.lock:
-            for obs_records in self.candidates:
+            self.prefetcher.cancel_all()
+            self.candidate_list = list(self.candidates)
+            self.candidate_index = dict((obs_records[0].provisional_name, index)
+                                        for index, obs_records in enumerate(self.candidate_list))
+            self.prefetch_comparisons(self.candidate_list)
+            for obs_records in self.candidate_list:
                 self._download_obs_records(obs_records)
 
         self.candidates = candidate.CandidateSet(self.healpix, catalog_dir=self.qrun_id)
         self.candidate = None  # reset on candidate to clear it of any leftover from previous sets
         self.load()
 
-    def _download_obs_records(self, record):
+    def _download_obs_records(self, record, priority=prefetch.BACKGROUND):
         """
         Download the observations associated with the current self.candidate set of obsRecords.
-        :return:
+
+        :param record: the ObsRecords of the candidate.
+        :param priority: priority of the downloads, see prefetch.
         """
-        previous_record = None
-        previous_offset = 2 * storage.CUTOUT_RADIUS
-        offset = previous_offset
         for obs_record in record:
             assert isinstance(obs_record, ObsRecord)
             key = self.downloader.image_key(obs_record)
-            if key not in self.image_list:
-                self.image_list[key] = self.pool.apply_async(self.downloader.get, (obs_record,))
-
-            # Check if we should load a comparison for the previous image.
-            if previous_record is not None:
-                offset = obs_record.coordinate.separation(previous_record.coordinate)
-                if offset > storage.CUTOUT_RADIUS and previous_offset > storage.CUTOUT_RADIUS:
-                    # Insert a blank image in the list
-                    previous_key = self.downloader.image_key(previous_record)
-                    try:
-                        comparison = storage.get_comparison_image(previous_record.coordinate,
-                                                                  previous_record.date.mjd,
-                                                                  radius=120/3600.)
-                        frame = "{}{}".format(comparison[0]['observationID'], previous_record.comment.frame)
-                        comparison_obs_record = ObsRecord(null_observation=True,
-                                                          provisional_name=previous_record.provisional_name,
-                                                          date=Time(comparison[0]['mjdate'], format='mjd',
-                                                                    precision=5).mpc,
-                                                          ra=previous_record.coordinate.ra.degree,
-                                                          dec=previous_record.coordinate.dec.degree,
-                                                          frame=frame,
-                                                          comment=previous_key)
-                        key = self.downloader.image_key(comparison_obs_record)
-                        self.null_observation[key] = comparison_obs_record
-                        self.comparison_images[previous_key] = key
-                        if key not in self.image_list:
-                            self.image_list[key] = self.pool.apply_async(self.downloader.get,
-                                                                         (comparison_obs_record,))
-                    except Exception as ex:
-                        self.logger.error("Failed to get comparison image.: {}".format(str(ex)))
-                        return
+            if self._needs_download(key):
+                self.image_list[key] = self.prefetcher.submit(key, self.downloader.get, (obs_record,), priority)
 
-            previous_record = obs_record
-            previous_offset = offset
-        # Check if the offset between the last record and the one just before it was large.
-        if previous_offset > storage.CUTOUT_RADIUS and previous_record is not None:
+        for previous_record, frame in self._comparisons_needed(record):
             previous_key = self.downloader.image_key(previous_record)
-            comparison = storage.get_comparison_image(previous_record.coordinate,
-                                                      previous_record.date.mjd,
-                                                      radius=120/3600.0)
-            frame = "{}{}".format(comparison[0]['observationID'], 'p00')
+            try:
+                comparison = self.comparison(previous_record)
+            except Exception as ex:
+                self.logger.error("Failed to get comparison image.: {}".format(str(ex)))
+                return
             comparison_obs_record = ObsRecord(null_observation=True,
                                               provisional_name=previous_record.provisional_name,
-                                              date=Time(comparison[0]['mjdate'], format='mjd',
+                                              date=Time(comparison['mjdate'], format='mjd',
                                                         precision=5).mpc,
                                               ra=previous_record.coordinate.ra.degree,
                                               dec=previous_record.coordinate.dec.degree,
-                                              frame=frame,
+                                              frame="{}{}".format(comparison['observationID'], frame),
                                               comment=previous_key)
             key = self.downloader.image_key(comparison_obs_record)
             self.null_observation[key] = comparison_obs_record
             self.comparison_images[previous_key] = key
-            if key not in self.image_list:
-                self.image_list[key] = self.pool.apply_async(self.downloader.get,
-                                                             (comparison_obs_record,))
+            if self._needs_download(key):
+                self.image_list[key] = self.prefetcher.submit(key, self.downloader.get, (comparison_obs_record,),
+                                                              priority)
+
+    def _needs_download(self, key):
+        """
+        Is the image not downloaded nor queued, or was its download cancelled.
+        """
+        image = self.image_list.get(key)
+        return image is None or (isinstance(image, prefetch.Request) and image.state == prefetch.CANCELLED)
+
+    @staticmethod
+    def _comparisons_needed(record):
+        """
+        The observations of a candidate that should be followed by a comparison image: those far from both the
+        observation before and the one after them, so the candidate would otherwise be seen on a single cutout.
+
+        :return: list of (ObsRecord, frame suffix of the comparison image)
+        """
+        needed = []
+        previous_record = None
+        previous_offset = 2 * storage.CUTOUT_RADIUS
+        offset = previous_offset
+        for obs_record in record:
+            if previous_record is not None:
+                offset = obs_record.coordinate.separation(previous_record.coordinate)
+                if offset > storage.CUTOUT_RADIUS and previous_offset > storage.CUTOUT_RADIUS:
+                    needed.append((previous_record, previous_record.comment.frame))
+            previous_record = obs_record
+            previous_offset = offset
+        # Check if the offset between the last record and the one just before it was large.
+        if previous_offset > storage.CUTOUT_RADIUS and previous_record is not None:
+            needed.append((previous_record, 'p00'))
+        return needed
+
+    def candidate_keys(self, record):
+        """
+        The image keys of a candidate, with those of its comparison images.
+        """
+        keys = []
+        for obs_record in record:
+            key = self.downloader.image_key(obs_record)
+            keys.append(key)
+            if key in self.comparison_images:
+                keys.append(self.comparison_images[key])
+        return keys
+
+    def prioritise(self):
+        """
+        Re-order the pending downloads for where the reviewer now is: the current candidate first, then the next
+        LOOKAHEAD candidates, then the rest of the pixel.  Downloads still pending for the candidates already passed
+        are cancelled.
+        """
+        # the current candidate is (re)submitted, in case it was cancelled or its images have been cleared.
+        self._download_obs_records(self.candidate, priority=prefetch.CURRENT)
+        for key in self.candidate_keys(self.candidate):
+            self.prefetcher.prioritise(key, prefetch.CURRENT)
+
+        index = self.candidate_index.get(self.candidate[0].provisional_name)
+        if index is None:
+            return
+        for position, record in enumerate(self.candidate_list):
+            if position == index:
+                continue
+            for key in self.candidate_keys(record):
+                if position < index:
+                    self.prefetcher.cancel(key)
+                elif position <= index + LOOKAHEAD:
+                    self.prefetcher.prioritise(key, prefetch.LOOKAHEAD)
+                else:
+                    self.prefetcher.prioritise(key, prefetch.BACKGROUND)
+
+    def prefetch_comparisons(self, candidates):
+        """
+        Look up the comparison exposures needed by all the candidates with a single TAP query.
+
+        :param candidates: list of candidates, each a list of ObsRecords.
+        """
+        records = [obs_record for record in candidates for obs_record, _ in self._comparisons_needed(record)]
+        records = [obs_record for obs_record in records
+                   if self.downloader.image_key(obs_record) not in self.comparison_exposures]
+        if not records:
+            return
+        try:
+            matches = storage.get_comparison_images([obs_record.coordinate for obs_record in records],
+                                                    [obs_record.date.mjd for obs_record in records],
+                                                    radius=COMPARISON_RADIUS)
+        except Exception as ex:
+            self.logger.error("Failed to look up comparison images: {}".format(str(ex)))
+            return
+        for obs_record, match in zip(records, matches):
+            self.comparison_exposures[self.downloader.image_key(obs_record)] = match
+        self.logger.info("Found comparison images for {} of {} observations."
+                         .format(sum(match is not None for match in matches), len(records)))
+
+    def comparison(self, obs_record):
+        """
+        The comparison exposure of an observation, from those found by prefetch_comparisons or else with a query of
+        its own.
+
+        :return: row with the observationID and mjdate of the exposure.
+        """
+        key = self.downloader.image_key(obs_record)
+        if key in self.comparison_exposures:
+            match = self.comparison_exposures[key]
+        else:
+            match = storage.get_comparison_images([obs_record.coordinate], [obs_record.date.mjd],
+                                                  radius=COMPARISON_RADIUS)[0]
+        if match is None:
+            raise ValueError("no comparison image of {}".format(key))
+        return match
 
     def set_examined(self):
         """
-        Checks if the current json file has been fully examined or not
+        Checks if the current json file has been fully examined or not, from the examined index of the QRUNID and
+        the summary written by the linker, so neither the candidates nor the VOSpace directory are read in full.
 
         :return True if the directory is fully examined and there's no override, False if it has not been examined.
         """
         self.logger.info("Accepted candidate entry: {}".format(self.healpix))
         try:
             self.candidates = candidate.CandidateSet(self.healpix, catalog_dir=self.qrun_id)
+            count = self.candidate_count(self.examined.count(self.healpix))
+            if self.examined.count(self.healpix) != count:
+                # the linker may have been run again since the count was taken.
+                self.examined.set_count(self.healpix, count)
             if self.length_check:
-                sub_directory = storage.listdir(os.path.join(os.path.dirname(storage.DBIMAGES),
-                                                             storage.CATALOG,
-                                                             self.qrun_id,
-                                                             self.candidates.catalog.catalog.dataset_name), force=True)
+                if not self.examined.is_examined(self.healpix):
+                    # the index may have lost marks, or be missing those made since it was read: add the .ast files
+                    self.update_examined()
                 if self.override is not None:
-                    filename = self.override+'.ast'
-                    if filename in sub_directory:
-                        self.logger.info("Overriding {}.".format(filename))
+                    if self.examined.is_examined(self.healpix, self.override):
+                        self.logger.info("Overriding {}.".format(self.override + '.ast'))
                         return False
+                elif self.examined.is_examined(self.healpix):
+                    self.logger.info("Candidate set {} fully examined.".format(self.healpix))
+                    return True
                 else:
-                    count = 0
-                    # counting the total amount of candidates that are in self.candidates
-                    for _ in self.candidates:
-                        count += 1
-
-                    # re-set self.candidates since the for loop removes all its candidates in a dequeuing fashion
-                    self.candidates = candidate.CandidateSet(self.healpix, catalog_dir=self.qrun_id)
-
-                    # the amount of files in the accompanying subdirectory for the .json candidate file
-                    directory_length = len(sub_directory)
-                    if count == directory_length:
-                        self.logger.info("Candidate set {} fully examined.".format(self.healpix))
-                        return True
-
-                    elif count > directory_length:
-                        self.logger.info("Candidate set {} not fully examined.".format(self.healpix))
-                        return False
-
-                    else:
-                        self.logger.error("Value error: count {} or directory_length {} is out of range."
-                                          .format(count, directory_length))
-                        raise ValueError
+                    self.logger.info("Candidate set {} not fully examined.".format(self.healpix))
+                    return False
 
             return False  # no length check, therefor no directory has been created and this set isn't examined
 
@@ -546,6 +696,20 @@ class ValidateGui(ipg.EnhancedCanvasView):
             else:
                 raise ex
 
+    def candidate_count(self, known=None):
+        """
+        The number of candidates in the current healpix, from the linker summary when there is one, otherwise the
+        count already known or, failing that, from the index of the candidate file.
+        """
+        try:
+            return storage.JSONSummary(self.healpix, catalog_dir=self.qrun_id).summary['count']
+        except Exception as ex:
+            self.logger.debug("No summary for {}: {}".format(self.healpix, str(ex)))
+        if known is not None:
+            return known
+        index = self.candidates.catalog.catalog.index
+        return sum(len(index[mjd]) for mjd in index.mjdates)
+
     def reload_candidates(self):
         """
         Performs a hard reload on all images for the case of loading errors.
@@ -555,6 +719,8 @@ class ValidateGui(ipg.EnhancedCanvasView):
             self.logger.info('Reloading all candidates...')
             self.pool.terminate()
             self.pool = Pool(processes=PROCESSES)
+            self.prefetcher.cancel_all()
+            self.image_list = {}
             self.buttons_on()
             self.set_qrun_id(self.qrun_id)
             self.load_candidates(self.healpix)
@@ -596,10 +762,13 @@ class ValidateGui(ipg.EnhancedCanvasView):
                 if key not in self.astro_images:
                     # TODO: MEF
                     image = AstroImage.AstroImage(logger=self.logger)
-                    image.load_hdu(self.loaded_hdu)
+                    hdu = self.loaded_hdu
+                    image.load_hdu(hdu)
                     self.astro_images[key] = image
+                    tiles.TILES.get(key, lambda: hdu, STRETCH, CMAP)
 
                 self.set_image(self.astro_images[key])
+                self.show_thumbnails()
 
                 if self.zoom is not None:
                     self.zoom_to(self.zoom)
@@ -625,6 +794,20 @@ class ValidateGui(ipg.EnhancedCanvasView):
         self._center = WCS(self.header).all_pix2world(self.get_data_size()[0] / 2,
                                                       self.get_data_size()[1] / 2, 0)
 
+    def show_thumbnails(self):
+        """
+        Show the observations of the candidate that any session has rendered, served from the shared tiles.
+        """
+        for index, thumbnail in enumerate(self.thumbnails):
+            source = ''
+            if index < len(self.candidate):
+                key = self.downloader.image_key(self.candidate[index])
+                if tiles.TILES.find(key, STRETCH, CMAP) is not None:
+                    source = '/tiles/{}?stretch={}&cmap={}'.format(tornado.escape.url_escape(key), STRETCH, CMAP)
+            if thumbnail.img_src != source:
+                thumbnail.img_src = source
+                thumbnail.get_app().do_operation('update_imgsrc', id=thumbnail.id, value=source)
+
     def mark_aperture(self):
         """
         Draws a red circle on the drawing canvas in the viewing window around the celestial object detected.
@@ -656,6 +839,9 @@ class ValidateGui(ipg.EnhancedCanvasView):
                         ob.null_observation = True
                     fobj.write(ob.to_string() + '\n')
 
+            self.examined.mark(self.healpix, self.candidate[0].provisional_name)
+            self.pool.apply_async(self.save_examined)
+
             self.logger.info("Queuing job to write file to VOSpace.")
             with self.lock:
                 try:
@@ -927,9 +1113,9 @@ class ValidateGui(ipg.EnhancedCanvasView):
         # TODO: MEF
         key = self.key
         with self.lock:
-            hdu = (isinstance(self.image_list[key], ApplyResult) and self.image_list[key].get()
+            hdu = (isinstance(self.image_list[key], (ApplyResult, prefetch.Request)) and self.image_list[key].get()
                    or self.image_list[key])
-            if isinstance(hdu, ApplyResult):
+            if isinstance(hdu, (ApplyResult, prefetch.Request)):
                 self.logger.info("Loaded HDU is Apply result instance, not an HDU.")
                 raise TypeError
             self.image_list[key] = hdu
@@ -956,6 +1142,22 @@ class ValidateGui(ipg.EnhancedCanvasView):
         return "\n".join([x + " = " + str(self.header.get(x, "UNKNOWN")) for x in DISPLAY_KEYWORDS])
 
 
+class TileHandler(tornado.web.RequestHandler):
+    """
+    Serve the rendered tiles as PNG at /tiles/<cutout key>?stretch=zscale&cmap=gray
+    """
+
+    def get(self, key):
+        tile = tiles.TILES.find(key, self.get_argument('stretch', STRETCH), self.get_argument('cmap', CMAP))
+        if tile is None:
+            raise tornado.web.HTTPError(404)
+        status, headers, body = tiles.response(tile, self.request.headers.get('If-None-Match'))
+        self.set_status(status)
+        for name, value in headers.items():
+            self.set_header(name, value)
+        self.finish(body)
+
+
 def main(params):
 
     ginga_logger = log.get_logger("ginga", options=params)
@@ -991,7 +1193,9 @@ def main(params):
     ValidateGui(daomop_logger, window)
 
     try:
-        app.start()
+        app.start(no_ioloop=True)
+        app.server.add_handlers(r".*", [(r"/tiles/(.*)", TileHandler)])
+        tornado.ioloop.IOLoop.instance().start()
 
     except KeyboardInterrupt:
         ginga_logger.info("Terminating viewer...")
@@ -1,5 +1,6 @@
 from __future__ import absolute_import
 import unittest
+from collections import OrderedDict
 from copy import deepcopy
 
 from daomop import candidate
@@ -37,3 +38,49 @@ class CandidateTest(unittest.TestCase):
     def test_provisional(self):
         candid = deepcopy(self.candidates.next())
         self.assertEqual(candid[0].provisional_name, 'c172f24340')
+
+
+class BatchedDatesTest(unittest.TestCase):
+    """
+    The dates a Target converts in batches are those of one Time per detection.
+    """
+    def setUp(self):
+        def track(mjds):
+            return {'mjd': mjds, 'ra': [185.6] * len(mjds), 'dec': [37.2] * len(mjds), 'mag': [23.1] * len(mjds),
+                    'magerr': [0.1] * len(mjds), 'filterid': ['r'] * len(mjds), 'fitsname': ['2434p'] * len(mjds)}
+        self.record = {'a': track([57801.30, 57801.34, 57801.38]), 'b': track([57801.31, 57801.35])}
+        self.tracks = ReadCounter(('t{:03d}'.format(i), track([57801.3 + i * 1e-3, 57801.34])) for i in range(70))
+
+    def test_dates(self):
+        target = candidate.Target(2434, '57801', self.record)
+        for observation_set in target:
+            record = self.record[target.observation_sets[target.current_observation]]
+            self.assertTrue(all(isinstance(date, str) for date in observation_set.dates))
+            for ob, mjd in zip(observation_set, record['mjd']):
+                self.assertAlmostEqual(ob.date.mjd, candidate.Time(mjd, format='mjd').mjd, places=6)
+
+    def test_random_access(self):
+        target = candidate.Target(2434, '57801', self.record)
+        self.assertEqual(len(target), 2)
+        self.assertEqual(len(list(target[1])), len(self.record[target.observation_sets[1]]['mjd']))
+
+    def test_one_candidate_reads_one_batch(self):
+        target = candidate.Target(2434, '57801', self.tracks)
+        target.next()
+        self.assertEqual(len(self.tracks.read), candidate.BATCH)
+        last = target[len(target) - 1]
+        self.assertEqual(len(self.tracks.read), candidate.BATCH + len(target) % candidate.BATCH)
+        self.assertEqual(last.dates, candidate.mpc_dates(last.record['mjd']))
+
+
+class ReadCounter(OrderedDict):
+    """
+    Tracks that remember which of them were read, as json_index.Tracks reads them on access.
+    """
+    def __init__(self, items):
+        super(ReadCounter, self).__init__(items)
+        self.read = set()
+
+    def __getitem__(self, key):
+        self.read.add(key)
+        return super(ReadCounter, self).__getitem__(key)
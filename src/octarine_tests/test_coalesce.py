@@ -0,0 +1,100 @@
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+import time
+import fcntl
+import unittest
+from multiprocessing import Pool
+
+from daomop import coalesce
+
+DELAY = 0.5
+
+
+def slow_copy(source, destination):
+    """
+    Stand-in for a VOSpace download: slow, and logs each call to the file named in the source.
+    """
+    log, content = source.split('#')
+    with open(log, 'a') as fobj:
+        fobj.write("{}\n".format(os.getpid()))
+    time.sleep(DELAY)
+    if content == 'missing':
+        raise IOError("{} not found".format(content))
+    with open(destination, 'w') as fobj:
+        fobj.write(content)
+    return 'disposition {}'.format(content)
+
+
+def request(args):
+    source, destination, cache_dir = args
+    try:
+        return coalesce.fetch(source, destination, slow_copy, cache_dir=cache_dir)
+    except IOError as ex:
+        return 'IOError: {}'.format(ex)
+
+
+class CoalesceTest(unittest.TestCase):
+    """
+    Processes asking for the same file at the same time share one download, and its failure.
+    """
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.workdir, 'cache')
+        self.log = os.path.join(self.workdir, 'calls.log')
+        self.pool = Pool(processes=4)
+
+    def tearDown(self):
+        self.pool.terminate()
+        shutil.rmtree(self.workdir)
+
+    def calls(self):
+        with open(self.log) as fobj:
+            return len(fobj.readlines())
+
+    def fetch_all(self, content):
+        source = '{}#{}'.format(self.log, content)
+        destinations = [os.path.join(self.workdir, 'copy{}'.format(i)) for i in range(4)]
+        return destinations, self.pool.map(request, [(source, destination, self.cache_dir)
+                                                     for destination in destinations], chunksize=1)
+
+    def test_one_fetch(self):
+        destinations, results = self.fetch_all('image')
+        self.assertEqual(self.calls(), 1)
+        self.assertEqual(results, ['disposition image'] * 4)
+        for destination in destinations:
+            with open(destination) as fobj:
+                self.assertEqual(fobj.read(), 'image')
+
+        # later requests are served from the cache too
+        self.fetch_all('image')
+        self.assertEqual(self.calls(), 1)
+
+    def test_failure_propagates(self):
+        destinations, results = self.fetch_all('missing')
+        self.assertEqual(self.calls(), 1)
+        self.assertEqual(results, ['IOError: missing not found'] * 4)
+        self.assertFalse(any(os.path.exists(destination) for destination in destinations))
+
+    def test_later_request_retries_failure(self):
+        destinations, results = self.fetch_all('missing')
+        self.assertEqual(self.calls(), 1)
+
+        # a request made after the failed download did not wait on it, so it tries again.
+        self.assertEqual(request(('{}#missing'.format(self.log), destinations[0], self.cache_dir)),
+                         'IOError: missing not found')
+        self.assertEqual(self.calls(), 2)
+
+    def test_prune_keeps_locked(self):
+        self.fetch_all('image')
+        self.pool.map(request, [('{}#other'.format(self.log), os.path.join(self.workdir, 'other'), self.cache_dir)])
+        data = sorted(name for name in os.listdir(self.cache_dir) if name.endswith('.data'))
+        self.assertEqual(len(data), 2)
+
+        locked = os.path.join(self.cache_dir, data[0][:-len('.data')] + '.lock')
+        with open(locked, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            coalesce.prune(self.cache_dir, max_bytes=0)
+        self.assertEqual(sorted(name for name in os.listdir(self.cache_dir) if name.endswith('.data')), data[:1])
@@ -0,0 +1,55 @@
+from __future__ import absolute_import
+import os
+import unittest
+
+import numpy
+from astropy.io import ascii
+
+from daomop import comparison
+
+RESPONSE = os.path.join(os.path.dirname(__file__), 'data', 'comparison_tap.tsv')
+
+
+class ComparisonTest(unittest.TestCase):
+    """
+    Resolve the comparison exposure of several candidates from a TAP response, one footprint a union of CCDs.
+    """
+
+    def setUp(self):
+        # read as storage.tap_query reads the TAP service response
+        reader = ascii.get_reader(Reader=ascii.Basic)
+        reader.header.splitter.delimiter = '\t'
+        reader.data.splitter.delimiter = '\t'
+        with open(RESPONSE) as fobj:
+            self.table = reader.read(fobj.read())
+
+    def test_resolve(self):
+        ra = [185.6, 185.9, 185.6, 186.19, 187.0, 0.1]
+        dec = [37.2, 37.2, 37.2, 37.2, 37.0, 0.0]
+        mjdates = [57841.401, 57820.0, 57820.0, 57820.0, 57820.0, 57820.0]
+        matches = comparison.resolve(self.table, ra, dec, mjdates, radius=120 / 3600.0)
+        # 185.6 falls in the gap between the two blocks of CCDs of 2087700.
+        self.assertEqual([match and str(match['observationID']) for match in matches],
+                         ['2087679', '2087700', '2087679', None, '2087800', '2087900'])
+        self.assertAlmostEqual(matches[0]['mjdate'], 57840.43)
+
+    def test_empty(self):
+        self.assertEqual(comparison.resolve(self.table[:0], [185.6], [37.2], [57820.0]), [None])
+
+    def test_parse_bounds(self):
+        def parse(value):
+            return [polygon.tolist() for polygon in comparison.parse_bounds(value)]
+        self.assertEqual(parse('polygon icrs 1 2 3 4 5 6'), [[[1, 2], [3, 4], [5, 6]]])
+        self.assertEqual(parse('1 2 3 4 5 6'), [[[1, 2], [3, 4], [5, 6]]])
+        self.assertEqual(parse('Union ICRS ( Polygon 1 2 3 4 5 6 Polygon 7 8 9 10 11 12 13 14 )'),
+                         [[[1, 2], [3, 4], [5, 6]], [[7, 8], [9, 10], [11, 12], [13, 14]]])
+        self.assertEqual(parse(''), [])
+
+    def test_query(self):
+        ra = numpy.array([185.6, 186.0, 359.9])
+        dec = numpy.array([37.2, 37.5, 37.0])
+        centre_ra, centre_dec, radius = comparison.union_circle(ra, dec, 0.1)
+        vectors = comparison.unit_vectors(ra, dec)
+        centre = comparison.unit_vectors([centre_ra], [centre_dec])[0]
+        self.assertTrue(numpy.all(numpy.degrees(numpy.arccos(vectors.dot(centre))) + 0.1 <= radius + 1e-9))
+        self.assertIn("INTERSECTS(CIRCLE('ICRS'", comparison.query(ra, dec, 0.1))
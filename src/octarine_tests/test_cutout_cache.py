@@ -0,0 +1,115 @@
+from __future__ import absolute_import
+import os
+import threading
+import time
+import unittest
+
+import numpy
+from astropy.io import fits
+
+from daomop import cutout_cache
+
+
+def cutout(value, size=10):
+    return fits.HDUList([fits.PrimaryHDU(data=numpy.full((size, size), value, dtype='f4'))])
+
+
+class CutoutCacheTest(unittest.TestCase):
+    """
+    Memory budget, spill to disk and single-flight fetches of the cutout cache.
+    """
+
+    def setUp(self):
+        # room for two 10x10 float32 cutouts in memory
+        self.cache = cutout_cache.CutoutCache(memory=800, disk=10 ** 6)
+
+    def tearDown(self):
+        self.cache.clear()
+
+    def test_evict_and_spill(self):
+        for key in 'abc':
+            self.cache.get(key, lambda: cutout(ord(key)))
+        self.assertEqual(self.cache.stats['misses'], 3)
+        self.assertEqual(self.cache.stats['evictions'], 1)
+        self.assertEqual(self.cache.stats['spills'], 1)
+        self.assertLessEqual(self.cache.memory_used, 800)
+        self.assertTrue(os.path.exists(self.cache.filename('a')))
+
+        hdulist = self.cache.get('a', lambda: self.fail("spilled cutout fetched again"))
+        self.assertEqual(self.cache.stats['disk_hits'], 1)
+        self.assertEqual(hdulist[0].data[0, 0], ord('a'))
+        self.assertFalse(os.path.exists(self.cache.filename('a')))
+
+    def test_lru(self):
+        self.cache.get('a', lambda: cutout(1))
+        self.cache.get('b', lambda: cutout(2))
+        self.cache.get('a', lambda: cutout(1))
+        self.cache.get('c', lambda: cutout(3))
+        self.assertEqual(self.cache.stats['hits'], 1)
+        self.assertTrue(os.path.exists(self.cache.filename('b')))
+        self.assertFalse(os.path.exists(self.cache.filename('a')))
+
+    def test_disk_budget(self):
+        cache = cutout_cache.CutoutCache(memory=0, disk=0)
+        cache.get('a', lambda: cutout(1))
+        cache.get('b', lambda: cutout(2))
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.stats['spills'], 0)
+        cache.clear()
+
+    def test_spill_outside_lock(self):
+        cache = cutout_cache.CutoutCache(memory=400, disk=10 ** 6)
+        writing, release = threading.Event(), threading.Event()
+        write = cache._write
+
+        def slow_write(hdulist, filename):
+            if not writing.is_set():
+                writing.set()
+                release.wait(5)
+            write(hdulist, filename)
+
+        cache._write = slow_write
+        cache.get('a', lambda: cutout(1))
+        thread = threading.Thread(target=cache.get, args=('b', lambda: cutout(2)))
+        thread.start()
+        writing.wait(5)
+        # 'a' is being written: the cache is not locked meanwhile, and 'a' is still found in memory.
+        start = time.time()
+        self.assertEqual(cache.get('b', lambda: self.fail("cached cutout fetched again"))[0].data[0, 0], 2)
+        self.assertEqual(cache.get('a', lambda: self.fail("spilling cutout fetched again"))[0].data[0, 0], 1)
+        self.assertLess(time.time() - start, 1)
+        release.set()
+        thread.join()
+        self.assertFalse(os.path.exists(cache.filename('a')))
+        self.assertTrue(os.path.exists(cache.filename('b')))
+        self.assertEqual(cache.stats['spills'], 1)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual([name for name in os.listdir(cache._directory) if name.endswith('.tmp')], [])
+        cache.clear()
+
+    def test_single_flight(self):
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            time.sleep(0.1)
+            return cutout(1)
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.cache.get('a', fetch))) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(set(id(result) for result in results)), 1)
+        self.assertEqual(self.cache._flights, {})
+
+    def test_failed_fetch(self):
+        def fetch():
+            raise IOError("no such cutout")
+        self.assertRaises(IOError, self.cache.get, 'a', fetch)
+        self.assertNotIn('a', self.cache)
+        self.assertEqual(self.cache._flights, {})
+        self.assertIsNone(self.cache.get('b', lambda: None))
+        self.assertNotIn('b', self.cache)
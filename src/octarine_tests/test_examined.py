@@ -0,0 +1,73 @@
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+import unittest
+
+from daomop import examined
+
+
+class ExaminedIndexTest(unittest.TestCase):
+    """
+    Keep the examined state of the candidates of a QRUN and find the next pixel to review.
+    """
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.workdir, examined.FILENAME)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_examined(self):
+        index = examined.ExaminedIndex(self.filename)
+        index.set_count(887, 2)
+        self.assertFalse(index.is_examined(887))
+        index.mark(887, 'a0001')
+        index.mark(887, 'a0001')
+        self.assertTrue(index.is_examined(887, 'a0001'))
+        self.assertFalse(index.is_examined(887))
+        index.mark(887, 'a0002')
+        self.assertTrue(index.is_examined(887))
+
+    def test_unknown_count(self):
+        index = examined.ExaminedIndex(self.filename)
+        index.set_examined(12, ['a0001'])
+        self.assertFalse(index.is_examined(12))
+        self.assertFalse(index.is_examined(13))
+
+    def test_next_unexamined(self):
+        index = examined.ExaminedIndex(self.filename)
+        index.set_count(1, 1)
+        index.set_examined(1, ['a0001'])
+        index.set_count(2, 0)
+        self.assertEqual(index.next_unexamined([3, 1, 2, 4]), 3)
+        self.assertEqual(index.next_unexamined([3, 1, 2, 4], start=4), 4)
+        self.assertIsNone(index.next_unexamined([1, 2]))
+
+    def test_save(self):
+        index = examined.ExaminedIndex(self.filename)
+        index.set_count(887, 3)
+        index.mark(887, 'a0001')
+        index.save()
+        loaded = examined.ExaminedIndex(self.filename)
+        self.assertEqual(loaded.pixels, index.pixels)
+        self.assertIn(887, loaded)
+
+    def test_merge_keeps_other_reviewers_marks(self):
+        index = examined.ExaminedIndex(self.filename)
+        index.set_count(887, 3)
+        index.save()
+        # two reviewers start from the same upload, each marks a different candidate
+        first = examined.ExaminedIndex(self.filename)
+        second = examined.ExaminedIndex(self.filename)
+        first.mark(887, 'a0001')
+        first.mark(12, 'b0001')
+        first.save()
+        second.mark(887, 'a0002')
+        second.merge(examined.ExaminedIndex(self.filename))
+        self.assertEqual(second.examined(887), ['a0001', 'a0002'])
+        self.assertEqual(second.examined(12), ['b0001'])
+        self.assertEqual(second.count(887), 3)
+        second.update(887, ['a0003'])
+        self.assertTrue(second.is_examined(887))
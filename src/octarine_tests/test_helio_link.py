@@ -0,0 +1,78 @@
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+from astropy.table import Table
+
+from daomop import helio_link
+
+
+class PropagateTest(unittest.TestCase):
+
+    def test_circular_orbit(self):
+        r = 40.0
+        speed = numpy.sqrt(helio_link.GM / r)
+        period = 2 * numpy.pi * r / speed
+        r0 = numpy.array([[r, 0., 0.]])
+        v0 = numpy.array([[0., speed, 0.]])
+        position, velocity = helio_link.propagate(r0, v0, numpy.array([period / 4.]))
+        numpy.testing.assert_allclose(position, [[0., r, 0.]], atol=1e-6)
+        numpy.testing.assert_allclose(velocity, [[-speed, 0., 0.]], atol=1e-9)
+
+
+class HelioLinkerTest(unittest.TestCase):
+    """
+    Observe a few objects on circular orbits at 40 au over three nights and link them back together.
+    """
+    times = [57800.30, 57800.34, 57800.38, 57801.30, 57801.34, 57801.38, 57803.30, 57803.34, 57803.38]
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.workdir = tempfile.mkdtemp()
+        rand = numpy.random.RandomState(7)
+        observer = helio_link.observer_positions(numpy.array(self.times))
+        # look towards opposition on the first night.
+        opposition = observer[0] / numpy.sqrt((observer[0] ** 2).sum())
+        self.ra = numpy.degrees(numpy.arctan2(opposition[1], opposition[0])) % 360
+        self.dec = numpy.degrees(numpy.arcsin(opposition[2]))
+
+        ra = self.ra + rand.uniform(-0.1, 0.1, 5)
+        dec = self.dec + rand.uniform(-0.1, 0.1, 5)
+        start, _ = helio_link.heliocentric(numpy.repeat(observer[:1], 5, axis=0),
+                                           helio_link.line_of_sight(ra, dec), 40.0)
+        pole = numpy.array([0., -numpy.sin(numpy.radians(23.44)), numpy.cos(numpy.radians(23.44))])
+        velocity = numpy.cross(pole, start)
+        velocity *= numpy.sqrt(helio_link.GM / 40.0) / numpy.sqrt((velocity ** 2).sum(axis=1))[:, numpy.newaxis]
+
+        rows = []
+        for t, obs in zip(self.times, observer):
+            position, _ = helio_link.propagate(start, velocity, numpy.ones(5) * (t - self.times[0]))
+            apparent = position - obs
+            apparent /= numpy.sqrt((apparent ** 2).sum(axis=1))[:, numpy.newaxis]
+            for n, u in enumerate(apparent):
+                rows.append((numpy.degrees(numpy.arctan2(u[1], u[0])) % 360, numpy.degrees(numpy.arcsin(u[2])),
+                             t, 22.0 + 0.1 * n, n))
+        table = Table(rows=rows, names=('X_WORLD', 'Y_WORLD', 'mid_mjdate', 'MAG_PSF', 'OBJECT_ID'))
+        for name, value in [('MAGERR_PSF', 0.1), ('FLUX_RADIUS', 3.0), ('X_IMAGE', 1000.),
+                            ('A_IMAGE', 2.), ('B_IMAGE', 2.), ('THETA_IMAGE', 0.)]:
+            table[name] = value * numpy.ones(len(table))
+        table['MAG_ISO'] = table['MAG_PSF']
+        table['dataset_name'] = ['2000000p00'] * len(table)
+        self.table = table
+        table.write(os.path.join(self.workdir, 'night.fits.ns'), format='fits')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.workdir)
+
+    def test_links_across_nights(self):
+        linker = helio_link.HelioLinker(self.workdir, '{}_{}_0'.format(self.ra, self.dec),
+                                        [(40.0, 0.0), (10.0, 0.0)])
+        linker.Searching(False, ['night.fits.ns'])
+        self.assertEqual(len(linker.tracks), 5)
+        for track in linker.tracks:
+            self.assertEqual(len(track), len(self.times))
+            self.assertEqual(len(set(self.table['OBJECT_ID'][list(track)])), 1)
@@ -0,0 +1,55 @@
+from __future__ import absolute_import
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from daomop import json_index
+
+
+class JSONIndexTest(unittest.TestCase):
+    """
+    Index a candidate JSON file and read single tracks back through the index.
+    """
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.workdir, 'HPX_00001_RA_160.0_DEC_+10.0_bk.json')
+        self.tracks = {57801: {'b': {'ra': [1.5, 2.0], 'mjd': [57801.3, 57801.4]},
+                               'a': {'ra': [3.0], 'fitsname': ['}{"']}},
+                       57800: {'c': {'ra': [4.0], 'mjd': [57800.3]}}}
+        with open(self.filename, 'w') as fobj:
+            json.dump(self.tracks, fobj)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_read_tracks(self):
+        catalog = json_index.IndexedCatalog(self.filename)
+        self.assertEqual(catalog.mjdates, ['57800', '57801'])
+        self.assertEqual(catalog['57801'].keys(), ['a', 'b'])
+        for mjd in self.tracks:
+            for track in self.tracks[mjd]:
+                self.assertEqual(catalog[str(mjd)][track], self.tracks[mjd][track])
+
+    def test_sidecar(self):
+        json_index.IndexedCatalog(self.filename)
+        self.assertTrue(os.path.exists(self.filename + json_index.SUFFIX))
+        with open(self.filename + json_index.SUFFIX) as fobj:
+            self.assertEqual(json.load(fobj), json_index.build(self.filename))
+
+    def test_summary(self):
+        filename = json_index.summary_name(self.filename)
+        json_index.write_summary(self.tracks, filename)
+        with open(filename) as fobj:
+            summary = json.load(fobj)
+        self.assertEqual(summary['count'], 3)
+        catalog = json_index.IndexedCatalog(self.filename)
+        self.assertEqual(summary['tracks'], [[mjd, track] for mjd in catalog.mjdates for track in catalog[mjd]])
+
+    def test_summary_name(self):
+        self.assertEqual(json_index.summary_name('vos:cfis/catalogs/Q1/HPX_00887_RA_203.6_DEC_+58.9_bk.json'),
+                         'vos:cfis/catalogs/Q1/HPX_00887_RA_203.6_DEC_+58.9_bk.summary.json')
+        self.assertEqual(json_index.summary_name('HPX_00887_RA_203.6_DEC_+58.9_cat.fits.mjdalltracks.json'),
+                         'HPX_00887_RA_203.6_DEC_+58.9_cat.fits.mjdalltracks.summary.json')
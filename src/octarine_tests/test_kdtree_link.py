@@ -0,0 +1,70 @@
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+import unittest
+
+from daomop import kdtree_link
+from daomop import link_benchmark
+
+
+class KDTreeLinkerTest(unittest.TestCase):
+    """
+    Link a small synthetic ns catalog with the KD-tree engine and check that the injected objects come back.
+    """
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.workdir = tempfile.mkdtemp()
+        self.catalog = link_benchmark.synthetic_catalog(20, 10, radius=0.1, seed=42)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.workdir)
+
+    def test_recovers_injected_objects(self):
+        mjdalltracks, _ = link_benchmark.run(kdtree_link.KDTreeLinker, self.catalog, self.workdir, 20.0)
+        n_tracks, recall, false_links = link_benchmark.score(mjdalltracks, self.catalog)
+        self.assertEqual(recall, 1.0)
+        self.assertEqual(false_links, 0.0)
+
+    def test_measure_in_new_process(self):
+        nsfile, ratelist = link_benchmark.write(self.catalog, self.workdir, 20.0)
+        mjdalltracks, elapsed, rss = link_benchmark.measure('kdtree', self.workdir, nsfile, ratelist, 0.1, 15.)
+        n_tracks, recall, false_links = link_benchmark.score(mjdalltracks, self.catalog)
+        self.assertEqual(recall, 1.0)
+        self.assertTrue(rss > 0)
+        self.assertEqual(sorted(os.listdir(self.workdir)), sorted([nsfile, os.path.basename(ratelist)]))
+
+    def test_track_layout(self):
+        mjdalltracks, _ = link_benchmark.run(kdtree_link.KDTreeLinker, self.catalog, self.workdir, 20.0)
+        for mjd, tracks in mjdalltracks.items():
+            for track in tracks.values():
+                self.assertEqual(int(track['mjd'][0]), mjd)
+                self.assertEqual(sorted(track['mjd']), track['mjd'])
+                for key in ['ra', 'dec', 'mag', 'magerr', 'fitsname', 'filterid']:
+                    self.assertEqual(len(track[key]), len(track['mjd']))
+
+    def test_deduplicate(self):
+        tracks = kdtree_link.deduplicate([(1, 2, 3), (2, 3), (1, 2, 3, 4), (5, 6, 7)])
+        self.assertEqual(sorted(tracks), [(1, 2, 3, 4), (5, 6, 7)])
+
+
+class PopulationTest(unittest.TestCase):
+    """
+    Plant a KBOGenerator population into a synthetic catalog and check every object is detected at every epoch.
+    """
+    def test_planted_count_and_epochs(self):
+        epochs = (0.0, 0.04, 0.08)
+        objects = link_benchmark.population(25, angle=(10.0, 30.0), radius=0.1, seed=42)
+        self.assertEqual(len(objects), 25)
+        self.assertEqual(sorted(objects['id']), list(range(1, 26)))
+        self.assertTrue(all(abs(objects['x']) <= 0.1) and all(abs(objects['y']) <= 0.1))
+        self.assertTrue(all((objects['angle'] >= 10.0) & (objects['angle'] <= 30.0)))
+
+        catalog = link_benchmark.synthetic_catalog(5, 0, epochs=epochs, radius=0.1, seed=42, objects=objects)
+        planted = catalog[catalog['OBJECT_ID'] >= 0]
+        self.assertEqual(len(planted), len(objects) * len(epochs))
+        for dt in epochs:
+            at_epoch = planted[abs(planted['mid_mjdate'] - (link_benchmark.MJD + dt)) < 1e-9]
+            self.assertEqual(sorted(at_epoch['OBJECT_ID']), list(range(len(objects))))
+        self.assertEqual(len(set(catalog['mid_mjdate'])), len(epochs))
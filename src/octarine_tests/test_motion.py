@@ -0,0 +1,25 @@
+from __future__ import absolute_import
+import unittest
+
+import numpy
+
+from daomop import motion
+
+
+class MotionTest(unittest.TestCase):
+    """
+    Check the window of position angles derived from the field geometry.
+    """
+
+    def test_angle_window_wraps(self):
+        angles = numpy.concatenate((numpy.linspace(170, 179.9, 50), numpy.linspace(0, 9.9, 50)))
+        start, end = motion.angle_window(angles, coverage=1.0)
+        self.assertAlmostEqual(start, 170.0)
+        self.assertAlmostEqual(end, 189.9)
+
+    def test_opposition_field(self):
+        # near opposition on the ecliptic the motion follows the ecliptic, which falls to the east at RA 160.
+        angles, (vmin, vmax) = motion.search_angles(57800.3, 160.0, 10.0)
+        self.assertLess(len(angles), 60)
+        self.assertTrue(angles[0] < 160 < angles[-1])
+        self.assertGreater(vmax, vmin)
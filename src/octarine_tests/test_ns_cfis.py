@@ -0,0 +1,91 @@
+from __future__ import absolute_import
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy
+from astropy.io import fits
+from astropy.table import Table
+from mock import patch
+
+from daomop import ns_cfis, rb_model
+
+
+def make_catalog(filename, rand, ra, dec, n=200):
+    """
+    An HPX catalog of n sources around (ra, dec): half stationary (MATCHES 3) and half candidates (MATCHES 0).
+    """
+    columns = [rand.normal(20, 1, n).astype('f4') for _ in ns_cfis.FEATURES]
+    table = Table(columns, names=ns_cfis.FEATURES)
+    table['MATCHES'] = numpy.where(numpy.arange(n) % 2, 3, 0).astype('i2')
+    table['OVERLAPS'] = numpy.full(n, 3, dtype='i2')
+    table['X_WORLD'] = ra + rand.uniform(-0.1, 0.1, n)
+    table['Y_WORLD'] = dec + rand.uniform(-0.1, 0.1, n)
+    table.write(filename, format='fits')
+    return table
+
+
+class NSCatalogTest(unittest.TestCase):
+    """
+    Run daomop_ns on a directory of catalogs with a model from the registry.
+    """
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.ps1_dir = os.path.join(self.workdir, 'PS')
+        self.registry = os.path.join(self.workdir, 'registry')
+        os.makedirs(self.ps1_dir)
+        rand = numpy.random.RandomState(3)
+        self.catalogs = []
+        for i, (ra, dec) in enumerate([(10.0, 30.0), (11.0, 31.0), (12.0, 32.0)]):
+            healpix = 'HPX_{:05d}_RA_{:.1f}_DEC_+{:.1f}'.format(i, ra, dec)
+            filename = os.path.join(self.workdir, healpix + '_cat.fits')
+            table = make_catalog(filename, rand, ra, dec)
+            # the first candidate of each catalog is a PS1 source.
+            Table([table['X_WORLD'][:1], table['Y_WORLD'][:1]], names=('f0', 'f1')).write(
+                os.path.join(self.ps1_dir, healpix + '_STK.fits'), format='fits')
+            self.catalogs.append(filename)
+        rb_model.train(self.catalogs[:1], registry=self.registry, n_estimators=10)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def run_main(self, *options):
+        argv = ['daomop_ns', self.workdir, '--ps1-dir', self.ps1_dir, '--registry', self.registry] + list(options)
+        with patch.object(sys, 'argv', argv):
+            ns_cfis.main()
+
+    def test_main_writes_ns_catalogs(self):
+        self.run_main('--batch', '2')
+        for filename in self.catalogs:
+            ns = fits.getdata(filename + '.ns')
+            self.assertTrue(0 < len(ns) < 100)
+            self.assertTrue((ns['MATCHES'] == 0).all())
+            self.assertNotIn(fits.getdata(filename)['X_WORLD'][0], ns['X_WORLD'])
+
+    def test_batch_scored_as_single_catalogs(self):
+        ns_cfis.init_worker(rb_model.load(self.registry), os.path.join(self.ps1_dir, ''))
+        timings = ns_cfis.ns_cats(self.catalogs)
+        self.assertEqual([fits_tab for fits_tab, elapsed in timings], self.catalogs)
+        batched = [fits.getdata(filename + '.ns')['X_WORLD'] for filename in self.catalogs]
+        for filename, expected in zip(self.catalogs, batched):
+            ns_cfis.ns_cat(filename)
+            numpy.testing.assert_array_equal(fits.getdata(filename + '.ns')['X_WORLD'], expected)
+
+    def test_ps1_match_is_angular(self):
+        # PS1 sources near the pole and either side of RA 0.
+        ps1_ra = numpy.array([120.0, 0.00005])
+        ps1_dec = numpy.array([80.0, 10.0])
+        ps1_cat = os.path.join(self.ps1_dir, 'HPX_99999_STK.fits')
+        Table([ps1_ra, ps1_dec], names=('f0', 'f1')).write(ps1_cat, format='fits')
+        # 2 arcsec of RA at DEC 80 is 0.35 arcsec on the sky, 359.99995 is 0.35 arcsec from 0.00005 at DEC 10, and
+        # 0.6 arcsec north is beyond the 0.5 arcsec radius: a match on raw RA/DEC degrees would find none of them.
+        ns_cat = Table([[120.0 + 2 / 3600., 359.99995, 120.0], [80.0, 10.0, 80.0 + 0.6 / 3600.]],
+                       names=('X_WORLD', 'Y_WORLD'))
+        numpy.testing.assert_array_equal(ns_cfis.remove_ps1_source(ps1_cat, ns_cat), [True, True, False])
+
+
+if __name__ == '__main__':
+    unittest.main()
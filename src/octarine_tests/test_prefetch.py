@@ -0,0 +1,86 @@
+from __future__ import absolute_import
+import threading
+import time
+import unittest
+
+from daomop import prefetch
+
+LATENCY = 0.02
+IMAGES = 3
+
+
+def download(key):
+    time.sleep(LATENCY)
+    return key
+
+
+class SchedulerTest(unittest.TestCase):
+    """
+    Priorities, re-prioritisation and cancellation of the prefetch scheduler, with a simulated download latency.
+    """
+
+    def setUp(self):
+        self.scheduler = prefetch.Scheduler(processes=2)
+
+    def tearDown(self):
+        self.scheduler.close()
+
+    def time_to_first_image(self, candidates):
+        """
+        Queue the whole pixel in the background, then open its last candidate and time until its first image is in.
+        """
+        for candidate in range(candidates):
+            for image in range(IMAGES):
+                key = (candidate, image)
+                self.scheduler.submit(key, download, (key,))
+        start = time.time()
+        current = [self.scheduler.submit((candidates - 1, image), download, ((candidates - 1, image),),
+                                         prefetch.CURRENT) for image in range(IMAGES)]
+        current[0].get(timeout=10)
+        elapsed = time.time() - start
+        self.scheduler.cancel_all()
+        return elapsed
+
+    def test_time_to_first_image(self):
+        small = self.time_to_first_image(5)
+        large = self.time_to_first_image(100)
+        # first come first served would take about 100 * IMAGES / 2 * LATENCY = 3s for the large pixel.
+        self.assertLess(large, 10 * LATENCY)
+        self.assertLess(large, small + 5 * LATENCY)
+
+    def test_prioritise(self):
+        order = []
+        block = threading.Event()
+        lock = threading.Lock()
+
+        def record(key):
+            block.wait()
+            with lock:
+                order.append(key)
+
+        # a single worker, kept busy while the queue is built, so the order of the downloads is that of the queue
+        scheduler = prefetch.Scheduler(processes=1)
+        busy = scheduler.submit('busy', record, ('busy',), prefetch.CURRENT)
+        time.sleep(0.05)
+        requests = [scheduler.submit(key, record, (key,)) for key in 'abcd']
+        self.assertTrue(scheduler.prioritise('c', prefetch.CURRENT))
+        self.assertTrue(scheduler.prioritise('d', prefetch.LOOKAHEAD))
+        self.assertTrue(scheduler.cancel('a'))
+        block.set()
+        for request in [busy] + requests[1:]:
+            request.get(timeout=10)
+        self.assertEqual(order, ['busy', 'c', 'd', 'b'])
+        self.assertRaises(prefetch.Cancelled, requests[0].get, 1)
+        self.assertEqual(len(scheduler), 0)
+        scheduler.close()
+
+    def test_single_request_per_key(self):
+        first = self.scheduler.submit('a', download, ('a',))
+        second = self.scheduler.submit('a', download, ('a',), prefetch.CURRENT)
+        self.assertIs(first, second)
+        self.assertEqual(second.get(timeout=10), 'a')
+
+    def test_error(self):
+        def fail():
+            raise IOError("cutout not found")
+        self.assertRaises(IOError, self.scheduler.submit('a', fail).get, 10)
@@ -0,0 +1,43 @@
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+from astropy.table import Table
+
+from daomop import reference_index
+
+
+class ReferenceIndexTest(unittest.TestCase):
+    """
+    Build, save and query a reference index.
+    """
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        rand = numpy.random.RandomState(5)
+        self.ra = rand.uniform(359.5, 360.5, 1000) % 360
+        self.dec = rand.uniform(59.5, 60.5, 1000)
+        self.catalog = os.path.join(self.workdir, 'HPX_00001_STK.fits')
+        Table([self.ra, self.dec], names=('f0', 'f1')).write(self.catalog, format='fits')
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_within(self):
+        index = reference_index.get_index(self.catalog, ra_column='f0', dec_column='f1')
+        # 0.3 arcsec north of a reference source, and 0.3 arcsec east across RA 0, are matched.
+        dec = self.dec + 0.3 / 3600.
+        ra = (self.ra + 0.3 / 3600. / numpy.cos(numpy.radians(self.dec))) % 360
+        self.assertTrue(index.within(self.ra, dec, 0.5).all())
+        self.assertTrue(index.within(ra, self.dec, 0.5).all())
+        self.assertFalse(index.within(self.ra, self.dec + 2 / 3600., 0.5).any())
+
+    def test_cached(self):
+        index = reference_index.get_index(self.catalog, ra_column='f0', dec_column='f1')
+        self.assertTrue(os.path.exists(self.catalog + reference_index.SUFFIX))
+        loaded = reference_index.get_index(self.catalog, ra_column='f0', dec_column='f1')
+        self.assertEqual(len(loaded), len(index))
+        self.assertTrue(loaded.within(self.ra[:10], self.dec[:10], 0.1).all())
@@ -0,0 +1,61 @@
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+from mock import patch
+
+from daomop import CFIS_Link_stacked as link
+from daomop import kdtree_link
+from daomop import link_benchmark
+from daomop import tiled_link
+
+
+class TiledLinkerTest(unittest.TestCase):
+    """
+    Link a synthetic ns catalog in many small tiles and check the tracks match linking the whole catalog at once.
+    """
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.workdir = tempfile.mkdtemp()
+        self.catalog = link_benchmark.synthetic_catalog(200, 20, radius=0.3, seed=7)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.workdir)
+
+    def test_matches_untiled(self):
+        untiled, _ = link_benchmark.run(kdtree_link.KDTreeLinker, self.catalog, self.workdir, 20.0)
+        linker = tiled_link.TiledLinker(self.workdir, '160.0_10.0_0', engine='kdtree', memory=0.01)
+        linker.Searching(False, 'HPX_00000_RA_160.0_DEC_+10.0_cat.fits.ns')
+        linker.CleanTracks_array()
+        self.assertGreater(len(linker.tiles), 1)
+        self.assertEqual(self.ras(linker.mjdalltracks), self.ras(untiled))
+
+    @staticmethod
+    def ras(mjdalltracks):
+        return sorted(tuple(track['ra']) for tracks in mjdalltracks.values() for track in tracks.values())
+
+    def test_line_engine_matches_untiled(self):
+        catalog = link_benchmark.synthetic_catalog(20, 5, radius=0.03, seed=11)
+        # a small field and a narrow fan of angles keep the line search quick.
+        with patch.object(link, 'fr', 0.04), patch.object(link, 'openangle', 1.):
+            untiled, _ = link_benchmark.run(link.SearchMovingObjects, catalog, self.workdir, 20.0)
+            linker = tiled_link.TiledLinker(self.workdir, '160.0_10.0_0', engine='line', memory=0.006)
+            linker.Searching(False, 'HPX_00000_RA_160.0_DEC_+10.0_cat.fits.ns', os.path.join(self.workdir,
+                                                                                             'ratelist.txt'))
+            linker.CleanTracks_array()
+        self.assertGreater(len(linker.tiles), 1)
+        self.assertGreater(len(self.ras(untiled)), 0)
+        self.assertEqual(self.ras(linker.mjdalltracks), self.ras(untiled))
+
+    def test_split_covers_box(self):
+        rand = numpy.random.RandomState(1)
+        x, y = rand.uniform(0, 1, 1000), rand.uniform(0, 1, 1000)
+        cores = tiled_link.split(x, y, (0., 1., 0., 1.), 0.01, 100, 0.01)
+        self.assertAlmostEqual(sum((x1 - x0) * (y1 - y0) for x0, x1, y0, y1 in cores), 1.0)
+        for x0, x1, y0, y1 in cores:
+            inside = (x >= x0 - 0.01) & (x < x1 + 0.01) & (y >= y0 - 0.01) & (y < y1 + 0.01)
+            self.assertLessEqual(inside.sum(), 100)
@@ -0,0 +1,111 @@
+from __future__ import absolute_import
+import random
+import struct
+import threading
+import time
+import unittest
+import zlib
+
+import numpy
+from astropy.io import fits
+
+from daomop import tiles
+
+CUTOUTS = 20
+REVIEWERS = 8
+
+
+class TileCacheTest(unittest.TestCase):
+    """
+    Several simulated reviewers viewing the same cutouts share one rendering of each.
+    """
+
+    def setUp(self):
+        self.renders = []
+        self.lock = threading.Lock()
+
+    def hdu(self, key):
+        def load():
+            with self.lock:
+                self.renders.append(key)
+            time.sleep(0.01)
+            data = numpy.random.RandomState(key).normal(100, 10, (64, 48)).astype('f4')
+            return fits.ImageHDU(data=data, header=fits.Header([('EXPNUM', key)]))
+        return load
+
+    def test_reviewers(self):
+        cache = tiles.TileCache()
+        etags = {}
+        errors = []
+
+        def review(seed):
+            try:
+                keys = range(CUTOUTS)
+                random.Random(seed).shuffle(keys)
+                for key in keys:
+                    tile = cache.get(str(key), self.hdu(key))
+                    status, headers, body = tiles.response(tile)
+                    self.assertEqual(status, 200)
+                    with self.lock:
+                        self.assertEqual(etags.setdefault(key, headers['ETag']), headers['ETag'])
+                    # the browser revalidating its copy gets no body back
+                    self.assertEqual(tiles.response(tile, headers['ETag'])[::2], (304, ''))
+            except Exception as ex:
+                errors.append(ex)
+
+        reviewers = [threading.Thread(target=review, args=(seed,)) for seed in range(REVIEWERS)]
+        for reviewer in reviewers:
+            reviewer.start()
+        for reviewer in reviewers:
+            reviewer.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(self.renders), range(CUTOUTS))
+        self.assertEqual(cache.cache.stats['misses'], CUTOUTS)
+
+    def test_bounded(self):
+        tile = tiles.render(self.hdu(0)())
+        cache = tiles.TileCache(max_bytes=3 * tile.nbytes)
+        for key in range(10):
+            cache.get(str(key), self.hdu(key))
+        self.assertLessEqual(cache.cache.memory_used, 3 * tile.nbytes)
+        self.assertTrue(cache.has('9'))
+        self.assertFalse(cache.has('0'))
+        self.assertIsNone(cache.find('0'))
+
+    def test_find_not_counted(self):
+        cache = tiles.TileCache()
+        self.assertIsNone(cache.find('0'))
+        tile = cache.get('0', self.hdu(0))
+        self.assertIs(cache.find('0'), tile)
+        self.assertEqual(cache.cache.stats['misses'], 1)
+        self.assertEqual(cache.cache.stats['hits'], 0)
+
+    def test_png_counted_when_encoded(self):
+        tile = tiles.render(self.hdu(0)())
+        cache = tiles.TileCache(max_bytes=10 * tile.nbytes)
+        first = cache.get('0', self.hdu(0))
+        self.assertIsNone(first._png)
+        self.assertEqual(cache.cache.memory_used, tile.nbytes)
+        body = tiles.response(first)[2]
+        self.assertEqual(cache.cache.memory_used, tile.nbytes + len(body))
+
+        # serving the PNG of the latest tile makes it outgrow the budget: the older one is evicted.
+        cache = tiles.TileCache(max_bytes=2 * tile.nbytes)
+        cache.get('0', self.hdu(0))
+        tiles.response(cache.get('1', self.hdu(1)))
+        self.assertTrue(cache.has('1'))
+        self.assertFalse(cache.has('0'))
+
+    def test_render(self):
+        tile = tiles.render(self.hdu(1)())
+        self.assertEqual(tile.data.dtype, numpy.uint8)
+        self.assertEqual(tile.data.shape, (64, 48))
+        self.assertEqual(tile.hdu.header['EXPNUM'], 1)
+        self.assertTrue(tile.png.startswith('\x89PNG'))
+        width, height = struct.unpack('>II', tile.png[16:24])
+        self.assertEqual((width, height), (48, 64))
+        # the pixel rows, each behind its filter byte, top row first
+        start = tile.png.index('IDAT') + 4
+        length = struct.unpack('>I', tile.png[start - 8:start - 4])[0]
+        rows = numpy.frombuffer(zlib.decompress(tile.png[start:start + length]), dtype='u1').reshape(64, 1 + 3 * 48)
+        self.assertTrue(numpy.all(rows[:, 1::3] == tile.data[::-1]))
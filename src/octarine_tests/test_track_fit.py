@@ -0,0 +1,55 @@
+from __future__ import absolute_import
+import unittest
+
+import numpy
+
+from daomop import track_fit
+
+
+def track(ra, dec, mjd, mag=22.0):
+    return {'ra': list(ra), 'dec': list(dec), 'mjd': list(mjd), 'mag': [mag] * len(mjd)}
+
+
+class TrackFitTest(unittest.TestCase):
+    """
+    Fit linear motion to synthetic tracks and check the false links are pruned.
+    """
+
+    def setUp(self):
+        mjd = numpy.array([57800.30, 57800.34, 57800.38, 57800.42])
+        rate = 5.0 * 24 / 3600.  # 5 arcsec/hr, in degree per day
+        # moving due north, so the position angle is 90 degrees.
+        self.good = track(160.0 + 0 * mjd, 10.0 + rate * (mjd - mjd[0]), mjd)
+        # crossing RA 0, moving due east.
+        self.wrap = track((359.9999 + rate * (mjd - mjd[0])) % 360, [0.0] * 4, mjd)
+        self.bad = track([160.0, 160.0002, 160.0, 160.0002], [10.0, 10.0001, 10.0002, 10.0003], mjd)
+        self.mjdalltracks = {57800: {'good': self.good, 'wrap': self.wrap, 'bad': self.bad}}
+
+    def test_fit(self):
+        result = track_fit.fit(*track_fit.padded([self.good, self.wrap, self.bad]))
+        self.assertAlmostEqual(result['rate'][0], 5.0, places=3)
+        self.assertAlmostEqual(result['angle'][0], 90.0, places=3)
+        self.assertLess(result['rms'][0], 1e-3)
+        self.assertAlmostEqual(result['rate'][1], 5.0, places=3)
+        self.assertLess(result['rms'][1], 1e-3)
+        self.assertGreater(result['rms'][2], 0.3)
+
+    def test_prune(self):
+        pruned, fits = track_fit.prune(self.mjdalltracks)
+        self.assertEqual(sorted(pruned[57800]), ['good', 'wrap'])
+        self.assertEqual(sorted(fits[57800]), ['good', 'wrap'])
+        ranked, fits = track_fit.prune(self.mjdalltracks, drop=False)
+        self.assertEqual(fits[57800]['bad']['rank'], 2)
+        # the tracks keep the layout of the linker, the fits are written apart.
+        self.assertEqual(ranked[57800]['bad'], self.bad)
+
+    def test_max_dmag(self):
+        self.good['mag'] = [21.0, 22.0, 21.0, 22.0]
+        pruned, _ = track_fit.prune(self.mjdalltracks)
+        self.assertEqual(sorted(pruned[57800]), ['good', 'wrap'])
+        pruned, _ = track_fit.prune(self.mjdalltracks, max_dmag=0.25)
+        self.assertEqual(sorted(pruned[57800]), ['wrap'])
+
+    def test_fit_name(self):
+        self.assertEqual(track_fit.fit_name('HPX_02937_RA_160.3_DEC_+31.4_bk.json'),
+                         'HPX_02937_RA_160.3_DEC_+31.4_bk.fit.json')
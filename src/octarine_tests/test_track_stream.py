@@ -0,0 +1,56 @@
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+import unittest
+
+from daomop import CFIS_Link_stacked
+
+
+class TrackStreamTest(unittest.TestCase):
+    """
+    Check that the streamed linker output survives a killed job and reads back in the oneangle layout.
+    """
+    track = {'ra': [1.0, 1.1, 1.2], 'dec': [2.0, 2.1, 2.2], 'mjd': [57800.3, 57800.34, 57800.38]}
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.workdir, 'tracks.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_read_back(self):
+        stream = CFIS_Link_stacked.TrackStream(self.filename)
+        stream.write(10.0, [{57800: {'a': self.track}}, {57800: {}}, {57800: {'b': self.track}}])
+        stream.write(11.0, [{57800: {'c': self.track}}])
+        results = list(stream)
+        self.assertEqual(len(results), 2)
+        self.assertEqual([sorted(pairs['57800'].keys()) for pairs in results[0]], [['a'], ['b']])
+        self.assertEqual(results[1][0]['57800']['c'], self.track)
+
+    def test_restart_skips_done_angles_and_drops_partial_writes(self):
+        stream = CFIS_Link_stacked.TrackStream(self.filename)
+        stream.write(10.0, [{57800: {'a': self.track}}])
+        with open(self.filename, 'a') as fobj:
+            fobj.write('{"angle": 11.0, "pairs": {"57800"')
+        stream = CFIS_Link_stacked.TrackStream(self.filename)
+        self.assertEqual(stream.done.keys(), [10.0])
+        self.assertEqual(len(list(stream)), 1)
+        stream.remove()
+        self.assertFalse(os.path.exists(self.filename))
+
+    def test_restart_drops_torn_checkpoint_line(self):
+        stream = CFIS_Link_stacked.TrackStream(self.filename)
+        stream.write(10.0, [{57800: {'a': self.track}}])
+        offset = stream.done[10.0]
+        stream.write(11.0, [{57800: {'b': self.track}}])
+        # killed while writing the checkpoint of angle 12: its offset is cut short.
+        with open(stream.checkpoint, 'a') as fobj:
+            fobj.write('12.0 %d' % (offset // 10))
+        stream = CFIS_Link_stacked.TrackStream(self.filename)
+        self.assertEqual(sorted(stream.done.keys()), [10.0, 11.0])
+        stream.write(12.0, [{57800: {'c': self.track}}])
+        stream = CFIS_Link_stacked.TrackStream(self.filename)
+        self.assertEqual(sorted(stream.done.keys()), [10.0, 11.0, 12.0])
+        self.assertEqual(len(list(stream)), 3)
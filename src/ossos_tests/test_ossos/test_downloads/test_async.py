@@ -1,12 +1,16 @@
 __author__ = "David Rusk <drusk@uvic.ca>"
 
+import errno
+import threading
 import unittest
 
+from concurrent import futures
 from mock import Mock
 
 from ossos.astrom import SourceReading
+from ossos.downloads.async import AsynchronousDownloadManager
+from ossos.downloads.async import DownloadCancelled
 from ossos.downloads.async import DownloadRequest
-from ossos.downloads.async import DownloadThread
 from ossos.downloads.cutouts import ImageCutoutDownloader
 from ossos.downloads.cutouts.source import SourceCutout
 
@@ -32,18 +36,164 @@ class DownloadRequestTest(unittest.TestCase):
         callback.assert_called_once_with(cutout)
 
 
-class DownloadThreadTest(unittest.TestCase):
-    def test_do_download_executes_request(self):
-        work_queue = Mock()
-        downloader = Mock()
-        errorhandler = Mock()
-
-        thread = DownloadThread(work_queue, downloader, errorhandler)
-
-        request = Mock(spec=DownloadRequest)
-        thread.do_download(request)
-
-        request.execute.assert_called_once_with(downloader)
+class FakeDownloader(object):
+    """
+    Returns the reading as the cutout, holding the first download until
+    released so that the following requests queue up behind it.
+    """
+
+    def __init__(self, errors=None):
+        self.errors = errors or {}
+        self.downloaded = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def download_cutout(self, reading, focus=None, needs_apcor=False):
+        self.downloaded.append(reading)
+        if len(self.downloaded) == 1:
+            self.started.set()
+            self.release.wait(5)
+        if reading in self.errors:
+            raise self.errors[reading]
+        return reading
+
+
+class AsynchronousDownloadManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.downloader = FakeDownloader()
+        self.error_handler = Mock()
+        self.sleep = Mock()
+        self.dispatch = Mock()
+
+    def create_manager(self):
+        return AsynchronousDownloadManager(self.downloader, self.error_handler,
+                                           max_workers=1, dispatch=self.dispatch,
+                                           retries=2, backoff=0.5, sleep=self.sleep)
+
+    def request(self, name):
+        reading = Mock(spec=SourceReading, name=name)
+        return DownloadRequest(reading, callback=Mock())
+
+    def block(self, manager):
+        blocker = self.request("blocker")
+        future = manager.submit_request(blocker, priority=0)
+        self.downloader.started.wait(5)
+        return future
+
+    def test_requests_run_most_urgent_first(self):
+        manager = self.create_manager()
+        blocked = self.block(manager)
+        low, high, middle = self.request("low"), self.request("high"), self.request("middle")
+        submitted = [manager.submit_request(low, priority=5),
+                     manager.submit_request(high, priority=1),
+                     manager.submit_request(middle, priority=3)]
+        self.downloader.release.set()
+        futures.wait([blocked] + submitted, timeout=5)
+
+        self.assertEqual(self.downloader.downloaded[1:],
+                         [high.reading, middle.reading, low.reading])
+
+    def test_reprioritise_moves_queued_request(self):
+        manager = self.create_manager()
+        blocked = self.block(manager)
+        first, second = self.request("first"), self.request("second")
+        submitted = [manager.submit_request(first, priority=1),
+                     manager.submit_request(second, priority=2)]
+        self.assertTrue(manager.reprioritise(submitted[1], 0))
+        self.downloader.release.set()
+        futures.wait([blocked] + submitted, timeout=5)
+
+        self.assertEqual(self.downloader.downloaded[1:], [second.reading, first.reading])
+
+    def test_cancelled_requests_are_not_downloaded(self):
+        manager = self.create_manager()
+        blocked = self.block(manager)
+        by_token, by_future, kept = self.request("token"), self.request("future"), self.request("kept")
+        submitted = [manager.submit_request(request) for request in (by_token, by_future, kept)]
+        by_token.token.cancel()
+        manager.cancel(submitted[1])
+        self.downloader.release.set()
+        futures.wait([blocked] + submitted, timeout=5)
+
+        self.assertEqual(self.downloader.downloaded[1:], [kept.reading])
+        self.assertTrue(submitted[0].cancelled())
+        self.assertTrue(submitted[1].cancelled())
+        self.assertEqual(submitted[2].result(), kept.reading)
+        by_token.callback.assert_not_called()
+
+    def test_cancelling_running_request_skips_callback(self):
+        manager = self.create_manager()
+        blocker = self.request("blocker")
+        future = manager.submit_request(blocker)
+        self.downloader.started.wait(5)
+        manager.stop_download()
+        self.downloader.release.set()
+        manager.wait_for_downloads_to_stop()
+
+        self.assertRaises(DownloadCancelled, future.result)
+        self.dispatch.assert_not_called()
+
+    def test_cancelled_request_failing_is_not_an_error(self):
+        manager = self.create_manager()
+        blocker = self.request("blocker")
+        self.downloader.errors[blocker.reading] = IOError("connection reset")
+        future = manager.submit_request(blocker)
+        self.downloader.started.wait(5)
+        manager.stop_download()
+        self.downloader.release.set()
+        manager.wait_for_downloads_to_stop()
+
+        self.assertRaises(DownloadCancelled, future.result)
+        self.assertEqual(len(self.downloader.downloaded), 1)
+        self.error_handler.handle_error.assert_not_called()
+        self.dispatch.assert_not_called()
+
+    def test_callback_dispatched_with_cutout(self):
+        manager = self.create_manager()
+        self.downloader.release.set()
+        request = self.request("reading")
+        future = manager.submit_request(request)
+
+        self.assertEqual(future.result(timeout=5), request.reading)
+        manager.wait_for_downloads_to_stop()
+        self.dispatch.assert_called_once_with(request.callback, request.reading)
+
+    def test_error_propagates_after_retries(self):
+        request = self.request("failing")
+        error = IOError("connection reset")
+        self.downloader.errors[request.reading] = error
+        self.downloader.release.set()
+        manager = self.create_manager()
+        future = manager.submit_request(request)
+
+        self.assertIs(future.exception(timeout=5), error)
+        self.assertEqual(len(self.downloader.downloaded), 3)
+        self.error_handler.handle_error.assert_called_once_with(error, request)
+        self.assertEqual(self.sleep.call_count, 2)
+        for attempt, call in enumerate(self.sleep.call_args_list):
+            self.assertTrue(0 <= call[0][0] <= 0.5 * 2 ** attempt)
+        self.dispatch.assert_not_called()
+
+    def test_certificate_error_not_retried(self):
+        request = self.request("denied")
+        error = IOError(errno.EACCES, "certificate expired")
+        self.downloader.errors[request.reading] = error
+        self.downloader.release.set()
+        manager = self.create_manager()
+        future = manager.submit_request(request)
+
+        self.assertIs(future.exception(timeout=5), error)
+        self.assertEqual(len(self.downloader.downloaded), 1)
+        self.error_handler.handle_error.assert_called_once_with(error, request)
+
+    def test_resubmitting_cancelled_request_runs_it(self):
+        manager = self.create_manager()
+        self.downloader.release.set()
+        request = self.request("again")
+        request.token.cancel()
+        future = manager.submit_request(request)
+
+        self.assertEqual(future.result(timeout=5), request.reading)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,85 @@
+__author__ = "David Rusk <drusk@uvic.ca>"
+
+import threading
+import unittest
+
+from concurrent import futures
+from mock import Mock
+
+from ossos.downloads.calibration import CalibrationCache
+from ossos.downloads.core import ApcorData
+
+
+class CountingDownloader(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.apcor_uris = []
+        self.zmag_uris = []
+
+    def download_apcor(self, uri):
+        with self.lock:
+            self.apcor_uris.append(uri)
+        return ApcorData.from_string("4 15 0.19 0.01")
+
+    def download_zmag(self, uri):
+        with self.lock:
+            self.zmag_uris.append(uri)
+        return 26.1
+
+
+def make_reading(expnum, ccd):
+    reading = Mock()
+    reading.obs.expnum = expnum
+    reading.get_ccd_num.return_value = ccd
+    reading.get_apcor_uri.return_value = "vos:dbimages/{}/ccd{:02d}/{}p{:02d}.apcor".format(expnum, ccd, expnum, ccd)
+    reading.get_zmag_uri.return_value = "vos:dbimages/{}/ccd{:02d}/{}p{:02d}.zeropoint.used".format(expnum, ccd,
+                                                                                                    expnum, ccd)
+    return reading
+
+
+class CalibrationCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.downloader = CountingDownloader()
+        self.cache = CalibrationCache(self.downloader, max_workers=4)
+        # ten sources seen in three exposures, falling on two CCDs of each.
+        self.readings = [make_reading(expnum, 10 + source % 2)
+                         for source in range(10)
+                         for expnum in ['1616681', '1616682', '1616683']]
+
+    def test_one_fetch_per_distinct_ccd(self):
+        futures.wait(self.cache.prefetch(self.readings, zmag=True))
+        for reading in self.readings:
+            self.assertEqual(self.cache.apcor(reading).apcor, 0.19)
+            self.assertEqual(self.cache.zmag(reading), 26.1)
+
+        self.assertEqual(len(self.downloader.apcor_uris), 6)
+        self.assertEqual(len(set(self.downloader.apcor_uris)), 6)
+        self.assertEqual(len(self.downloader.zmag_uris), 6)
+
+    def test_prefetch_again_fetches_nothing(self):
+        futures.wait(self.cache.prefetch(self.readings))
+        self.assertEqual(self.cache.prefetch(self.readings), [])
+        self.assertEqual(len(self.downloader.apcor_uris), 6)
+        self.assertEqual(self.downloader.zmag_uris, [])
+
+    def test_concurrent_requests_share_fetch(self):
+        threads = [threading.Thread(target=self.cache.apcor, args=(reading,)) for reading in self.readings]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(self.downloader.apcor_uris), 6)
+
+    def test_failed_fetch_is_tried_again(self):
+        reading = make_reading('1616681', 22)
+        self.downloader.download_apcor = Mock(side_effect=[IOError("timeout"),
+                                                           ApcorData.from_string("4 15 0.2 0.01")])
+
+        self.assertRaises(IOError, self.cache.apcor, reading)
+        self.assertEqual(self.cache.apcor(reading).apcor, 0.2)
+        self.assertEqual(self.downloader.download_apcor.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+__author__ = "David Rusk <drusk@uvic.ca>"
+
+import gzip
+import multiprocessing
+import os
+import resource
+import tempfile
+import unittest
+
+import numpy
+from astropy.io import fits
+from mock import patch
+
+from ossos.downloads import core
+
+SHAPE = (4096, 4096)
+
+
+class FakeVOFile(object):
+    """
+    Reads a local file the way a vos client connection does, remembering
+    the largest read asked for.
+    """
+
+    def __init__(self, filename):
+        self.fobj = open(filename, 'rb')
+        self.largest_read = 0
+
+    def read(self, size=-1):
+        self.largest_read = max(self.largest_read, size < 0 and os.path.getsize(self.fobj.name) or size)
+        return self.fobj.read(size)
+
+    def close(self):
+        self.fobj.close()
+
+
+def write_image(filename, shape, compress=False):
+    data = numpy.arange(shape[0] * shape[1], dtype='f4').reshape(shape)
+    hdulist = fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(data)])
+    if compress:
+        with gzip.open(filename, 'wb') as fobj:
+            hdulist.writeto(fobj)
+    else:
+        hdulist.writeto(filename)
+    return data
+
+
+def peak_growth(filename, queue):
+    """
+    In a child process: how far the peak resident size grows while an
+    image is downloaded and all its pixels read, in bytes.
+    """
+    with patch.object(core.storage, 'vofile', lambda uri, **kwargs: FakeVOFile(filename)):
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        hdulist = core.Downloader().download_hdulist('vos:test/image.fits')
+        hdulist[1].data.sum()
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        hdulist.close()
+    queue.put((after - before) * 1024)
+
+
+class DownloaderTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'image.fits')
+
+    def tearDown(self):
+        for name in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, name))
+        os.rmdir(self.directory)
+
+    def download(self):
+        vofile = FakeVOFile(self.filename)
+        with patch.object(core.storage, 'vofile', return_value=vofile):
+            hdulist = core.Downloader().download_hdulist('vos:test/image.fits', view='data')
+        return vofile, hdulist
+
+    def test_download_hdulist_streams_and_memory_maps(self):
+        data = write_image(self.filename, (200, 300))
+        vofile, hdulist = self.download()
+
+        self.assertTrue(hdulist._file.memmap)
+        numpy.testing.assert_array_equal(hdulist[1].data, data)
+        self.assertEqual(vofile.largest_read, core.CHUNK_SIZE)
+        hdulist.close()
+
+    def test_gzipped_download_is_decompressed(self):
+        data = write_image(self.filename, (200, 300), compress=True)
+        vofile, hdulist = self.download()
+
+        numpy.testing.assert_array_equal(hdulist[1].data, data)
+        hdulist.close()
+
+    def test_peak_memory_is_about_one_image(self):
+        data = write_image(self.filename, SHAPE)
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=peak_growth, args=(self.filename, queue))
+        process.start()
+        growth = queue.get(timeout=60)
+        process.join()
+
+        self.assertLess(growth, 1.5 * data.nbytes)
+
+
+if __name__ == '__main__':
+    unittest.main()
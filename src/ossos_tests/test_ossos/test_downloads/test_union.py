@@ -0,0 +1,123 @@
+__author__ = "David Rusk <drusk@uvic.ca>"
+
+import unittest
+
+import numpy
+from astropy import units
+from astropy.coordinates import SkyCoord
+from astropy.io import fits
+from mock import Mock
+
+from ossos.downloads.async import UnionDownloadRequest
+from ossos.downloads.cutouts import union
+from ossos.downloads.cutouts.calculator import CoordinateConverter
+from ossos.gui.models.imagemanager import ImageManager
+from ossos.wcs import WCS
+
+PIXEL_SCALE = 0.185 / 3600.0
+
+
+def make_union_hdu(x_offset=1000, y_offset=2000, shape=(400, 300)):
+    """
+    A cutout starting at pixel (x_offset + 1, y_offset + 1) of its exposure.
+    """
+    header = fits.Header()
+    header['CTYPE1'] = 'RA---TAN'
+    header['CTYPE2'] = 'DEC--TAN'
+    header['CRVAL1'] = 150.0
+    header['CRVAL2'] = 10.0
+    header['CRPIX1'] = 1024.0 - x_offset
+    header['CRPIX2'] = 2300.0 - y_offset
+    header['CD1_1'] = -PIXEL_SCALE
+    header['CD1_2'] = 0.0
+    header['CD2_1'] = 0.0
+    header['CD2_2'] = PIXEL_SCALE
+    header['EXTVER'] = 22
+    data = numpy.arange(shape[0] * shape[1], dtype='f4').reshape(shape)
+    hdu = fits.ImageHDU(data=data, header=header)
+    hdu.converter = CoordinateConverter(x_offset, y_offset)
+    hdu.wcs = WCS(hdu.header)
+    return hdu
+
+
+class SectionTest(unittest.TestCase):
+    def setUp(self):
+        self.hdu = make_union_hdu()
+        self.hdulist = fits.HDUList([fits.PrimaryHDU(), self.hdu])
+
+    def sky(self, x, y):
+        ra, dec = self.hdu.wcs.xy2sky([x], [y], usepv=False)
+        return SkyCoord(ra[0], dec[0])
+
+    def test_section_box_clipped_to_image(self):
+        self.assertEqual(union.section_box(150, 200, 50, 300, 400), (100, 200, 150, 250))
+        self.assertEqual(union.section_box(10, 390, 50, 300, 400), (1, 60, 340, 400))
+        self.assertEqual(union.section_box(-20, 500, 50, 300, 400), (1, 51, 350, 400))
+
+    def test_section_shares_pixels(self):
+        section = union.section_hdu(self.hdu, (101, 200, 51, 150))
+
+        self.assertEqual(section.data.shape, (100, 100))
+        self.assertTrue(numpy.may_share_memory(section.data, self.hdu.data))
+        self.assertEqual(section.data[0, 0], self.hdu.data[50, 100])
+
+    def test_section_converts_to_original_frame(self):
+        section = union.section_hdu(self.hdu, (101, 200, 51, 150))
+
+        for x, y in [(1, 1), (37.5, 12.25), (100, 100)]:
+            union_x, union_y = x + 100, y + 50
+            self.assertEqual(section.converter.get_inverse_converter().convert((x, y)),
+                             self.hdu.converter.get_inverse_converter().convert((union_x, union_y)))
+            self.assertEqual(section.converter.convert((union_x + 1000, union_y + 2000)), (x, y))
+
+    def test_section_wcs_matches_union(self):
+        section = union.section_hdu(self.hdu, (101, 200, 51, 150))
+
+        for x, y in [(1, 1), (37.5, 12.25), (100, 100)]:
+            ra, dec = section.wcs.xy2sky([x], [y], usepv=False)
+            union_ra, union_dec = self.hdu.wcs.xy2sky([x + 100], [y + 50], usepv=False)
+            self.assertAlmostEqual(ra[0].value, union_ra[0].value, 9)
+            self.assertAlmostEqual(dec[0].value, union_dec[0].value, 9)
+
+    def test_section_hdulist_centred_on_sky_coord(self):
+        radius = 10 * units.arcsec
+        sections = union.section_hdulist(self.hdulist, self.sky(120, 240), radius)
+
+        self.assertIs(sections[0], self.hdulist[0])
+        half_size = int(round(radius.to(units.degree).value / PIXEL_SCALE))
+        self.assertEqual(sections[1].data.shape, (2 * half_size + 1, 2 * half_size + 1))
+        x, y = sections[1].wcs.sky2xy(self.sky(120, 240).ra, self.sky(120, 240).dec, usepv=False)
+        self.assertAlmostEqual(x, half_size + 1, 6)
+        self.assertAlmostEqual(y, half_size + 1, 6)
+
+    def test_union_circle_encloses_cutouts(self):
+        coords = [self.sky(20, 30), self.sky(150, 200), self.sky(280, 390)]
+        radius = 5 * units.arcsec
+        ra, dec, union_radius = union.union_circle(coords, radius)
+
+        centre = SkyCoord(ra, dec)
+        for coord in coords:
+            self.assertLessEqual((centre.separation(coord) + radius).to(units.degree).value,
+                                 union_radius.to(units.degree).value + 1e-12)
+
+
+class TripletDownloadTest(unittest.TestCase):
+    def test_one_download_per_exposure(self):
+        readings = [Mock(reference_sky_coord=SkyCoord(150.0 + i * 1e-3, 10.0, unit='deg')) for i in range(3)]
+        source = Mock()
+        source.get_readings.return_value = readings
+        source.num_readings.return_value = len(readings)
+        triplet_download_manager = Mock()
+
+        ImageManager(Mock(), triplet_download_manager).download_triplets_for_source(source)
+
+        requests = [call[0][0] for call in triplet_download_manager.submit_request.call_args_list]
+        self.assertEqual(len(requests), len(readings))
+        for request, reading in zip(requests, readings):
+            self.assertIsInstance(request, UnionDownloadRequest)
+            self.assertIs(request.reading, reading)
+            self.assertEqual(request.sky_coords, [r.reference_sky_coord for r in readings])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,17 +1,21 @@
 __author__ = "David Rusk <drusk@uvic.ca>"
 
+import os
+import shutil
+import tempfile
 import unittest
 
 from mock import Mock
 from hamcrest import (assert_that, contains_inanyorder, has_length, contains,
-                      equal_to)
+                      equal_to, none)
 
 from tests.base_tests import FileReadingTestCase
 from ossos.gui import tasks
 from ossos.gui.context import LocalDirectoryWorkingContext
 from ossos.gui.progress import (LocalProgressManager, InMemoryProgressManager,
                                    FileLockedException, RequiresLockException,
-                                   LOCK_SUFFIX)
+                                   LOCK_SUFFIX, DocumentProgressManager,
+                                   SQLiteProgressStore, ProgressStore)
 
 WD_HAS_PROGRESS = "data/persistence_has_progress"
 WD_NO_LOG = "data/persistence_no_log"
@@ -280,5 +284,222 @@ class InMemoryProgressManagerTest(unittest.TestCase):
         assert_that(self.undertest.owns_lock(self.file2), equal_to(True))
 
 
+class CountingStore(ProgressStore):
+    """
+    Counts the calls to a store, and lets a test change the document
+    behind a manager's back between its read and its swap.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.reads = 0
+        self.swaps = 0
+        self.before_swap = None
+
+    def read(self):
+        self.reads += 1
+        return self.store.read()
+
+    def compare_and_swap(self, version, state):
+        self.swaps += 1
+        if self.before_swap is not None:
+            before_swap, self.before_swap = self.before_swap, None
+            before_swap()
+        return self.store.compare_and_swap(version, state)
+
+    def acquire(self, filename, userid):
+        return self.store.acquire(filename, userid)
+
+    def holder(self, filename):
+        return self.store.holder(filename)
+
+    def release(self, filename):
+        self.store.release(filename)
+
+    def release_all(self):
+        self.store.release_all()
+
+    def mark_done(self, filename, userid):
+        self.store.mark_done(filename, userid)
+
+    def done_files(self):
+        return self.store.done_files()
+
+    def clear_done(self):
+        self.store.clear_done()
+
+
+class LastWriterWinsStore(CountingStore):
+    """
+    Swaps without checking the version, as two VOSpace writers can when
+    both check it before either writes.
+    """
+
+    def compare_and_swap(self, version, state):
+        self.swaps += 1
+        if self.before_swap is not None:
+            before_swap, self.before_swap = self.before_swap, None
+            before_swap()
+        return self.store.compare_and_swap(self.store.read()[1], state)
+
+
+class DocumentProgressManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.file1 = "file1.cands.astrom"
+        self.file2 = "file2.cands.astrom"
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "progress.sqlite")
+        self.context = Mock(spec=LocalDirectoryWorkingContext)
+        self.context.directory = self.directory
+        self.context.listdir.return_value = [self.file1, self.file2]
+        self.context.get_listing.return_value = [self.file1, self.file2]
+        self.store = CountingStore(SQLiteProgressStore(self.filename))
+        self.undertest = self.create_manager("main_user", self.store)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def create_manager(self, userid, store=None, legacy=None, track_partial_progress=False):
+        if store is None:
+            store = SQLiteProgressStore(self.filename)
+        return DocumentProgressManager(self.context, store, userid=userid, legacy=legacy,
+                                       track_partial_progress=track_partial_progress)
+
+    def test_store_swaps_only_unchanged_version(self):
+        store = SQLiteProgressStore(self.filename)
+        assert_that(store.read(), equal_to(({}, 0)))
+        assert_that(store.compare_and_swap(0, {"a": {"done": "x"}}), equal_to(True))
+        assert_that(store.compare_and_swap(0, {"b": {}}), equal_to(False))
+        state, version = store.read()
+        assert_that(store.compare_and_swap(version, {"c": {}}), equal_to(True))
+        assert_that(store.compare_and_swap(version, {"d": {}}), equal_to(False))
+        assert_that(store.read(), equal_to(({"c": {}}, version + 1)))
+
+    def test_store_lock_is_atomic(self):
+        store = SQLiteProgressStore(self.filename)
+        assert_that(store.holder(self.file1), none())
+        assert_that(store.acquire(self.file1, "main_user"), equal_to("main_user"))
+        assert_that(store.acquire(self.file1, "other_user"), equal_to("main_user"))
+        assert_that(store.acquire(self.file1, "main_user"), equal_to("main_user"))
+        store.release(self.file1)
+        assert_that(store.acquire(self.file1, "other_user"), equal_to("other_user"))
+
+    def test_lock_is_exclusive(self):
+        other = self.create_manager("other_user")
+        self.undertest.lock(self.file1)
+
+        self.assertRaises(FileLockedException, other.lock, self.file1)
+        self.assertRaises(FileLockedException, other.unlock, self.file1)
+        assert_that(self.undertest.owns_lock(self.file1), equal_to(True))
+        assert_that(other.owns_lock(self.file1), equal_to(False))
+
+        self.undertest.unlock(self.file1)
+        other.lock(self.file1)
+        assert_that(other.owns_lock(self.file1), equal_to(True))
+
+    def test_done_and_indices(self):
+        self.undertest = self.create_manager("main_user", track_partial_progress=True)
+        self.undertest.lock(self.file1)
+        self.undertest.record_index(self.file1, 0)
+        self.undertest.record_index(self.file1, 2)
+        self.undertest.record_done(self.file1)
+
+        other = self.create_manager("other_user", track_partial_progress=True)
+        assert_that(other.is_done(self.file1), equal_to(True))
+        assert_that(other.is_done(self.file2), equal_to(False))
+        assert_that(other.get_processed_indices(self.file1), contains(0, 2))
+        assert_that(other.get_done(tasks.CANDS_TASK), contains(self.file1))
+        self.assertRaises(RequiresLockException, other.record_done, self.file2)
+
+    def test_indices_not_recorded_by_default(self):
+        self.undertest.lock(self.file1)
+        self.store.reads = self.store.swaps = 0
+
+        self.undertest.record_index(self.file1, 0)
+
+        assert_that(self.store.reads, equal_to(0))
+        assert_that(self.store.swaps, equal_to(0))
+        assert_that(self.undertest.get_processed_indices(self.file1), equal_to([]))
+
+    def test_states_of_all_files_in_one_read(self):
+        self.undertest.lock(self.file1)
+        self.undertest.record_done(self.file1)
+        self.create_manager("other_user").lock(self.file2)
+        self.store.reads = 0
+
+        states = self.undertest.get_states([self.file1, self.file2, "file3"])
+
+        assert_that(self.store.reads, equal_to(1))
+        assert_that(states, equal_to({self.file1: {"done": True, "lock": "main_user"},
+                                      self.file2: {"done": False, "lock": "other_user"},
+                                      "file3": {"done": False, "lock": None}}))
+
+    def test_concurrent_change_is_not_lost(self):
+        other = self.create_manager("other_user")
+        self.store.before_swap = lambda: other.lock(self.file2)
+
+        self.undertest.lock(self.file1)
+
+        assert_that(self.store.swaps, equal_to(2))
+        assert_that(self.undertest.owns_lock(self.file1), equal_to(True))
+        assert_that(other.owns_lock(self.file2), equal_to(True))
+
+    def test_lock_taken_by_store_not_document(self):
+        # Another user took the lock but has not recorded it in the
+        # document yet.
+        SQLiteProgressStore(self.filename).acquire(self.file1, "other_user")
+        other = self.create_manager("other_user")
+
+        self.assertRaises(FileLockedException, self.undertest.lock, self.file1)
+        assert_that(self.undertest.owns_lock(self.file1), equal_to(False))
+        assert_that(other.owns_lock(self.file1), equal_to(True))
+
+    def test_unlock_releases_store_lock(self):
+        self.undertest.lock(self.file1)
+        self.undertest.unlock(self.file1)
+
+        other = self.create_manager("other_user")
+        other.lock(self.file1)
+        assert_that(other.get_states([self.file1])[self.file1]["lock"], equal_to("other_user"))
+
+    def test_clean_releases_locks(self):
+        self.undertest.lock(self.file1)
+        self.undertest.clean()
+
+        assert_that(self.undertest.owns_lock(self.file1), equal_to(False))
+        assert_that(self.undertest.get_states([self.file1])[self.file1]["lock"], none())
+
+    def test_done_survives_lost_document_write(self):
+        store = LastWriterWinsStore(SQLiteProgressStore(self.filename))
+        undertest = self.create_manager("main_user", store)
+        other = self.create_manager("other_user", store)
+        other.lock(self.file1)
+        # other records file1 done between our read and our write of the
+        # document, which then drops it.
+        store.before_swap = lambda: other.record_done(self.file1)
+
+        undertest.lock(self.file2)
+
+        assert_that(store.read()[0].get(self.file1, {}).get("done"), none())
+        assert_that(undertest.is_done(self.file1), equal_to(True))
+        assert_that(undertest.get_states([self.file1])[self.file1]["done"], equal_to(True))
+        assert_that(undertest.get_done(tasks.CANDS_TASK), equal_to([self.file1]))
+
+        undertest.clean()
+        assert_that(undertest.is_done(self.file1), equal_to(False))
+
+    def test_seeded_from_legacy_progress(self):
+        legacy_manager = InMemoryProgressManager(self.context, userid="old_user")
+        legacy_manager.done.add(self.file2)
+        legacy = Mock(wraps=legacy_manager)
+        manager = self.create_manager("main_user", legacy=legacy)
+
+        assert_that(manager.is_done(self.file2), equal_to(True))
+        assert_that(manager.is_done(self.file1), equal_to(False))
+        assert_that(legacy.get_states.call_count, equal_to(1))
+        manager.lock(self.file1)
+        assert_that(self.create_manager("main_user").is_done(self.file2), equal_to(True))
+
+
 if __name__ == '__main__':
     unittest.main()
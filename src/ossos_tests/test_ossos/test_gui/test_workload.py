@@ -1,6 +1,8 @@
 __author__ = "David Rusk <drusk@uvic.ca>"
 
 import os
+import threading
+import time
 import unittest
 
 from hamcrest import (assert_that, is_in, is_not, equal_to, is_, none,
@@ -42,6 +44,9 @@ class TestDirectoryManager(object):
     def get_file_size(self, filename):
         return 1
 
+    def get_file_sizes(self, filenames):
+        return dict((filename, self.get_file_size(filename)) for filename in filenames)
+
 
 class TestWorkUnitBuilder(object):
     def build_workunit(self, full_path):
@@ -627,6 +632,17 @@ class WorkUnitProviderTest(unittest.TestCase):
         self.assertRaises(NoAvailableWorkException, self.undertest.get_workunit,
                           ignore_list=[self.file1])
 
+    def test_progress_of_all_files_read_at_once(self):
+        test_files = [self.file1, self.file2, self.file3, self.file4]
+        self.directory_manager.set_listing(self.taskid, test_files)
+        self.progress_manager.done.update([self.file1, self.file2, self.file3])
+        self.progress_manager.get_states = Mock(wraps=self.progress_manager.get_states)
+        self.progress_manager.lock = Mock(wraps=self.progress_manager.lock)
+
+        assert_that(self.undertest.get_workunit().get_filename(), equal_to(self.file4))
+        assert_that(self.progress_manager.get_states.call_count, equal_to(1))
+        self.progress_manager.lock.assert_called_once_with(self.file4)
+
     def test_file_found_to_be_done_not_checked_again(self):
         test_files = [self.file1, self.file2, self.file3, self.file4]
         self.directory_manager.set_listing(self.taskid, test_files)
@@ -816,6 +832,153 @@ class PreFetchingWorkUnitProviderTest(unittest.TestCase):
         self.assertRaises(NoAvailableWorkException, self.undertest.get_workunit)
 
 
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class FakeWorkUnitProvider(object):
+    """
+    Hands out workunits, each taking fetch_time on the clock to fetch.
+    """
+
+    def __init__(self, clock, fetch_time, userid="me"):
+        self.clock = clock
+        self.fetch_time = fetch_time
+        self.progress_manager = Mock(spec=InMemoryProgressManager)
+        self.progress_manager.userid = userid
+        self.progress_manager.get_states.side_effect = self.get_states
+        self.states = {}
+        self.fetched = 0
+        self.fetching = 0
+        self.most_fetching = 0
+        self.lock = threading.Lock()
+
+    def get_states(self, filenames):
+        return dict((filename, self.states.get(filename, {"done": False, "lock": "me"}))
+                    for filename in filenames)
+
+    def get_workunit(self, ignore_list=None):
+        with self.lock:
+            self.fetching += 1
+            self.most_fetching = max(self.most_fetching, self.fetching)
+            self.clock.advance(self.fetch_time)
+            number = self.fetched
+            self.fetched += 1
+        time.sleep(0.01)
+        workunit = Mock(spec=WorkUnit)
+        workunit.get_filename.return_value = "Workunit%d" % number
+        with self.lock:
+            self.fetching -= 1
+        return workunit
+
+
+class AdaptivePreFetchingWorkUnitProviderTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.image_manager = Mock(spec=ImageManager)
+
+    def create_undertest(self, fetch_time, prefetch_quantity=8,
+                         max_bytes=10 ** 6, workunit_bytes=100):
+        self.workunit_provider = FakeWorkUnitProvider(self.clock, fetch_time)
+        undertest = PreFetchingWorkUnitProvider(self.workunit_provider,
+                                                prefetch_quantity,
+                                                self.image_manager,
+                                                initial_quantity=2,
+                                                max_bytes=max_bytes,
+                                                sizer=lambda workunit: workunit_bytes,
+                                                clock=self.clock)
+        # Fetch on the calling thread so the clock is deterministic.
+        undertest.prefetch_workunit = undertest._do_prefetch_workunit
+        return undertest
+
+    def review(self, undertest, count, review_time):
+        workunits = []
+        for _ in range(count):
+            workunits.append(undertest.get_workunit())
+            self.clock.advance(review_time)
+        return workunits
+
+    def test_starts_with_initial_quantity(self):
+        undertest = self.create_undertest(fetch_time=10)
+        undertest.get_workunit()
+        assert_that(undertest.workunits, has_length(2))
+
+    def test_fast_review_and_slow_fetch_prefetches_further(self):
+        undertest = self.create_undertest(fetch_time=5)
+        self.review(undertest, 6, review_time=1)
+        assert_that(undertest.depth, equal_to(6))
+        assert_that(undertest.workunits, has_length(6))
+
+    def test_depth_limited_by_prefetch_quantity(self):
+        undertest = self.create_undertest(fetch_time=60, prefetch_quantity=4)
+        self.review(undertest, 6, review_time=1)
+        assert_that(undertest.depth, equal_to(4))
+        assert_that(undertest.workunits, has_length(4))
+
+    def test_slow_review_and_fast_fetch_prefetches_less(self):
+        undertest = self.create_undertest(fetch_time=1)
+        self.review(undertest, 6, review_time=60)
+        assert_that(undertest.depth, equal_to(2))
+
+        undertest.get_workunit()
+        assert_that(undertest.workunits, has_length(2))
+
+    def test_prefetched_bytes_kept_within_budget(self):
+        undertest = self.create_undertest(fetch_time=60, max_bytes=300,
+                                          workunit_bytes=100)
+        for _ in range(6):
+            undertest.get_workunit()
+            assert_that(undertest.prefetched_bytes <= 300, equal_to(True))
+            self.clock.advance(1)
+        assert_that(undertest.depth, equal_to(3))
+
+    def test_workunit_taken_by_another_user_dropped(self):
+        undertest = self.create_undertest(fetch_time=1)
+        assert_that(undertest.get_workunit().get_filename(), equal_to("Workunit0"))
+
+        taken = undertest.workunits[0]
+        self.workunit_provider.states["Workunit1"] = {"done": False, "lock": "someone"}
+
+        assert_that(undertest.get_workunit().get_filename(), equal_to("Workunit2"))
+        self.image_manager.cancel_downloads_for_workunit.assert_called_once_with(taken)
+        assert_that(taken, is_not(is_in(undertest.workunits)))
+        assert_that(taken.unlock.called, equal_to(False))
+
+    def test_progress_of_prefetched_read_at_once(self):
+        undertest = self.create_undertest(fetch_time=1)
+        undertest.get_workunit()
+        undertest.get_workunit()
+
+        get_states = self.workunit_provider.progress_manager.get_states
+        assert_that(get_states.call_count, equal_to(1))
+        assert_that(get_states.call_args[0][0],
+                    contains("Workunit1", "Workunit2"))
+
+    def test_fetches_on_fixed_pool(self):
+        workunit_provider = FakeWorkUnitProvider(self.clock, fetch_time=0)
+        undertest = PreFetchingWorkUnitProvider(workunit_provider, 5,
+                                                self.image_manager,
+                                                max_workers=2)
+        undertest.get_workunit()
+        for _ in range(500):
+            if len(undertest.workunits) == 5:
+                break
+            time.sleep(0.01)
+        undertest.shutdown()
+
+        assert_that(undertest.workunits, has_length(5))
+        assert_that(workunit_provider.most_fetching, equal_to(2))
+        assert_that(self.image_manager.download_singlets_for_workunit.call_count,
+                    equal_to(5))
+
+
 class WorkUnitProviderRealFilesTest(FileReadingTestCase, DirectoryCleaningTestCase):
     def setUp(self):
         working_directory = self.get_directory_to_clean()
@@ -10,7 +10,8 @@ dependencies = ['requests >= 2.7',
                 'Polygon2',
                 'scipy',
                 'mp_ephem',
-                'ginga']
+                'ginga',
+                'futures']
 
 
 if sys.version_info[0] > 2:
@@ -18,7 +19,13 @@ if sys.version_info[0] > 2:
     sys.exit(-1)
 
 console_scripts = ['daomop_populate = daomop.populate:main',
+                   'daomop_ns = daomop.ns_cfis:main',
+                   'daomop_ref_index = daomop.reference_index:main',
+                   'daomop_rb = daomop.rb_model:main',
                    'daomop_link = daomop.CFIS_Link_stacked:main',
+                   'daomop_helio_link = daomop.helio_link:main',
+                   'daomop_link_benchmark = daomop.link_benchmark:main',
+                   'daomop_candidate_benchmark = daomop.candidate_benchmark:main',
                    'daomop_validate = daomop.web_validate:main',
                    'daomop_stationary = daomop.stationary:main',
                    'daomop_cat = daomop.build_cat:main',
@@ -1,21 +1,63 @@
 __author__ = "David Rusk <drusk@uvic.ca>"
-import Queue
+import errno
+import heapq
+import itertools
+import random
 import threading
+import time
+
+from concurrent import futures
 
 from src.daomop.gui import logger
 
 from src.validate.gui import config
 
 MAX_THREADS = config.read('APP.MAX_THREADS')
+RETRIES = 3
+BACKOFF = 1.0
+
+
+class DownloadCancelled(Exception):
+    """
+    Set on the future of a request whose token was cancelled.
+    """
+
+
+class CancellationToken(object):
+    """
+    Shared between a request and whoever may want to stop it.  A request
+    still queued is dropped once its token is cancelled; one already
+    downloading is not interrupted, but is not retried and its callback is
+    not called.
+    """
+
+    def __init__(self):
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+
+def call_now(function, *args):
+    function(*args)
 
 
 class AsynchronousDownloadManager(object):
     """
     Coordinates the downloading of images asynchronously from the rest of
     the application.
+
+    Requests wait in a priority queue and are run by a pool of at most
+    max_workers threads, the most urgent (lowest priority value) first.
     """
 
-    def __init__(self, downloader, error_handler):
+    def __init__(self, downloader, error_handler, max_workers=MAX_THREADS,
+                 dispatch=call_now, retries=RETRIES, backoff=BACKOFF,
+                 sleep=time.sleep):
         """
         Constructor.
 
@@ -24,52 +66,166 @@ class AsynchronousDownloadManager(object):
             Downloads images.
           error_handler:
             Handles errors that occur when trying to download resources.
+          max_workers: int
+            Number of downloads run at the same time.
+          dispatch: callable
+            Called as dispatch(callback, cutout) to run the completion
+            callback of a request, e.g. wx.CallAfter to run it in the GUI
+            thread.  By default the callback is run in the worker thread.
+          retries: int
+            Number of times a failed download is tried again before the
+            error is handed to the error handler.
+          backoff: float
+            Upper bound in seconds of the delay before the first retry,
+            doubled for each further retry; the actual delay is drawn
+            uniformly below the bound.
+          sleep: callable
+            Waits for the given number of seconds between retries.
         """
         self.downloader = downloader
         self.error_handler = error_handler
+        self.dispatch = dispatch
+        self.retries = retries
+        self.backoff = backoff
+        self.sleep = sleep
+
+        self._executor = futures.ThreadPoolExecutor(max_workers=max_workers)
+        self._lock = threading.Lock()
+        self._queue = []
+        self._entries = {}
+        self._count = itertools.count()
+        self._futures = {}
 
-        self._work_queue = Queue.PriorityQueue()
+    def submit_request(self, request, priority=100):
+        """
+        Queue a request.
 
-        self._workers = []
-        self._maximize_workers()
+        Returns:
+          future: concurrent.futures.Future
+            Resolves to the downloaded cutout.  Cancelling the future drops
+            the request if it has not started yet.
+        """
+        if request.token.cancelled:
+            # submitting again, e.g. retrying after an error, is a new request.
+            request.token = CancellationToken()
+        future = futures.Future()
+        with self._lock:
+            entry = [priority, next(self._count), request, future]
+            heapq.heappush(self._queue, entry)
+            self._entries[future] = entry
+            self._futures[future] = request
+        future.add_done_callback(self._forget)
+        # one pool task per request: each runs the most urgent request
+        # queued at the time a worker becomes free.
+        self._executor.submit(self._run_next)
+        return future
+
+    def reprioritise(self, future, priority):
+        """
+        Move a request that has not started yet to another priority.
 
-    def submit_request(self, request, priority=100):
-        self._work_queue.put((priority, request))
-        self._maximize_workers()
+        Returns:
+          True if the request was still queued.
+        """
+        with self._lock:
+            entry = self._entries.pop(future, None)
+            if entry is None or entry[2] is None:
+                return False
+            request = entry[2]
+            entry[2] = None
+            entry = [priority, next(self._count), request, future]
+            heapq.heappush(self._queue, entry)
+            self._entries[future] = entry
+            return True
+
+    def cancel(self, future):
+        """
+        Cancel a request, queued or running.
+        """
+        request = self._futures.get(future)
+        if request is not None:
+            request.token.cancel()
+        future.cancel()
 
     def stop_download(self):
-        for worker in self._workers:
-            worker.stop()
+        for future in list(self._futures):
+            self.cancel(future)
 
     def wait_for_downloads_to_stop(self):
-        while not self._all_workers_stopped():
-            pass
+        futures.wait(list(self._futures))
 
     def refresh_vos_client(self):
         self.downloader.refresh_vos_client()
 
-    def _maximize_workers(self):
-        self._prune_dead_workers()
-
-        while len(self._workers) < MAX_THREADS:
-            worker = DownloadThread(self._work_queue, self.downloader,
-                                    self.error_handler)
-            worker.daemon = True  # Thread quits when application does
-            self._workers.append(worker)
-            worker.start()
+    def shutdown(self, wait=True):
+        self.stop_download()
+        self._executor.shutdown(wait=wait)
 
-            logger.debug("Created download worker thread (total=%d)" %
-                         len(self._workers))
-
-    def _prune_dead_workers(self):
-        self._workers = filter(lambda thread: thread.is_alive(), self._workers)
-
-    def _all_workers_stopped(self):
-        for worker in self._workers:
-            if not worker.is_stopped():
-                return False
+    def _forget(self, future):
+        with self._lock:
+            self._futures.pop(future, None)
+            self._entries.pop(future, None)
 
-        return True
+    def _pop(self):
+        """
+        The most urgent request still wanted, None if there is none.
+        """
+        while True:
+            with self._lock:
+                if not self._queue:
+                    return None
+                _, _, request, future = heapq.heappop(self._queue)
+                if request is None:
+                    # moved to another priority.
+                    continue
+                self._entries.pop(future, None)
+            if request.token.cancelled:
+                future.cancel()
+            if future.set_running_or_notify_cancel():
+                return request, future
+
+    def _run_next(self):
+        item = self._pop()
+        if item is None:
+            return
+        request, future = item
+
+        attempt = 0
+        while True:
+            try:
+                cutout = request.download(self.downloader)
+                break
+            except Exception as error:
+                if request.token.cancelled:
+                    # Nobody wants the cutout any more: not an error.
+                    future.set_exception(DownloadCancelled(request))
+                    return
+                if attempt >= self.retries or not retryable(error):
+                    future.set_exception(error)
+                    # It is up to the error handler to requeue the request
+                    # if needed.
+                    self.error_handler.handle_error(error, request)
+                    return
+                delay = random.uniform(0, self.backoff * 2 ** attempt)
+                logger.debug("Download of {} failed ({}), retrying in {:.1f}s".format(
+                    request.reading, error, delay))
+                attempt += 1
+                self.sleep(delay)
+
+        if request.token.cancelled:
+            future.set_exception(DownloadCancelled(request))
+            return
+        future.set_result(cutout)
+        if request.callback is not None:
+            self.dispatch(request.callback, cutout)
+
+
+def retryable(error):
+    """
+    Whether trying again may help: not for a certificate problem, which
+    needs the user to act.
+    """
+    return getattr(error, "errno", None) != errno.EACCES
 
 
 class DownloadRequest(object):
@@ -81,7 +237,8 @@ class DownloadRequest(object):
                  reading,
                  focus=None,
                  needs_apcor=False,
-                 callback=None):
+                 callback=None,
+                 token=None):
         """
         Constructor.
 
@@ -101,56 +258,64 @@ class DownloadRequest(object):
           callback: callable
             An optional callback to be called with the downloaded snapshot
             as its argument.
+          token: CancellationToken
+            Cancels the request; a new token by default.
         """
         self.reading = reading
         self.needs_apcor = needs_apcor
         self.callback = callback
+        self.token = token if token is not None else CancellationToken()
 
         if focus is None:
             self.focus = reading.source_point
         else:
             self.focus = focus
 
-    def execute(self, downloader):
+    def download(self, downloader):
         cutout = downloader.download_cutout(self.reading,
                                             focus=self.focus,
                                             needs_apcor=self.needs_apcor)
         logger.debug("Got cutout: {}".format(cutout))
+        return cutout
+
+    def execute(self, downloader):
+        cutout = self.download(downloader)
         if self.callback is not None:
             self.callback(cutout)
 
 
-class DownloadThread(threading.Thread):
-    def __init__(self, work_queue, downloader, error_handler):
-        super(DownloadThread, self).__init__()
-
-        self.work_queue = work_queue
-        self.downloader = downloader
-        self.error_handler = error_handler
-
-        self._should_stop = False
-        self._idle = True
-
-    def run(self):
-        while not self._should_stop:
-            download_request = self.work_queue.get()
-            self._idle = False
-
-            try:
-                self.do_download(download_request)
-            except Exception as error:
-                self.error_handler.handle_error(error, download_request)
-            finally:
-                # It is up to the error handler to requeue the downloadable
-                # item if needed.
-                self.work_queue.task_done()
-                self._idle = True
-
-    def do_download(self, download_request):
-        download_request[1].execute(self.downloader)
+class UnionDownloadRequest(DownloadRequest):
+    """
+    Specifies one cutout of the exposure of a reading that encloses the
+    cutouts around several positions, such as all the readings of a source.
+    """
 
-    def stop(self):
-        self._should_stop = True
+    def __init__(self,
+                 reading,
+                 sky_coords,
+                 needs_apcor=False,
+                 callback=None,
+                 token=None):
+        """
+        Constructor.
 
-    def is_stopped(self):
-        return self._should_stop and self._idle
+        Args:
+          reading: daomop.astrom.SourceReading
+            The reading whose exposure is cut out.
+          sky_coords: list(SkyCoord)
+            The positions the cutout encloses.
+          needs_apcor, callback, token:
+            As for DownloadRequest.
+        """
+        super(UnionDownloadRequest, self).__init__(reading,
+                                                   needs_apcor=needs_apcor,
+                                                   callback=callback,
+                                                   token=token)
+        self.sky_coords = sky_coords
+
+    def download(self, downloader):
+        cutout = downloader.download_union_cutout(self.reading,
+                                                  self.sky_coords,
+                                                  needs_apcor=self.needs_apcor)
+        logger.debug("Got union cutout: {}".format(cutout))
+        return cutout
@@ -0,0 +1,133 @@
+__author__ = "David Rusk <drusk@uvic.ca>"
+
+import threading
+
+from concurrent import futures
+
+from src.validate.gui import logger
+from .core import Downloader
+
+MAX_WORKERS = 8
+
+
+def calibration_key(reading):
+    """
+    The aperture correction and zeropoint are per exposure and CCD.
+    """
+    return str(reading.obs.expnum), int(reading.get_ccd_num())
+
+
+class CalibrationCache(object):
+    """
+    The aperture corrections and zeropoints of the exposures and CCDs of a
+    workload, each fetched once per process however many readings and
+    cutouts share it.
+
+    prefetch collects the distinct (expnum, ccd) pairs of a set of readings
+    and fetches all those not yet known at once, in parallel, before their
+    cutouts ask for them.  Values are then served from memory.  Concurrent
+    requests for a value being fetched wait for that fetch instead of
+    starting another; failed fetches are not remembered.
+    """
+
+    def __init__(self, downloader=None, max_workers=MAX_WORKERS):
+        """
+        Constructor.
+
+        Args:
+          downloader: core.Downloader
+            Fetches the .apcor and .zeropoint.used files, reading local
+            copies when present.
+          max_workers: int
+            Number of files fetched at the same time by prefetch.
+        """
+        self.downloader = downloader or Downloader()
+        self._executor = futures.ThreadPoolExecutor(max_workers=max_workers)
+        self._lock = threading.Lock()
+        self._apcor = {}
+        self._zmag = {}
+
+    def _claim(self, values, key):
+        """
+        The future of a value, and whether the caller is to fetch it.
+        """
+        with self._lock:
+            future = values.get(key)
+            if future is not None:
+                return future, False
+            future = values[key] = futures.Future()
+        future.set_running_or_notify_cancel()
+        return future, True
+
+    def _fetch(self, values, key, fetch, uri, future):
+        try:
+            future.set_result(fetch(uri))
+        except Exception as ex:
+            logger.debug("Failed to fetch {}: {}".format(uri, ex))
+            with self._lock:
+                del values[key]
+            future.set_exception(ex)
+
+    def _value(self, values, key, fetch, uri):
+        future, leader = self._claim(values, key)
+        if leader:
+            self._fetch(values, key, fetch, uri, future)
+        return future.result()
+
+    def apcor(self, reading):
+        """
+        Returns:
+          apcor: core.ApcorData
+            The aperture correction of the exposure and CCD of reading.
+        """
+        return self._value(self._apcor, calibration_key(reading),
+                           self.downloader.download_apcor, reading.get_apcor_uri())
+
+    def zmag(self, reading):
+        """
+        Returns:
+          zmag: float
+            The zeropoint of the exposure and CCD of reading.
+        """
+        return self._value(self._zmag, calibration_key(reading),
+                           self.downloader.download_zmag, reading.get_zmag_uri())
+
+    def prefetch(self, readings, zmag=False):
+        """
+        Start fetching the calibration of every distinct exposure and CCD
+        of readings not already fetched or being fetched.
+
+        Args:
+          readings: list(daomop.astrom.SourceReading)
+          zmag: bool
+            Also fetch the zeropoints; by default only the aperture
+            corrections, the zeropoints being in the image headers.
+
+        Returns:
+          futures: list(concurrent.futures.Future)
+            One for each fetch started.
+        """
+        distinct = {}
+        for reading in readings:
+            try:
+                distinct.setdefault(calibration_key(reading), reading)
+            except Exception as ex:
+                logger.debug("No calibration key for {}: {}".format(reading, ex))
+
+        tables = [(self._apcor, self.downloader.download_apcor, 'get_apcor_uri')]
+        if zmag:
+            tables.append((self._zmag, self.downloader.download_zmag, 'get_zmag_uri'))
+
+        started = []
+        for key, reading in distinct.items():
+            for values, fetch, uri_method in tables:
+                uri = getattr(reading, uri_method)()
+                future, leader = self._claim(values, key)
+                if leader:
+                    self._executor.submit(self._fetch, values, key, fetch, uri, future)
+                    started.append(future)
+        logger.debug("Prefetching calibration of {} CCDs".format(len(distinct)))
+        return started
+
+
+CALIBRATION = CalibrationCache()
@@ -1,13 +1,49 @@
 import os
+import tempfile
+import zlib
 
 __author__ = "David Rusk <drusk@uvic.ca>"
 
 from astropy.io import fits
-import cStringIO
 from src.validate.gui import logger
 from src.daomop import storage
 import sys
 
+CHUNK_SIZE = 1024 ** 2
+GZIP_MAGIC = '\x1f\x8b'
+
+
+def stream(source, destination, chunk_size=CHUNK_SIZE):
+    """
+    Copy a file-like source to destination a chunk at a time, decompressing
+    it on the way if it is gzipped.  Tile compressed (fpack) FITS is copied
+    as is: astropy decompresses its HDUs when their data is accessed.
+
+    Returns:
+      size: int
+        The number of bytes written.
+    """
+    decompressor = None
+    first = True
+    size = 0
+    while True:
+        chunk = source.read(chunk_size)
+        if not chunk:
+            break
+        if first and chunk.startswith(GZIP_MAGIC):
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        first = False
+        if decompressor is not None:
+            chunk = decompressor.decompress(chunk)
+        destination.write(chunk)
+        size += len(chunk)
+    if decompressor is not None:
+        chunk = decompressor.flush()
+        destination.write(chunk)
+        size += len(chunk)
+    destination.flush()
+    return size
+
 
 class Downloader(object):
     """
@@ -34,17 +70,15 @@ class Downloader(object):
         logger.debug(str(kwargs))
         hdulist = None
         try:
-            vobj = storage.vofile(uri, **kwargs)
+            fobj = self.download_raw(uri, **kwargs)
             try:
-                fobj = cStringIO.StringIO(vobj.read())
-                fobj.seek(0)
-                hdulist = fits.open(fobj)
+                # the pixels stay in the temporary file and are paged in
+                # when used; the file goes when the HDUList is closed.
+                hdulist = fits.open(fobj, memmap=True)
             except Exception as e:
                 sys.stderr.write("ERROR: {}\n".format(str(e)))
                 sys.stderr.write("While loading {} {}\n".format(uri, kwargs))
-                pass
-            finally:
-                vobj.close()
+                fobj.close()
         except Exception as e:
             sys.stderr.write(str(e)+"\n")
             sys.stderr.write("While opening connection to {}.\n".format(uri))
@@ -52,6 +86,34 @@ class Downloader(object):
             hdulist = self.download_hdulist('vos:OSSOS/dbimages/calibrators/13AQ05_r_flat.fits', **kwargs)
         return hdulist
 
+    def download_raw(self, uri, **kwargs):
+        """
+        Downloads a file into an anonymous temporary file, decompressing it
+        on the fly if it is gzipped, without holding it in memory.
+
+        Args:
+          uri: The URI of the file to download.
+          kwargs: optional arguments to pass to the vos client.
+
+        Returns:
+          fobj: file
+            The temporary file, positioned at its start.  It is deleted
+            when closed.
+        """
+        vobj = storage.vofile(uri, **kwargs)
+        try:
+            fobj = tempfile.TemporaryFile(prefix='validate_')
+            try:
+                size = stream(vobj, fobj)
+            except Exception:
+                fobj.close()
+                raise
+        finally:
+            vobj.close()
+        logger.debug("Downloaded {} bytes from {}".format(size, uri))
+        fobj.seek(0)
+        return fobj
+
     def download_apcor(self, uri):
         """
         Downloads apcor data.
@@ -1,4 +1,5 @@
 from astropy import units
+from astropy.coordinates import SkyCoord
 from astropy.units import Quantity
 from src.daomop.gui import logger
 
@@ -6,6 +7,7 @@ from src.daomop import storage
 from src.daomop.astrom import SourceReading
 from src.validate.gui import config
 from ..core import Downloader
+from ..cutouts import union
 from ..cutouts.source import SourceCutout
 
 
@@ -69,6 +71,48 @@ class ImageCutoutDownloader(Downloader):
                                                                                                     needs_apcor))
         assert isinstance(reading, SourceReading)
 
+        radius = self.cutout_radius(reading)
+        image_uri = reading.get_image_uri()
+        logger.debug("Getting cutout at {} for {}".format(reading.reference_sky_coord, image_uri))
+        hdulist = storage._cutout_expnum(reading.obs,
+                                         reading.reference_sky_coord, radius)
+        # hdulist = storage.ra_dec_cutout(image_uri, reading.reference_sky_coord, radius)
+        return self._source_cutout(reading, hdulist, radius, needs_apcor)
+
+    def download_union_cutout(self, reading, sky_coords, needs_apcor=False):
+        """
+        Downloads one cutout of the exposure of a reading that encloses the
+        cutouts around each of several positions, to be cut up with
+        SourceCutout.section.
+
+        Args:
+          reading: daomop.astrom.SourceReading
+            The reading whose exposure is cut out.
+          sky_coords: list(SkyCoord)
+            The positions the cutout should enclose, e.g. those of all the
+            readings of a source.
+          needs_apcor: bool
+            As for download_cutout.
+
+        Returns:
+          cutout: daomop.downloads.data.SourceCutout
+            Its radius is that of the cutout around each position.
+        """
+        assert isinstance(reading, SourceReading)
+
+        radius = self.cutout_radius(reading)
+        ra, dec, union_radius = union.union_circle(sky_coords, radius)
+        logger.debug("Getting union cutout at {} {} radius {} for {}".format(ra, dec, union_radius,
+                                                                           reading.get_image_uri()))
+        hdulist = storage._cutout_expnum(reading.obs, SkyCoord(ra, dec), union_radius)
+        return self._source_cutout(reading, hdulist, radius, needs_apcor)
+
+    @staticmethod
+    def cutout_radius(reading):
+        """
+        The radius of the cutout around a reading: its uncertainty ellipse
+        with some margin, and at least the configured radius.
+        """
         min_radius = config.read('CUTOUTS.SINGLETS.RADIUS')
         if not isinstance(min_radius, Quantity):
             min_radius = min_radius * units.arcsec
@@ -77,11 +121,10 @@ class ImageCutoutDownloader(Downloader):
                      reading.uncertainty_ellipse.b) * 2.5 + min_radius
 
         logger.debug("got radius for cutout: {}".format(radius))
-        image_uri = reading.get_image_uri()
-        logger.debug("Getting cutout at {} for {}".format(reading.reference_sky_coord, image_uri))
-        hdulist = storage._cutout_expnum(reading.obs,
-                                         reading.reference_sky_coord, radius)
-        # hdulist = storage.ra_dec_cutout(image_uri, reading.reference_sky_coord, radius)
+        return radius
+
+    @staticmethod
+    def _source_cutout(reading, hdulist, radius, needs_apcor):
         logger.debug("Getting the aperture correction.")
         source = SourceCutout(reading, hdulist, radius=radius)
         # Accessing the attribute here to trigger the download.
@@ -15,7 +15,9 @@ from astropy.time import Time
 from astropy.units import Quantity
 from src.daomop.gui import logger
 
-from downloader import Downloader, ApcorData
+from ..core import ApcorData
+from ..calibration import CALIBRATION
+from union import section_hdulist
 from src.daomop import storage
 from src.daomop.astrom import SourceReading, Observation
 from src.validate.gui import config
@@ -59,6 +61,21 @@ class SourceCutout(object):
         self._tempfile = None
         self._bad_comparison_images = [self.hdulist[-1].header.get('EXPNUM', None)]
 
+    def section(self, sky_coord, radius=None):
+        """
+        The cutout of radius around sky_coord taken out of this one.  Its pixels are a view on those of this cutout,
+        with the WCS and the offsets to the original image adjusted, and it shares the photometric calibration.
+
+        @param sky_coord: centre of the section.
+        @param radius: half size of the section, the radius of this cutout by default.
+        @rtype: SourceCutout
+        """
+        radius = radius is not None and radius or self.radius
+        cutout = SourceCutout(self.reading, section_hdulist(self.hdulist, sky_coord, radius), radius=radius)
+        cutout._apcor = self._apcor
+        cutout._zmag = self._zmag
+        return cutout
+
     def reset_coord(self):
         """
         Reset the source location based on the init_skycoord values
@@ -278,7 +295,12 @@ class SourceCutout(object):
         """
         if self._zmag is None:
             hdulist_index = self.get_hdulist_idx(self.reading.get_ccd_num())
-            self._zmag = self.hdulist[hdulist_index].header.get('PHOTZP', 0.0)
+            self._zmag = self.hdulist[hdulist_index].header.get('PHOTZP', None)
+        if self._zmag is None:
+            try:
+                self._zmag = CALIBRATION.zmag(self.reading)
+            except:
+                self._zmag = 0.0
         return self._zmag
 
     @property
@@ -289,7 +311,7 @@ class SourceCutout(object):
         """
         if self._apcor is None:
             try:
-                self._apcor = Downloader().download_apcor(self.reading.get_apcor_uri())
+                self._apcor = CALIBRATION.apcor(self.reading)
             except:
                 self._apcor = ApcorData.from_string("5 15 99.99 99.99")
         return self._apcor
@@ -0,0 +1,103 @@
+"""
+The union module lets the readings of a source share one cutout of each exposure.  A triplet shows every reading of
+the source in every exposure, so instead of downloading one cutout per (exposure, reading), one cutout enclosing all
+of them is downloaded per exposure and each frame is a section of it: a view on its pixels, with the WCS and the
+offset to the original image adjusted to the section.
+"""
+import numpy
+from astropy import units
+from astropy.io import fits
+from astropy.units import Quantity
+
+from src.daomop import comparison
+from src.daomop.wcs import WCS
+from .calculator import CoordinateConverter
+
+__author__ = "David Rusk <drusk@uvic.ca>"
+
+
+def degrees(angle):
+    if isinstance(angle, Quantity):
+        return angle.to(units.degree).value
+    return float(angle)
+
+
+def union_circle(sky_coords, radius):
+    """
+    The circle enclosing circles of radius around each of sky_coords.
+
+    @param sky_coords: list of SkyCoord
+    @param radius: radius around each of them, Quantity or degrees.
+    @return: ra, dec, radius of the enclosing circle, all Quantity
+    """
+    ra = [coord.ra.to(units.degree).value for coord in sky_coords]
+    dec = [coord.dec.to(units.degree).value for coord in sky_coords]
+    ra, dec, union_radius = comparison.union_circle(ra, dec, degrees(radius))
+    return ra * units.degree, dec * units.degree, union_radius * units.degree
+
+
+def pixel_scale(hdu):
+    """
+    The size of a pixel of the HDU, in degrees.
+    """
+    return numpy.sqrt(abs(numpy.linalg.det(numpy.array(hdu.wcs.cd, dtype='f8'))))
+
+
+def section_box(x, y, half_size, naxis1, naxis2):
+    """
+    The box of half_size pixels around (x, y), clipped to an image of naxis1 by naxis2 pixels.  A point off the image
+    gives the box at the nearest edge.
+
+    @return: x1, x2, y1, y2, FITS pixels (from 1, inclusive)
+    """
+    x = min(max(x, 1), naxis1)
+    y = min(max(y, 1), naxis2)
+    x1 = max(int(round(x - half_size)), 1)
+    x2 = min(int(round(x + half_size)), naxis1)
+    y1 = max(int(round(y - half_size)), 1)
+    y2 = min(int(round(y + half_size)), naxis2)
+    return x1, x2, y1, y2
+
+
+def section_hdu(hdu, box):
+    """
+    A section of an image HDU, sharing its pixels.
+
+    @param hdu: ImageHDU with converter and wcs attributes, as made by storage.
+    @param box: x1, x2, y1, y2 from section_box
+    @return: ImageHDU whose converter and wcs map its pixels to the same places as those of hdu.
+    """
+    x1, x2, y1, y2 = box
+    header = hdu.header.copy()
+    for keyword in ['BZERO', 'BSCALE']:
+        header.pop(keyword, None)
+    header['CRPIX1'] = header.get('CRPIX1', 0) - (x1 - 1)
+    header['CRPIX2'] = header.get('CRPIX2', 0) - (y1 - 1)
+    section = fits.ImageHDU(data=hdu.data[y1 - 1:y2, x1 - 1:x2], header=header)
+    converter = getattr(hdu, 'converter', None)
+    x_offset = converter is not None and converter.x_offset or 0
+    y_offset = converter is not None and converter.y_offset or 0
+    section.converter = CoordinateConverter(x_offset + x1 - 1, y_offset + y1 - 1)
+    section.wcs = WCS(section.header)
+    return section
+
+
+def section_hdulist(hdulist, sky_coord, radius):
+    """
+    The section of radius around sky_coord of each image in hdulist; HDUs without data are kept as they are.
+
+    @param hdulist: the union cutout.
+    @param sky_coord: SkyCoord at the centre of the sections.
+    @param radius: Quantity or degrees.
+    @rtype: fits.HDUList
+    """
+    sections = []
+    for hdu in hdulist:
+        if hdu.data is None:
+            sections.append(hdu)
+            continue
+        x, y = hdu.wcs.sky2xy(sky_coord.ra, sky_coord.dec)
+        half_size = degrees(radius) / pixel_scale(hdu)
+        naxis2, naxis1 = hdu.data.shape
+        sections.append(section_hdu(hdu, section_box(float(x), float(y), half_size, naxis1, naxis2)))
+    return fits.HDUList(sections)
@@ -2,6 +2,8 @@ __author__ = "David Rusk <drusk@uvic.ca>"
 
 import sys
 
+import wx
+
 from src.daomop.astrom import AstromParser, StationaryParser
 
 from src.validate.downloads.async import AsynchronousDownloadManager
@@ -93,7 +95,10 @@ class ValidationApplication(object):
 
         prefetching_workunit_provider = PreFetchingWorkUnitProvider(workunit_provider,
                                                                     config.read("PREFETCH.NUMBER"),
-                                                                    image_manager)
+                                                                    image_manager,
+                                                                    initial_quantity=config.read("PREFETCH.INITIAL"),
+                                                                    max_workers=config.read("PREFETCH.WORKERS"),
+                                                                    max_bytes=config.read("PREFETCH.BYTES"))
 
         if working_context.is_remote():
             synchronization_manager = SynchronizationManager(working_context, sync_enabled=True)
@@ -132,14 +137,14 @@ class ValidationApplication(object):
             slice_cols=read("SINGLETS.SLICE_COLS"))
 
         singlet_download_manager = AsynchronousDownloadManager(
-            singlet_downloader, error_handler)
+            singlet_downloader, error_handler, dispatch=wx.CallAfter)
 
         triplet_downloader = ImageCutoutDownloader(
             slice_rows=read("TRIPLETS.SLICE_ROWS"),
             slice_cols=read("TRIPLETS.SLICE_COLS"))
 
         triplet_download_manager = AsynchronousDownloadManager(
-            triplet_downloader, error_handler)
+            triplet_downloader, error_handler, dispatch=wx.CallAfter)
 
         return ImageManager(singlet_download_manager, triplet_download_manager)
 
@@ -3,7 +3,8 @@ __author__ = "David Rusk <drusk@uvic.ca>"
 import os
 
 from src.daomop import storage
-from progress import LocalProgressManager, VOSpaceProgressManager
+from progress import (LocalProgressManager, VOSpaceProgressManager, DocumentProgressManager,
+                      VOSpaceProgressStore, PROGRESS_DOCUMENT)
 
 
 def get_context(directory, userid=None):
@@ -37,6 +38,12 @@ class WorkingContext(object):
     def get_file_size(self, filename):
         raise NotImplementedError()
 
+    def get_file_sizes(self, filenames):
+        """
+        The sizes of several files, by name.
+        """
+        return dict((filename, self.get_file_size(filename)) for filename in filenames)
+
     def exists(self, filename):
         raise NotImplementedError()
 
@@ -111,6 +118,16 @@ class VOSpaceWorkingContext(WorkingContext):
 
         return int(length_property)
 
+    def get_file_sizes(self, filenames):
+        """
+        The sizes of several files, from a single listing of the directory
+        when it gives them.
+        """
+        sizes = storage.list_sizes(self.directory)
+        return dict((filename, sizes[filename] if sizes.get(filename) is not None
+                     else self.get_file_size(filename))
+                    for filename in filenames)
+
     def _get_file_size_by_downloading(self, filename):
         filehandle = storage.vofile(self.get_full_path(filename), os.O_RDONLY)
         contents = filehandle.read()
@@ -130,4 +147,7 @@ class VOSpaceWorkingContext(WorkingContext):
         storage.delete_uri(self.get_full_path(filename))
 
     def get_progress_manager(self):
-        return VOSpaceProgressManager(self, track_partial_progress=False, userid=self.userid)
+        return DocumentProgressManager(self, VOSpaceProgressStore(self.get_full_path(PROGRESS_DOCUMENT)),
+                                       userid=self.userid, track_partial_progress=False,
+                                       legacy=VOSpaceProgressManager(self, track_partial_progress=False,
+                                                                     userid=self.userid))
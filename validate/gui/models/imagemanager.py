@@ -1,8 +1,9 @@
 __author__ = "David Rusk <drusk@uvic.ca>"
 
-from src.validate.downloads.cutouts.focus import (SingletFocusCalculator,
-                                                  TripletFocusCalculator)
-from ...downloads.async import DownloadRequest
+from src.validate.downloads.cutouts.focus import SingletFocusCalculator
+from ...downloads.async import (CancellationToken, DownloadRequest,
+                                UnionDownloadRequest)
+from ...downloads.calibration import CALIBRATION
 from ...downloads.cutouts.grid import CutoutGrid
 from ...gui import events, logger
 from ...gui.models.exceptions import ImageNotLoadedException
@@ -13,15 +14,18 @@ class ImageManager(object):
     TODO: refactor duplication.
     """
 
-    def __init__(self, singlet_download_manager, triplet_download_manager):
+    def __init__(self, singlet_download_manager, triplet_download_manager,
+                 calibration=CALIBRATION):
         self._singlet_download_manager = singlet_download_manager
         self._triplet_download_manager = triplet_download_manager
+        self._calibration = calibration
 
         self._cutouts = {}
         self._cutout_grids = {}
 
         self._workunits_downloaded_for_singlets = set()
         self._workunits_downloaded_for_triplets = set()
+        self._singlet_tokens = {}
 
     def submit_singlet_download_request(self, download_request):
         self._singlet_download_manager.submit_request(download_request)
@@ -37,12 +41,42 @@ class ImageManager(object):
                      workunit.get_filename())
 
         self._workunits_downloaded_for_singlets.add(workunit)
+        token = self._singlet_tokens[workunit] = CancellationToken()
 
         needs_apcor = workunit.is_apcor_needed()
+        if needs_apcor:
+            self.prefetch_calibration(workunit)
         for source in workunit.get_unprocessed_sources():
-            self.download_singlets_for_source(source, needs_apcor=needs_apcor)
+            self.download_singlets_for_source(source, needs_apcor=needs_apcor,
+                                              token=token)
+
+    def cancel_downloads_for_workunit(self, workunit):
+        """
+        Drops the singlet downloads of a workunit that have not finished,
+        e.g. when it was prefetched but has since been taken by another
+        user.  Downloading it again later starts them afresh.
+        """
+        token = self._singlet_tokens.pop(workunit, None)
+        if token is None:
+            return
 
-    def download_singlets_for_source(self, source, needs_apcor=False, priority=100):
+        logger.debug("Cancelling singlet downloads for workunit: %s" %
+                     workunit.get_filename())
+        token.cancel()
+        self._workunits_downloaded_for_singlets.discard(workunit)
+
+    def prefetch_calibration(self, workunit):
+        """
+        Starts fetching the aperture corrections of all the exposures and
+        CCDs of a workunit at once, rather than one per cutout.
+        """
+        readings = [reading
+                    for source in workunit.get_unprocessed_sources()
+                    for reading in source.get_readings()]
+        self._calibration.prefetch(readings)
+
+    def download_singlets_for_source(self, source, needs_apcor=False, priority=100,
+                                     token=None):
         focus_calculator = SingletFocusCalculator(source)
         logger.debug("Got focus calculator {} for source {}".format(focus_calculator, source))
 
@@ -57,7 +91,8 @@ class ImageManager(object):
                 DownloadRequest(reading,
                                 needs_apcor=needs_apcor,
                                 focus=focus,
-                                callback=self.on_singlet_image_loaded),
+                                callback=self.on_singlet_image_loaded,
+                                token=token),
                 priority=priority
             )
 
@@ -90,12 +125,20 @@ class ImageManager(object):
             self.download_triplets_for_source(source)
 
     def download_triplets_for_source(self, source, needs_apcor=False):
-        focus_calculator = TripletFocusCalculator(source)
+        """
+        Downloads one cutout per reading, enclosing the positions of all
+        the readings of the source, and fills the grid with sections of it:
+        one download per exposure instead of one per frame and exposure.
+        """
         grid = CutoutGrid(source)
+        sky_coords = [reading.reference_sky_coord
+                      for reading in source.get_readings()]
 
-        def create_callback(frame_index, time_index):
+        def create_callback(time_index):
             def callback(cutout):
-                grid.add_cutout(cutout, frame_index, time_index)
+                for frame_index, sky_coord in enumerate(sky_coords):
+                    grid.add_cutout(cutout.section(sky_coord),
+                                    frame_index, time_index)
 
                 if grid.is_filled():
                     self._cutout_grids[grid.source] = grid
@@ -105,16 +148,12 @@ class ImageManager(object):
             return callback
 
         for time_index, reading in enumerate(source.get_readings()):
-            for frame_index in range(source.num_readings()):
-                callback = create_callback(frame_index, time_index)
-
-                focus = focus_calculator.calculate_focus(reading, frame_index)
-                self._triplet_download_manager.submit_request(
-                    DownloadRequest(reading,
-                                    needs_apcor=needs_apcor,
-                                    focus=focus,
-                                    callback=callback)
-                )
+            self._triplet_download_manager.submit_request(
+                UnionDownloadRequest(reading,
+                                     sky_coords,
+                                     needs_apcor=needs_apcor,
+                                     callback=create_callback(time_index))
+            )
 
     def get_cutout_grid(self, source):
         try:
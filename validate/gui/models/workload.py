@@ -1,9 +1,13 @@
+import math
 import os
 import random
 import re
 import threading
+import time
 from glob import glob
 
+from concurrent import futures
+
 from src.daomop.astrom import StreamingAstromWriter, Source, SourceReading, StreamingVettingWriter
 from src.daomop.orbfit import Orbfit
 from .collections import StatefulCollection
@@ -596,20 +600,26 @@ class WorkUnitProvider(object):
         if ignore_list is None:
             ignore_list = []
 
-        potential_files = self.get_potential_files(ignore_list)
+        potential_files = [filename for filename in self.get_potential_files(ignore_list)
+                           if not self._filter(filename)]
+        # the sizes and progress of all the candidates at once rather than
+        # two remote calls per candidate.
+        sizes = self.directory_context.get_file_sizes(potential_files)
+        states = self.progress_manager.get_states(potential_files)
 
         while len(potential_files) > 0:
             potential_file = self.select_potential_file(potential_files)
             potential_files.remove(potential_file)
-            if self._filter(potential_file):
-                continue
 
-            if self.directory_context.get_file_size(potential_file) == 0:
+            if sizes[potential_file] == 0:
                 continue
 
-            if self.progress_manager.is_done(potential_file):
+            state = states[potential_file]
+            if state['done']:
                 self._done.append(potential_file)
                 continue
+            elif state['lock'] not in (None, self.progress_manager.userid):
+                continue
             else:
                 try:
                     self.progress_manager.lock(potential_file)
@@ -673,16 +683,107 @@ class WorkUnitProvider(object):
         pass
 
 
+PREFETCH_WORKERS = 3
+PREFETCH_BYTES = 2 * 1024 ** 3
+BYTES_PER_READING = 1024 ** 2
+MIN_SAMPLES = 3
+SMOOTHING = 0.3
+
+
+def estimate_workunit_bytes(workunit):
+    """
+    A rough size of the cutouts downloaded for a workunit, in bytes: one
+    cutout of BYTES_PER_READING per reading of its unprocessed sources.
+    0 if the workunit can't tell.
+    """
+    try:
+        return BYTES_PER_READING * sum(len(source.get_readings())
+                                       for source in workunit.get_unprocessed_sources())
+    except Exception as ex:
+        logger.debug("Can't estimate the size of {}: {}".format(workunit, ex))
+        return 0
+
+
+class MovingAverage(object):
+    """
+    Exponentially weighted moving average of a measurement, e.g. the time
+    taken to review a workunit.
+    """
+
+    def __init__(self, smoothing=SMOOTHING):
+        self.smoothing = smoothing
+        self.mean = None
+        self.count = 0
+
+    def add(self, value):
+        self.count += 1
+        if self.mean is None:
+            self.mean = float(value)
+        else:
+            self.mean += self.smoothing * (value - self.mean)
+
+
 class PreFetchingWorkUnitProvider(object):
-    def __init__(self, workunit_provider, prefetch_quantity, image_manager):
+    """
+    Keeps workunits ready ahead of the user, fetched and locked with their
+    singlet downloads started, on a fixed pool of threads.
+
+    How far ahead is adapted to how fast the user reviews workunits and how
+    long it takes to fetch one: enough to be fetched in the time the ones
+    ready are reviewed, at most prefetch_quantity and as many as the
+    estimated size of their downloads fits in max_bytes.  Workunits taken
+    by another user since they were prefetched are dropped, and their
+    downloads cancelled.
+    """
+
+    def __init__(self, workunit_provider, prefetch_quantity, image_manager=None,
+                 initial_quantity=None, max_workers=PREFETCH_WORKERS,
+                 max_bytes=PREFETCH_BYTES, sizer=estimate_workunit_bytes,
+                 clock=time.time):
+        """
+        Constructor.
+
+        Args:
+          workunit_provider: WorkUnitProvider
+          prefetch_quantity: int
+            The most workunits kept ahead of the user.
+          image_manager: ImageManager
+            Starts the singlet downloads of prefetched workunits.
+          initial_quantity: int
+            Workunits kept ahead until review and fetch times are known;
+            prefetch_quantity by default.
+          max_workers: int
+            Number of workunits fetched at the same time.
+          max_bytes: int
+            Budget for the estimated downloads of the prefetched workunits.
+          sizer: callable
+            Estimates the bytes downloaded for a workunit.
+          clock: callable
+            Current time in seconds.
+        """
         self.workunit_provider = workunit_provider
         self.prefetch_quantity = prefetch_quantity
         self.image_manager = image_manager
+        self.max_bytes = max_bytes
+        self.sizer = sizer
+        self.clock = clock
+
+        if initial_quantity is None:
+            initial_quantity = prefetch_quantity
+        self.depth = min(initial_quantity, prefetch_quantity)
 
         self.fetched_files = []
         self.workunits = []
 
-        self._threads = []
+        self.review_time = MovingAverage()
+        self.fetch_time = MovingAverage()
+        self.workunit_bytes = MovingAverage()
+
+        self._executor = futures.ThreadPoolExecutor(max_workers=max(max_workers, 1))
+        self._lock = threading.Lock()
+        self._pending = []
+        self._sizes = {}
+        self._last_returned = None
         self._all_fetched = False
 
     @property
@@ -692,66 +793,145 @@ class PreFetchingWorkUnitProvider(object):
         """
         return self.workunit_provider.directory
 
+    @property
+    def prefetched_bytes(self):
+        """
+        Estimated bytes of the workunits ready and being fetched.
+        """
+        in_flight = len(self._pending) * (self.workunit_bytes.mean or 0)
+        return sum(self._sizes.values()) + in_flight
+
     def get_workunit(self):
+        if self._last_returned is not None:
+            # Time spent by the user on the last workunit, not counting
+            # the time spent here waiting for this one.
+            self.review_time.add(self.clock() - self._last_returned)
+
+        self.drop_taken_workunits()
+
         if self._all_fetched and len(self.workunits) == 0:
             raise NoAvailableWorkException()
 
         if len(self.workunits) > 0:
-            workunit = self.workunits.pop(0)
+            with self._lock:
+                workunit = self.workunits.pop(0)
+                self._sizes.pop(workunit.get_filename(), None)
         else:
             workunit = self.workunit_provider.get_workunit(
                 ignore_list=self.fetched_files)
             self.fetched_files.append(workunit.get_filename())
 
+        self.adapt_depth()
         self.trigger_prefetching()
         logger.debug("Returning {}".format(workunit))
+        self._last_returned = self.clock()
         return workunit
 
+    def adapt_depth(self):
+        """
+        Sets how many workunits to keep ahead from the measured review and
+        fetch times, once there are enough of both.
+        """
+        if self.review_time.count < MIN_SAMPLES or self.fetch_time.count < MIN_SAMPLES:
+            return
+
+        review_time = max(self.review_time.mean, 1e-3)
+        depth = int(math.ceil(self.fetch_time.mean / review_time)) + 1
+        if self.workunit_bytes.mean:
+            depth = min(depth, int(self.max_bytes // self.workunit_bytes.mean))
+        depth = max(1, min(depth, self.prefetch_quantity))
+
+        if depth != self.depth:
+            logger.debug("Prefetching {} workunits ahead: {:.1f}s to review, "
+                         "{:.1f}s to fetch".format(depth, self.review_time.mean,
+                                                   self.fetch_time.mean))
+        self.depth = depth
+
     def trigger_prefetching(self):
         if self._all_fetched:
             return
 
-        num_to_fetch = self.prefetch_quantity - len(self.workunits)
+        self._pending = [future for future in self._pending if not future.done()]
+
+        num_to_fetch = self.depth - len(self.workunits) - len(self._pending)
 
-        if num_to_fetch < 0:
-            # Prefetch quantity can be 0
-            num_to_fetch = 0
+        # Fewer are needed ahead than are queued: drop those not started.
+        for future in reversed(self._pending):
+            if num_to_fetch >= 0:
+                break
+            if future.cancel():
+                num_to_fetch += 1
+        self._pending = [future for future in self._pending if not future.cancelled()]
 
         while num_to_fetch > 0:
-            if self._all_fetched:
+            if self._all_fetched or self.prefetched_bytes >= self.max_bytes:
                 return
 
             self.prefetch_workunit()
             num_to_fetch -= 1
 
     def prefetch_workunit(self):
-        thread = threading.Thread(target=self._do_prefetch_workunit)
-        self._threads.append(thread)
-        thread.start()
+        self._pending.append(self._executor.submit(self._do_prefetch_workunit))
 
     def _do_prefetch_workunit(self):
         try:
+            started = self.clock()
             workunit = self.workunit_provider.get_workunit(
                 ignore_list=self.fetched_files)
+            self.fetch_time.add(self.clock() - started)
             filename = workunit.get_filename()
 
-            # 2 or more threads created back to back could end up
+            # 2 or more workers started back to back could end up
             # retrieving the same workunit.  Only keep one of them.
-            if filename not in self.fetched_files:
+            with self._lock:
+                if filename in self.fetched_files:
+                    return
+                size = self.sizer(workunit)
+                self.workunit_bytes.add(size)
+                self._sizes[filename] = size
                 self.fetched_files.append(filename)
                 self.workunits.append(workunit)
+
+            if self.image_manager is not None:
                 self.image_manager.download_singlets_for_workunit(workunit)
 
-                logger.info("%s was prefetched." % filename)
+            logger.info("%s was prefetched." % filename)
 
         except NoAvailableWorkException:
             self._all_fetched = True
 
+    def drop_taken_workunits(self):
+        """
+        Drops the prefetched workunits that another user has since locked
+        or finished, reading their progress in one go.
+        """
+        progress_manager = getattr(self.workunit_provider, "progress_manager", None)
+        if progress_manager is None or len(self.workunits) == 0:
+            return
+
+        with self._lock:
+            workunits = list(self.workunits)
+        states = progress_manager.get_states([workunit.get_filename()
+                                              for workunit in workunits])
+
+        for workunit in workunits:
+            state = states.get(workunit.get_filename(), {})
+            if not state.get("done") and state.get("lock") in (None, progress_manager.userid):
+                continue
+
+            logger.info("%s was taken by another user." % workunit.get_filename())
+            with self._lock:
+                self.workunits.remove(workunit)
+                self._sizes.pop(workunit.get_filename(), None)
+            if self.image_manager is not None:
+                self.image_manager.cancel_downloads_for_workunit(workunit)
+
     def shutdown(self):
-        # Make sure all threads are finished so that no more locks are
+        # Make sure all fetches are finished so that no more locks are
         # acquired
-        for thread in self._threads:
-            thread.join()
+        for future in self._pending:
+            future.cancel()
+        self._executor.shutdown(wait=True)
 
         for workunit in self.workunits:
             workunit.unlock()
@@ -1,7 +1,12 @@
 __author__ = "David Rusk <drusk@uvic.ca>"
 
 import collections
+import json
+import os
+import sqlite3
+import tempfile
 import threading
+import uuid
 
 from src.daomop import storage
 from src.validate import auth
@@ -20,6 +25,12 @@ DONE_PROPERTY = "done"
 PROCESSED_INDICES_PROPERTY = "processed_indices"
 LOCK_PROPERTY = "lock_holder"
 
+# Constants for the state document progress manager
+PROGRESS_DOCUMENT = ".progress.json"
+LOCK_DIRECTORY = ".locks"
+DONE_DIRECTORY = ".done"
+CAS_RETRIES = 20
+
 # TODO: just make them both "," for consistency
 INDEX_SEP = "\n"
 VO_INDEX_SEP = ","
@@ -57,6 +68,12 @@ class RequiresLockException(Exception):
             "Operation requires a lock on the file.")
 
 
+class ProgressConflictException(Exception):
+    def __init__(self, filename):
+        super(ProgressConflictException, self).__init__(
+            "Progress of %s kept changing while being updated." % filename)
+
+
 class AbstractProgressManager(object):
     """
     Manages persistence of progress made processing files in a directory.
@@ -100,6 +117,23 @@ class AbstractProgressManager(object):
         """
         raise NotImplementedError()
 
+    def get_states(self, filenames):
+        """
+        Gets the progress of several files at once.
+
+        Args:
+          filenames: list(str)
+            Files in the working directory.
+
+        Returns:
+          states: dict(str, dict)
+            For each filename, 'done': True if it has been completely
+            processed, and 'lock': who holds its lock, None if it is not
+            locked or that can only be found by trying to lock it.
+        """
+        return dict((filename, {'done': self.is_done(filename), 'lock': None})
+                    for filename in filenames)
+
     def get_processed_indices(self, filename):
         """
         Retrieve indices of items that have been processed in a file.
@@ -272,6 +306,451 @@ class VOSpaceProgressManager(AbstractProgressManager):
         return self.working_context.get_full_path(filename)
 
 
+class ProgressStore(object):
+    """
+    Keeps the progress of all the files of a task directory as a single
+    state document with a version.  The document is only replaced if it has
+    not changed since it was read, so that concurrent reviewers can update
+    it without losing each other's changes.
+    """
+
+    def read(self):
+        """
+        Returns:
+          state: dict
+            The document, empty if there is none yet.
+          version: int
+            Its version, 0 if there is none yet.
+        """
+        raise NotImplementedError()
+
+    def compare_and_swap(self, version, state):
+        """
+        Replaces the document read at version by state.
+
+        Returns:
+          swapped: bool
+            False if the document changed since version, in which case it
+            is left as it is.
+        """
+        raise NotImplementedError()
+
+    def acquire(self, filename, userid):
+        """
+        Takes the lock of filename for userid, atomically: of several
+        users trying at once, only one gets it.
+
+        Returns:
+          holder: str
+            Who holds the lock now, userid if it was taken or already held.
+        """
+        raise NotImplementedError()
+
+    def holder(self, filename):
+        """
+        Returns:
+          holder: str
+            Who holds the lock of filename, None if nobody does.
+        """
+        raise NotImplementedError()
+
+    def release(self, filename):
+        """
+        Releases the lock of filename, whoever holds it.
+        """
+        raise NotImplementedError()
+
+    def release_all(self):
+        """
+        Releases the locks of all the files.
+        """
+        raise NotImplementedError()
+
+    def mark_done(self, filename, userid):
+        """
+        Records that filename is done, atomically and for that file alone,
+        so that no concurrent change of the document can lose it.
+        """
+        raise NotImplementedError()
+
+    def done_files(self):
+        """
+        Returns:
+          done: set(str)
+            The files recorded as done by mark_done, from a single read.
+        """
+        raise NotImplementedError()
+
+    def clear_done(self):
+        """
+        Forgets the files recorded as done.
+        """
+        raise NotImplementedError()
+
+
+class SQLiteProgressStore(ProgressStore):
+    """
+    A state document in an SQLite database, whose transactions make the
+    compare and swap atomic for all the processes sharing the file.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute("CREATE TABLE IF NOT EXISTS progress "
+                                   "(id INTEGER PRIMARY KEY CHECK (id = 0), "
+                                   "version INTEGER NOT NULL, document TEXT NOT NULL)")
+                connection.execute("CREATE TABLE IF NOT EXISTS locks "
+                                   "(filename TEXT PRIMARY KEY, holder TEXT NOT NULL)")
+                connection.execute("CREATE TABLE IF NOT EXISTS done "
+                                   "(filename TEXT PRIMARY KEY, holder TEXT NOT NULL)")
+        finally:
+            connection.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.filename, timeout=30)
+
+    def read(self):
+        connection = self._connect()
+        try:
+            row = connection.execute("SELECT version, document FROM progress WHERE id = 0").fetchone()
+        finally:
+            connection.close()
+        if row is None:
+            return {}, 0
+        return json.loads(row[1]), row[0]
+
+    def compare_and_swap(self, version, state):
+        document = json.dumps(state, separators=(',', ':'))
+        connection = self._connect()
+        try:
+            with connection:
+                if version == 0:
+                    cursor = connection.execute("INSERT OR IGNORE INTO progress (id, version, document) "
+                                                "VALUES (0, 1, ?)", (document,))
+                else:
+                    cursor = connection.execute("UPDATE progress SET version = version + 1, document = ? "
+                                                "WHERE id = 0 AND version = ?", (document, version))
+                return cursor.rowcount == 1
+        finally:
+            connection.close()
+
+    def acquire(self, filename, userid):
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute("INSERT OR IGNORE INTO locks (filename, holder) VALUES (?, ?)",
+                                   (filename, userid))
+                return connection.execute("SELECT holder FROM locks WHERE filename = ?",
+                                          (filename,)).fetchone()[0]
+        finally:
+            connection.close()
+
+    def holder(self, filename):
+        connection = self._connect()
+        try:
+            row = connection.execute("SELECT holder FROM locks WHERE filename = ?", (filename,)).fetchone()
+        finally:
+            connection.close()
+        return row is not None and row[0] or None
+
+    def release(self, filename):
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute("DELETE FROM locks WHERE filename = ?", (filename,))
+        finally:
+            connection.close()
+
+    def release_all(self):
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute("DELETE FROM locks")
+        finally:
+            connection.close()
+
+    def mark_done(self, filename, userid):
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute("INSERT OR IGNORE INTO done (filename, holder) VALUES (?, ?)",
+                                   (filename, userid))
+        finally:
+            connection.close()
+
+    def done_files(self):
+        connection = self._connect()
+        try:
+            rows = connection.execute("SELECT filename FROM done").fetchall()
+        finally:
+            connection.close()
+        return set(row[0] for row in rows)
+
+    def clear_done(self):
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute("DELETE FROM done")
+        finally:
+            connection.close()
+
+
+class VOSpaceProgressStore(ProgressStore):
+    """
+    A state document stored as a file in VOSpace.
+
+    VOSpace has no conditional write, so the swap checks the version just
+    before writing and reads the document back afterwards to detect a
+    concurrent writer that replaced it.  Writers that both pass the check
+    before either of them writes can still overwrite each other, so the
+    document is only a cache for bulk reads of the progress.  Locks and
+    done flags are recorded by creating one node per file, in LOCK_DIRECTORY
+    and DONE_DIRECTORY, which VOSpace refuses if the node already exists,
+    see storage.create_lock.  The done files are then all found by listing
+    DONE_DIRECTORY.
+    """
+
+    def __init__(self, uri):
+        self.uri = uri
+        self.lock_directory = "{}/{}".format(os.path.dirname(uri), LOCK_DIRECTORY)
+        self.done_directory = "{}/{}".format(os.path.dirname(uri), DONE_DIRECTORY)
+
+    def _lock_uri(self, filename):
+        return "{}/{}".format(self.lock_directory, filename)
+
+    def _download(self):
+        if not storage.exists(self.uri, force=True):
+            return {'version': 0, 'files': {}}
+        fd, filename = tempfile.mkstemp(suffix=PROGRESS_DOCUMENT)
+        os.close(fd)
+        try:
+            storage.copy(self.uri, filename)
+            with open(filename) as fobj:
+                return json.load(fobj)
+        finally:
+            os.remove(filename)
+
+    def read(self):
+        document = self._download()
+        return document['files'], document['version']
+
+    def compare_and_swap(self, version, state):
+        if self._download()['version'] != version:
+            return False
+        writer = uuid.uuid4().hex
+        fd, filename = tempfile.mkstemp(suffix=PROGRESS_DOCUMENT)
+        try:
+            with os.fdopen(fd, 'w') as fobj:
+                json.dump({'version': version + 1, 'writer': writer, 'files': state}, fobj,
+                          separators=(',', ':'))
+            storage.copy(filename, self.uri)
+        finally:
+            os.remove(filename)
+        return self._download().get('writer') == writer
+
+    def acquire(self, filename, userid):
+        return storage.create_lock(self._lock_uri(filename), userid)
+
+    def holder(self, filename):
+        return storage.lock_holder(self._lock_uri(filename))
+
+    def release(self, filename):
+        storage.release_lock(self._lock_uri(filename))
+
+    def release_all(self):
+        if storage.exists(self.lock_directory, force=True):
+            storage.delete(self.lock_directory)
+
+    def mark_done(self, filename, userid):
+        storage.create_lock("{}/{}".format(self.done_directory, filename), userid)
+
+    def done_files(self):
+        if not storage.exists(self.done_directory, force=True):
+            return set()
+        return set(storage.listdir(self.done_directory, force=True))
+
+    def clear_done(self):
+        if storage.exists(self.done_directory, force=True):
+            storage.delete(self.done_directory)
+
+
+class DocumentProgressManager(AbstractProgressManager):
+    """
+    Keeps the done and locked state and the processed indices of all the
+    files of a task directory in one state document, see ProgressStore.
+    Reading the progress of every file costs one read of the store, and
+    each change is a compare and swap.  Locks are taken and done flags
+    recorded atomically by the store, one file at a time, and copied into
+    the document, which is a cache for the bulk reads: a file is done if
+    either says so, so a document change lost to a concurrent writer
+    cannot hand a done file out again.
+    """
+
+    def __init__(self, working_context, store, userid=None, legacy=None,
+                 track_partial_progress=False):
+        """
+        By default partial results are not tracked, as with the
+        VOSpaceProgressManager: get_processed_indices returns an empty list
+        and record_index is a no-op.
+
+        Args:
+          working_context: WorkingContext
+            The task directory.
+          store: ProgressStore
+            Where the state document is kept.
+          legacy: AbstractProgressManager
+            If given, the progress it holds is copied into the document
+            when there is no document yet, e.g. the node properties of a
+            directory processed before the document was introduced.
+          track_partial_progress: bool
+            Record the indices of the items processed in each file.
+        """
+        super(DocumentProgressManager, self).__init__(working_context, userid=userid)
+        self.store = store
+        self.legacy = legacy
+        self.track_partial_results = track_partial_progress
+
+    def _read(self):
+        state, version = self.store.read()
+        if version == 0 and self.legacy is not None:
+            # Copy the legacy progress into the document, once.
+            self.store.compare_and_swap(0, self._seed())
+            state, version = self.store.read()
+        return state, version
+
+    def _seed(self):
+        state = {}
+        filenames = [filename for filename in self.working_context.listdir()
+                     if filename not in (PROGRESS_DOCUMENT, LOCK_DIRECTORY, DONE_DIRECTORY)]
+        for filename, legacy_state in self.legacy.get_states(filenames).items():
+            if legacy_state['done']:
+                state[filename] = {'done': legacy_state['done']}
+        return state
+
+    def _update(self, filename, change):
+        """
+        Applies change(file_state) to the state of filename and stores it,
+        retrying if someone else changed the document meanwhile.
+
+        Returns:
+          what change returned.
+        """
+        for _ in range(CAS_RETRIES):
+            state, version = self._read()
+            file_state = state.setdefault(filename, {})
+            result = change(file_state)
+            if not file_state:
+                del state[filename]
+            if self.store.compare_and_swap(version, state):
+                return result
+        raise ProgressConflictException(filename)
+
+    def _file_state(self, filename):
+        return self._read()[0].get(filename, {})
+
+    def _done_files(self, state):
+        return self.store.done_files().union(filename for filename, file_state in state.items()
+                                             if file_state.get('done'))
+
+    def get_states(self, filenames):
+        state = self._read()[0]
+        done = self._done_files(state)
+        return dict((filename, {'done': filename in done,
+                                'lock': state.get(filename, {}).get('lock')})
+                    for filename in filenames)
+
+    def get_done(self, task):
+        done = self._done_files(self._read()[0])
+        return [filename for filename in self.working_context.get_listing(task)
+                if filename in done]
+
+    def is_done(self, filename):
+        return filename in self.store.done_files() or bool(self._file_state(filename).get('done'))
+
+    def get_processed_indices(self, filename):
+        if not self.track_partial_results:
+            return []
+
+        return list(self._file_state(filename).get('indices', []))
+
+    def _record_done(self, filename):
+        self.store.mark_done(filename, self.userid)
+
+        def change(file_state):
+            file_state['done'] = self.userid
+
+        self._update(filename, change)
+
+    def _record_index(self, filename, index):
+        if not self.track_partial_results:
+            return
+
+        def change(file_state):
+            indices = file_state.setdefault('indices', [])
+            if index not in indices:
+                indices.append(index)
+
+        self._update(filename, change)
+
+    def lock(self, filename):
+        lock_holder = self.store.acquire(filename, self.userid)
+        if lock_holder != self.userid:
+            raise FileLockedException(filename, lock_holder)
+
+        def change(file_state):
+            file_state['lock'] = self.userid
+
+        self._update(filename, change)
+
+    def unlock(self, filename, async=False):
+        if async:
+            threading.Thread(target=self._do_unlock, args=(filename, )).start()
+        else:
+            self._do_unlock(filename)
+
+    def _do_unlock(self, filename):
+        lock_holder = self.store.holder(filename)
+        if lock_holder is not None and lock_holder != self.userid:
+            # Can't remove someone else's lock!
+            raise FileLockedException(filename, lock_holder)
+
+        def change(file_state):
+            if file_state.get('lock') == self.userid:
+                del file_state['lock']
+
+        self._update(filename, change)
+        if lock_holder is not None:
+            self.store.release(filename)
+
+    def clean(self, suffixes=None):
+        if suffixes is None:
+            suffixes = [DONE_SUFFIX, LOCK_SUFFIX, PART_SUFFIX]
+        keys = [{DONE_SUFFIX: 'done', LOCK_SUFFIX: 'lock', PART_SUFFIX: 'indices'}[suffix]
+                for suffix in suffixes]
+
+        for _ in range(CAS_RETRIES):
+            state, version = self.store.read()
+            for file_state in state.values():
+                for key in keys:
+                    file_state.pop(key, None)
+            state = dict((filename, file_state) for filename, file_state in state.items() if file_state)
+            if self.store.compare_and_swap(version, state):
+                break
+        else:
+            raise ProgressConflictException(self.working_context.directory)
+
+        if LOCK_SUFFIX in suffixes:
+            self.store.release_all()
+        if DONE_SUFFIX in suffixes:
+            self.store.clear_done()
+
+    def owns_lock(self, filename):
+        return self.store.holder(filename) == self.userid
+
+
 class LocalProgressManager(AbstractProgressManager):
     """
     Persists progress locally to disk.